@@ -5,7 +5,7 @@ from setuptools import Extension
 from setuptools.command.build_ext import build_ext
 
 extensions = [
-    Extension("preprocess_cancellation_cext", sources=["ext/gcode_parser.cxx", "ext/hull.cxx", "ext/point.cxx"]),
+    Extension("preprocess_cancellation_cext", sources=["ext/gcode_parser.cxx", "ext/hull.cxx", "ext/point.cxx", "ext/moves.cxx", "ext/bgcode.cxx", "ext/raster.cxx"]),
 ]
 
 
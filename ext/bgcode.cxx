@@ -0,0 +1,385 @@
+#include "bgcode.h"
+#include "pyref.h"
+#include <cstring>
+#include <vector>
+
+namespace {
+
+class BitReader {
+    public:
+        BitReader(const uint8_t *data, size_t size): data(data), size(size), bit(0) {}
+
+        /* Next bits, most significant first, or -1 at the end of data */
+        int get(int count) {
+            if (bit + count > size * 8)
+                return -1;
+            int value = 0;
+            for (int i = 0; i < count; i++, bit++)
+                value = (value << 1) | ((data[bit >> 3] >> (7 - (bit & 7))) & 1);
+            return value;
+        }
+
+    private:
+        const uint8_t *data;
+        size_t size;
+        size_t bit;
+};
+
+class BitWriter {
+    public:
+        BitWriter(std::string& out): out(out), current(0), used(0) {}
+
+        /* Up to 24 bits at a time */
+        void put(uint32_t value, int count) {
+            current = (current << count) | (value & ((1u << count) - 1));
+            used += count;
+            while (used >= 8) {
+                used -= 8;
+                out.push_back(static_cast<char>(current >> used));
+            }
+        }
+
+        /* Pad the last byte with zeros, the decoder drops an incomplete back-reference */
+        void flush() {
+            if (used > 0)
+                out.push_back(static_cast<char>(current << (8 - used)));
+            current = 0;
+            used = 0;
+        }
+
+    private:
+        std::string& out;
+        uint64_t current;
+        int used;
+};
+
+}
+
+std::string heatshrinkDecode(const uint8_t *data, size_t size, int windowBits, int lookaheadBits, size_t expected) {
+    std::string out;
+    out.reserve(expected);
+    BitReader reader(data, size);
+    while (true) {
+        int tag = reader.get(1);
+        if (tag < 0)
+            break;
+        if (tag) {
+            int literal = reader.get(8);
+            if (literal < 0)
+                break;
+            out.push_back(static_cast<char>(literal));
+        } else {
+            int index = reader.get(windowBits);
+            if (index < 0)
+                break;
+            int count = reader.get(lookaheadBits);
+            if (count < 0)
+                break;
+            size_t offset = index + 1;
+            /* The decoder window starts zeroed, back-references before the start of data read zeros */
+            for (int i = 0; i <= count; i++)
+                out.push_back(offset <= out.size() ? out[out.size() - offset] : 0);
+        }
+    }
+    return out;
+}
+
+/* Greedy LZSS with hash chains over 3 byte prefixes */
+static const int HASH_BITS = 13;
+static const int MIN_MATCH = 3;
+static const int MAX_CHAIN = 32;
+
+static inline unsigned hash3(const uint8_t *p) {
+    return ((p[0] << 10) ^ (p[1] << 5) ^ p[2]) & ((1 << HASH_BITS) - 1);
+}
+
+std::string heatshrinkEncode(const uint8_t *data, size_t size, int windowBits, int lookaheadBits) {
+    std::string out;
+    out.reserve(size / 2 + 16);
+    BitWriter writer(out);
+    const size_t window = size_t(1) << windowBits;
+    const size_t maxLength = size_t(1) << lookaheadBits;
+
+    std::vector<int64_t> head(1 << HASH_BITS, -1);
+    std::vector<int64_t> previous(size, -1);
+    auto insert = [&](size_t pos) {
+        if (pos + MIN_MATCH <= size) {
+            unsigned h = hash3(data + pos);
+            previous[pos] = head[h];
+            head[h] = pos;
+        }
+    };
+
+    size_t pos = 0;
+    while (pos < size) {
+        size_t bestLength = 0;
+        size_t bestOffset = 0;
+        if (pos + MIN_MATCH <= size) {
+            size_t limit = std::min(maxLength, size - pos);
+            int64_t candidate = head[hash3(data + pos)];
+            for (int chain = 0; candidate >= 0 && pos - candidate <= window && chain < MAX_CHAIN; chain++) {
+                size_t length = 0;
+                while (length < limit && data[candidate + length] == data[pos + length])
+                    length++;
+                if (length > bestLength) {
+                    bestLength = length;
+                    bestOffset = pos - candidate;
+                    if (length == limit)
+                        break;
+                }
+                candidate = previous[candidate];
+            }
+        }
+
+        if (bestLength >= MIN_MATCH) {
+            writer.put(0, 1);
+            writer.put(bestOffset - 1, windowBits);
+            writer.put(bestLength - 1, lookaheadBits);
+            for (size_t i = 0; i < bestLength; i++)
+                insert(pos + i);
+            pos += bestLength;
+        } else {
+            writer.put(1, 1);
+            writer.put(data[pos], 8);
+            insert(pos);
+            pos++;
+        }
+    }
+    writer.flush();
+    return out;
+}
+
+/* MeatPack packs the common G-code characters into 4 bits, two per byte, low nibble first. 0b1111 means the character
+ * follows in full. Two 0xFF bytes followed by a command byte switch the modes. */
+static const uint8_t MP_SIGNAL = 0xFF;
+static const uint8_t MP_ENABLE_PACKING = 0xFB;
+static const uint8_t MP_DISABLE_PACKING = 0xFA;
+static const uint8_t MP_RESET_ALL = 0xF9;
+static const uint8_t MP_ENABLE_NO_SPACES = 0xF7;
+static const uint8_t MP_DISABLE_NO_SPACES = 0xF6;
+static const uint8_t MP_FULL = 0xF;
+static const char MP_CHARS[] = "0123456789. \nGX";
+
+static int meatpackCode(uint8_t c) {
+    switch (c) {
+        case '0': case '1': case '2': case '3': case '4':
+        case '5': case '6': case '7': case '8': case '9':
+            return c - '0';
+        case '.': return 0b1010;
+        case ' ': return 0b1011;
+        case '\n': return 0b1100;
+        case 'G': return 0b1101;
+        case 'X': return 0b1110;
+    }
+    return MP_FULL;
+}
+
+static bool isGLineParameter(char c) {
+    return strchr("XYZEFIJRPWHCA", c) != nullptr && c != '\0';
+}
+
+std::string meatpackDecode(const uint8_t *data, size_t size) {
+    std::string out;
+    out.reserve(2 * size);
+
+    bool packing = false;
+    bool noSpaces = false;
+    bool signal = false;
+    bool command = false;
+    int fullQueue = 0;
+    char pending = 0;
+    bool addSpace = false;
+
+    auto emit = [&](char c) {
+        /* Spaces are dropped in the no-spaces mode, put them back in front of the G line parameters */
+        if (c == 'G' && (out.empty() || out.back() == '\n'))
+            addSpace = true;
+        else if (c == '\n')
+            addSpace = false;
+        if (addSpace && (out.empty() || out.back() != ' ') && isGLineParameter(c))
+            out.push_back(' ');
+        if (c != '\n' || out.empty() || out.back() != '\n')
+            out.push_back(c);
+    };
+    auto decodeChar = [&](int code) {
+        return code == 0b1011 && noSpaces ? 'E' : MP_CHARS[code];
+    };
+    auto receive = [&](uint8_t c) {
+        if (!packing) {
+            emit(c);
+        } else if (fullQueue > 0) {
+            emit(c);
+            if (pending) {
+                emit(pending);
+                pending = 0;
+            }
+            fullQueue--;
+        } else {
+            int low = c & 0xF;
+            int high = c >> 4;
+            if (low == MP_FULL) {
+                fullQueue++;
+                if (high == MP_FULL)
+                    fullQueue++;
+                else
+                    pending = decodeChar(high);
+            } else {
+                char first = decodeChar(low);
+                emit(first);
+                /* A line end completes the byte */
+                if (first != '\n') {
+                    if (high == MP_FULL)
+                        fullQueue++;
+                    else
+                        emit(decodeChar(high));
+                }
+            }
+        }
+    };
+
+    for (size_t i = 0; i < size; i++) {
+        uint8_t c = data[i];
+        if (c == MP_SIGNAL) {
+            if (signal) {
+                command = true;
+                signal = false;
+            } else {
+                signal = true;
+            }
+        } else if (command) {
+            switch (c) {
+                case MP_ENABLE_PACKING: packing = true; break;
+                case MP_DISABLE_PACKING: packing = false; break;
+                case MP_RESET_ALL: packing = false; break;
+                case MP_ENABLE_NO_SPACES: noSpaces = true; break;
+                case MP_DISABLE_NO_SPACES: noSpaces = false; break;
+            }
+            command = false;
+        } else {
+            if (signal) {
+                receive(MP_SIGNAL);
+                signal = false;
+            }
+            receive(c);
+        }
+    }
+    return out;
+}
+
+bool meatpackEncode(const uint8_t *data, size_t size, std::string& out) {
+    if (memchr(data, MP_SIGNAL, size))
+        return false;
+    out.clear();
+    out.reserve(size);
+    const char enable[] = {char(MP_SIGNAL), char(MP_SIGNAL), char(MP_ENABLE_PACKING)};
+    out.append(enable, sizeof(enable));
+
+    size_t i = 0;
+    while (i < size) {
+        uint8_t first = data[i];
+        int low = meatpackCode(first);
+        if (first == '\n') {
+            out.push_back(static_cast<char>(low));
+            i++;
+            continue;
+        }
+        if (i + 1 == size) {
+            /* A lone character at the end of a line without a line end, send it unpacked */
+            const char disable[] = {char(MP_SIGNAL), char(MP_SIGNAL), char(MP_DISABLE_PACKING)};
+            out.append(disable, sizeof(disable));
+            out.push_back(static_cast<char>(first));
+            break;
+        }
+        uint8_t second = data[i + 1];
+        int high = meatpackCode(second);
+        out.push_back(static_cast<char>((high << 4) | low));
+        if (low == MP_FULL)
+            out.push_back(static_cast<char>(first));
+        if (high == MP_FULL)
+            out.push_back(static_cast<char>(second));
+        i += 2;
+    }
+    return true;
+}
+
+static PyObject *py_heatshrink_decode(PyObject *self, PyObject *args) {
+    Py_buffer view;
+    int windowBits, lookaheadBits;
+    Py_ssize_t expected = 0;
+    if (!PyArg_ParseTuple(args, "y*ii|n", &view, &windowBits, &lookaheadBits, &expected))
+        return nullptr;
+    if (windowBits < 4 || windowBits > 15 || lookaheadBits < 3 || lookaheadBits >= windowBits) {
+        PyBuffer_Release(&view);
+        PyErr_SetString(PyExc_ValueError, "invalid heatshrink parameters");
+        return nullptr;
+    }
+    std::string out;
+    Py_BEGIN_ALLOW_THREADS
+    out = heatshrinkDecode(static_cast<const uint8_t*>(view.buf), view.len, windowBits, lookaheadBits, expected);
+    Py_END_ALLOW_THREADS
+    PyBuffer_Release(&view);
+    return PyBytes_FromStringAndSize(out.data(), out.size());
+}
+
+static PyObject *py_heatshrink_encode(PyObject *self, PyObject *args) {
+    Py_buffer view;
+    int windowBits, lookaheadBits;
+    if (!PyArg_ParseTuple(args, "y*ii", &view, &windowBits, &lookaheadBits))
+        return nullptr;
+    if (windowBits < 4 || windowBits > 15 || lookaheadBits < 3 || lookaheadBits >= windowBits) {
+        PyBuffer_Release(&view);
+        PyErr_SetString(PyExc_ValueError, "invalid heatshrink parameters");
+        return nullptr;
+    }
+    std::string out;
+    Py_BEGIN_ALLOW_THREADS
+    out = heatshrinkEncode(static_cast<const uint8_t*>(view.buf), view.len, windowBits, lookaheadBits);
+    Py_END_ALLOW_THREADS
+    PyBuffer_Release(&view);
+    return PyBytes_FromStringAndSize(out.data(), out.size());
+}
+
+static PyObject *py_meatpack_decode(PyObject *self, PyObject *args) {
+    Py_buffer view;
+    if (!PyArg_ParseTuple(args, "y*", &view))
+        return nullptr;
+    std::string out;
+    Py_BEGIN_ALLOW_THREADS
+    out = meatpackDecode(static_cast<const uint8_t*>(view.buf), view.len);
+    Py_END_ALLOW_THREADS
+    PyBuffer_Release(&view);
+    return PyBytes_FromStringAndSize(out.data(), out.size());
+}
+
+static PyObject *py_meatpack_encode(PyObject *self, PyObject *args) {
+    Py_buffer view;
+    if (!PyArg_ParseTuple(args, "y*", &view))
+        return nullptr;
+    std::string out;
+    bool ok;
+    Py_BEGIN_ALLOW_THREADS
+    ok = meatpackEncode(static_cast<const uint8_t*>(view.buf), view.len, out);
+    Py_END_ALLOW_THREADS
+    PyBuffer_Release(&view);
+    if (!ok) {
+        PyErr_SetString(PyExc_ValueError, "0xFF bytes can not be encoded with MeatPack");
+        return nullptr;
+    }
+    return PyBytes_FromStringAndSize(out.data(), out.size());
+}
+
+PyMethodDef bgcode_methods[] = {
+    {"heatshrink_decode", py_heatshrink_decode, METH_VARARGS,
+        "heatshrink_decode(data, window_bits, lookahead_bits, expected_size=0): decompress heatshrink data"
+    },
+    {"heatshrink_encode", py_heatshrink_encode, METH_VARARGS,
+        "heatshrink_encode(data, window_bits, lookahead_bits): compress data with heatshrink"
+    },
+    {"meatpack_decode", py_meatpack_decode, METH_VARARGS,
+        "Decode MeatPack encoded G-code"
+    },
+    {"meatpack_encode", py_meatpack_encode, METH_VARARGS,
+        "Encode G-code with MeatPack, raises ValueError if it contains 0xFF bytes"
+    },
+    {NULL}
+};
@@ -0,0 +1,21 @@
+#pragma once
+
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+
+#include <cstdint>
+#include <string>
+
+/* Codecs of the binary G-code format (.bgcode): the heatshrink LZSS compression and the MeatPack G-code encoding. */
+
+/* Decompress a heatshrink stream with the given window and lookahead sizes (in bits) */
+std::string heatshrinkDecode(const uint8_t *data, size_t size, int windowBits, int lookaheadBits, size_t expected);
+std::string heatshrinkEncode(const uint8_t *data, size_t size, int windowBits, int lookaheadBits);
+
+/* Decode MeatPack, adding back the spaces dropped from G lines in the no-spaces mode, like libbgcode does */
+std::string meatpackDecode(const uint8_t *data, size_t size);
+/* Encode text with MeatPack packing (keeping spaces and comments). Returns false if the text can not be represented,
+ * which is the case for 0xFF bytes. */
+bool meatpackEncode(const uint8_t *data, size_t size, std::string& out);
+
+extern PyMethodDef bgcode_methods[];
@@ -1,10 +1,16 @@
 #define PY_SSIZE_T_CLEAN
 #include <Python.h>
 #include <string>
-#include <stdexcept>
+#include <vector>
+#include <cmath>
+#include <cstring>
+#include <structmember.h>
 #include "pyref.h"
 #include "hull.h"
 #include "point.h"
+#include "moves.h"
+#include "number.h"
+#include "bgcode.h"
 
 /* Parse G-Code and
  * 1) track points and compute their convex hulls
@@ -16,15 +22,6 @@ struct StringSegment {
     StringSegment(): start(nullptr), size(0) {}
     StringSegment(const char* start, size_t size = 1): start(start), size(size) {}
 
-    bool grow() {
-        if (start[size] == 0) {
-            return false;
-        } else {
-            size++;
-            return true;
-        }
-    }
-
     bool cmpi(const char *str) {
         size_t other_size = strlen(str);
         if (size != other_size) {
@@ -37,22 +34,40 @@ struct StringSegment {
         return std::string(start, size);
     }
 
-    double atof() const {
-        return std::stod(string());
+    /* The number at the start of the segment, false if there is none */
+    bool number(double &out) const {
+        const char *p = start;
+        return parseNumber(p, start + size, out);
     }
 
     const char* start;
     size_t size;
 };
 
+/* One interesting line found by feed_buffer, packed for python as three int64 values */
+struct Match {
+    int64_t start;
+    int64_t end;
+    int64_t code;
+};
+
 struct Interest {
     std::string line_start;
     int code;
 };
 
 struct GCodeParserData {
+    GCodeParserData(): busy(false), lines(0) {}
     PyRef currentHull;
     std::vector<Interest> interests;
+    /* Indices of the interests that can match a line starting with a given character, in registration order. An
+     * interest in the empty prefix is in every bucket (and in emptyLine, for lines with nothing but whitespace). */
+    std::vector<size_t> dispatch[256];
+    std::vector<size_t> emptyLine;
+    /* feed_buffer is running without the GIL, the interests must not change */
+    bool busy;
+    /* Number of lines processed */
+    unsigned long long lines;
 };
 
 struct GCodeParser {
@@ -60,6 +75,9 @@ struct GCodeParser {
 
     GCodeParserData data;
 
+    const Interest* processLine(const char *line, const char *end, Hull *hull);
+    bool checkBusy();
+
     static PyObject *py_new(PyTypeObject *type, PyObject *args, PyObject *kwds);
     static void py_dealloc(PyObject *self);
 
@@ -67,6 +85,7 @@ struct GCodeParser {
     static PyObject *py_get_hull(GCodeParser *self, void *closure);
 
     static PyObject *py_feed_line(GCodeParser *self, PyObject *args);
+    static PyObject *py_feed_buffer(GCodeParser *self, PyObject *args, PyObject *kwds);
     static PyObject *py_register_interest(GCodeParser *self, PyObject *args);
     static PyObject *py_clear_interests(GCodeParser *self, PyObject *args);
 };
@@ -111,50 +130,80 @@ PyObject* GCodeParser::py_get_hull(GCodeParser *self, void *closure) {
     }
 }
 
+bool GCodeParser::checkBusy() {
+    if (data.busy) {
+        PyErr_SetString(PyExc_RuntimeError, "the parser is being used by another thread");
+        return true;
+    }
+    return false;
+}
+
 PyObject* GCodeParser::py_register_interest(GCodeParser *self, PyObject *args) {
     const char *line_start;
     int code;
     if (!PyArg_ParseTuple(args, "si", &line_start, &code))
         return nullptr;
+    if (self->checkBusy())
+        return nullptr;
 
     Interest i;
     i.code = code;
     i.line_start = line_start;
     self->data.interests.push_back(std::move(i));
+
+    size_t index = self->data.interests.size() - 1;
+    unsigned char first = line_start[0];
+    if (first == '\0') {
+        for (auto& bucket: self->data.dispatch)
+            bucket.push_back(index);
+        self->data.emptyLine.push_back(index);
+    } else {
+        self->data.dispatch[tolower(first)].push_back(index);
+        if (toupper(first) != tolower(first))
+            self->data.dispatch[toupper(first)].push_back(index);
+    }
     Py_RETURN_NONE;
 }
 
 PyObject* GCodeParser::py_clear_interests(GCodeParser *self, PyObject * Py_UNUSED(args)) {
+    if (self->checkBusy())
+        return nullptr;
     self->data.interests.clear();
+    for (auto& bucket: self->data.dispatch)
+        bucket.clear();
+    self->data.emptyLine.clear();
     Py_RETURN_NONE;
 }
 
-PyObject *GCodeParser::py_feed_line(GCodeParser *self, PyObject *args)
+/* Process one line in [line, end), returns the matched interest if there is one. Otherwise feeds extrusion
+ * moves to the hull (if any). Does not touch any python objects, so it can run without the GIL. */
+const Interest* GCodeParser::processLine(const char *line, const char *end, Hull *hull)
 {
-    const char *line_orig;
-    if (!PyArg_ParseTuple(args, "s", &line_orig))
-        return nullptr;
+    data.lines++;
 
-    const char *line = line_orig;
     /* Skip whitespace */
-    while (isspace(*line))
+    while (line < end && isspace(*line))
         line++;
 
-    /* Check for interests */
-    for (auto& interest: self->data.interests) {
-        if (strncasecmp(line, interest.line_start.c_str(), interest.line_start.size()) == 0) {
-            return PyLong_FromLong(interest.code);
+    /* Check for interests, only those starting with the same character */
+    size_t remaining = end - line;
+    const auto& candidates = remaining > 0 ? data.dispatch[static_cast<unsigned char>(*line)] : data.emptyLine;
+    for (size_t index: candidates) {
+        const auto& interest = data.interests[index];
+        if (interest.line_start.size() <= remaining
+            && strncasecmp(line, interest.line_start.c_str(), interest.line_start.size()) == 0) {
+            return &interest;
         }
     }
 
-    if (!self->data.currentHull) {
-        Py_RETURN_NONE;
+    if (!hull) {
+        return nullptr;
     }
 
     /* Anything that looks like extrusion move, we remember. Very coarse heuristic, we e.g. assume the slicer
      * is using absolute coordinates. */
-    if (tolower(*line) != 'g') {
-        Py_RETURN_NONE;
+    if (line == end || tolower(*line) != 'g') {
+        return nullptr;
     }
 
     StringSegment cmd;
@@ -164,17 +213,17 @@ PyObject *GCodeParser::py_feed_line(GCodeParser *self, PyObject *args)
     StringSegment unknown;
 
     /* Parsing helpers */
-    auto is_cmd = [](int c) {return !(isspace(c) || c == ';' || c == '\0'); };
+    auto is_cmd = [&](const char *c) {return c < end && !(isspace(*c) || *c == ';' || *c == '\0'); };
     auto consume_command = [&](StringSegment& into) {
         into = StringSegment(line, 0);
-        while (is_cmd(*line)) {
+        while (is_cmd(line)) {
             line++;
-            into.grow();
+            into.size++;
         }
     };
 
     auto skip_whitespace = [&]() {
-        while (isspace(*line))
+        while (line < end && isspace(*line))
             line++;
     };
 
@@ -182,7 +231,7 @@ PyObject *GCodeParser::py_feed_line(GCodeParser *self, PyObject *args)
     consume_command(cmd);
     skip_whitespace();
 
-    while (*line != '\0' && *line != ';') {
+    while (line < end && *line != '\0' && *line != ';') {
         char arg = *line;
         line++;
         switch (toupper(arg)) {
@@ -201,30 +250,112 @@ PyObject *GCodeParser::py_feed_line(GCodeParser *self, PyObject *args)
     /* Evaluate */
     if (argx.size > 0 && argy.size > 0 && arge.size > 0) {
         double x, y, e;
-        try {
-            x = argx.atof();
-            y = argy.atof();
-            e = arge.atof();
-        } catch (const std::invalid_argument&) {
+        if (!argx.number(x) || !argy.number(y) || !arge.number(e)) {
             // ignore invalid commands
-            Py_RETURN_NONE;
-        } catch (const std::out_of_range&) {
-            // ignore invalid commands
-            Py_RETURN_NONE;
+            return nullptr;
         }
-        if (e > 0) {
-            auto hull = self->data.currentHull.cast<Hull>();
+        /* Numbers too long for a double can't be rounded to the grid */
+        if (e > 0 && std::isfinite(x) && std::isfinite(y)) {
             hull->addPoint(Point(x, y));
         }
     }
 
+    return nullptr;
+}
+
+PyObject *GCodeParser::py_feed_line(GCodeParser *self, PyObject *args)
+{
+    const char *line;
+    if (!PyArg_ParseTuple(args, "s", &line))
+        return nullptr;
+    if (self->checkBusy())
+        return nullptr;
+
+    auto hull = self->data.currentHull.cast<Hull>();
+    if (hull && hull->checkBusy())
+        return nullptr;
+
+    auto interest = self->processLine(line, line + strlen(line), hull);
+    if (interest) {
+        return PyLong_FromLong(interest->code);
+    }
     Py_RETURN_NONE;
 }
 
+/* Scan a whole buffer line by line. Returns packed (start, end, code) int64 triples for matched lines, where end
+ * is just past the line's newline. Scanning stops after max_matches matches (if non-zero), so that python can e.g.
+ * switch the current hull and resume from the last end offset.
+ *
+ * The GIL is released while scanning, so parsers with their own hulls can scan in parallel threads. The parser and
+ * the hull are marked busy meanwhile, the buffer must not be modified by other threads. */
+PyObject *GCodeParser::py_feed_buffer(GCodeParser *self, PyObject *args, PyObject *kwds)
+{
+    static const char *names[] = {"buffer", "start", "end", "max_matches", NULL};
+    Py_buffer view;
+    Py_ssize_t start = 0;
+    Py_ssize_t end = -1;
+    Py_ssize_t max_matches = 0;
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "y*|nnn", const_cast<char**>(names),
+            &view, &start, &end, &max_matches))
+        return nullptr;
+
+    if (end < 0 || end > view.len)
+        end = view.len;
+    if (start < 0 || start > end) {
+        PyBuffer_Release(&view);
+        PyErr_SetString(PyExc_ValueError, "start offset out of range");
+        return nullptr;
+    }
+    if (self->checkBusy()) {
+        PyBuffer_Release(&view);
+        return nullptr;
+    }
+
+    /* Keep the hull alive even if another thread replaces it meanwhile */
+    PyRef hull = self->data.currentHull;
+    if (hull && hull.cast<Hull>()->checkBusy()) {
+        PyBuffer_Release(&view);
+        return nullptr;
+    }
+    self->data.busy = true;
+    if (hull)
+        hull.cast<Hull>()->data.busy = true;
+
+    const char *buf = static_cast<const char*>(view.buf);
+    std::vector<Match> matches;
+    Py_BEGIN_ALLOW_THREADS
+    const char *line = buf + start;
+    const char *buf_end = buf + end;
+    while (line < buf_end) {
+        auto newline = static_cast<const char*>(memchr(line, '\n', buf_end - line));
+        const char *line_end = newline ? newline + 1 : buf_end;
+
+        auto interest = self->processLine(line, line_end, hull.cast<Hull>());
+        if (interest) {
+            matches.push_back(Match{line - buf, line_end - buf, interest->code});
+            if (max_matches > 0 && static_cast<Py_ssize_t>(matches.size()) >= max_matches)
+                break;
+        }
+        line = line_end;
+    }
+    Py_END_ALLOW_THREADS
+
+    self->data.busy = false;
+    if (hull)
+        hull.cast<Hull>()->data.busy = false;
+    PyBuffer_Release(&view);
+
+    return PyBytes_FromStringAndSize(
+        reinterpret_cast<const char*>(matches.data()), sizeof(Match) * matches.size());
+}
+
 static PyMethodDef GCodeParser_methods[] = {
     {"feed_line", (PyCFunction) GCodeParser::py_feed_line, METH_VARARGS, 
         "Feed a line into the parser"
     },
+    {"feed_buffer", (PyCFunction) GCodeParser::py_feed_buffer, METH_VARARGS | METH_KEYWORDS,
+        "Scan a bytes-like buffer line by line. Returns matched lines as packed int64 (start, end, code) triples"
+    },
     {"register_interest", (PyCFunction) GCodeParser::py_register_interest, METH_VARARGS, 
         "Register interest in lines starting with a given string. Assign an integer code to the interest that will be returned when matched"
     },
@@ -234,6 +365,11 @@ static PyMethodDef GCodeParser_methods[] = {
     {NULL}  /* Sentinel */
 };
 
+static PyMemberDef GCodeParser_members[] = {
+    {"lines", T_ULONGLONG, offsetof(GCodeParser, data.lines), READONLY, "number of lines processed"},
+    {NULL}
+};
+
 static PyGetSetDef GCodeParser_getset[] = {
     {"hull", (getter) GCodeParser::py_get_hull, (setter) GCodeParser::py_set_hull, "current hull to feed points to"},
     {NULL}
@@ -247,6 +383,7 @@ static PyTypeObject GCodeParser_type = {
     .tp_dealloc = GCodeParser::py_dealloc,
     .tp_flags = Py_TPFLAGS_DEFAULT,
     .tp_methods = GCodeParser_methods,
+    .tp_members = GCodeParser_members,
     .tp_getset = GCodeParser_getset,
     .tp_new = GCodeParser::py_new,
 };
@@ -256,6 +393,7 @@ static struct PyModuleDef mod_gcode_parser = {
      PyModuleDef_HEAD_INIT,
     .m_name = "preprocess_cancellation_cext",
     .m_size = -1,
+    .m_methods = bgcode_methods,
 };
 
 PyMODINIT_FUNC
@@ -270,6 +408,12 @@ PyInit_preprocess_cancellation_cext(void)
     if (PyType_Ready(&Point_type) < 0)
         return nullptr;
 
+    if (PyType_Ready(&MoveTable_type) < 0)
+        return nullptr;
+
+    if (PyType_Ready(&MoveColumn_type) < 0)
+        return nullptr;
+
     PyRef m = PyRef::from_strong(PyModule_Create(&mod_gcode_parser));
     if (!m)
         return nullptr;
@@ -288,6 +432,11 @@ PyInit_preprocess_cancellation_cext(void)
 	Py_DECREF(&Point_type);
         return nullptr;
     }
+
+    if (PyModule_AddObject(m.get(), "MoveTable", reinterpret_cast<PyObject*>(&MoveTable_type)) < 0) {
+	Py_DECREF(&MoveTable_type);
+        return nullptr;
+    }
     
     return m.release();
 }
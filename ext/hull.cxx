@@ -1,41 +1,165 @@
 #include "hull.h"
 #include "pyref.h"
+#include <algorithm>
+#include <cmath>
+#include <cstdint>
 #include <limits>
 #include <structmember.h>
 
+/* Fold the pending points once there is this many of them (plus the hull size, to keep folding amortized) */
+static const size_t FOLD_THRESHOLD = 4096;
+
 PyObject *Hull::py_new(PyTypeObject *type, PyObject *args, PyObject *kwds) {
-    if (!PyArg_ParseTuple(args, ""))
+    static const char *names[] = {"raster", NULL};
+    int raster = 0;
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "|p", const_cast<char**>(names), &raster))
         return nullptr;
     PyRef self = PyRef::from_strong(type->tp_alloc(type, 0));
     if (!self)
         return nullptr;
     auto typed = self.cast<Hull>();
     new (&typed->data) HullData();
+    typed->data.raster = raster;
     return self.release();
 }
 
 void Hull::addPoint(const Point& p) {
+    data.added++;
     data.floatPointsValid = false;
+    if (data.raster) {
+        data.cells.insert(IntPoint::fromPoint(data.precision, p));
+        data.rasterFolded = false;
+        return;
+    }
     data.points.insert(IntPoint::fromPoint(data.precision, p));
+    if (data.points.size() >= FOLD_THRESHOLD + data.hull.size()) {
+        foldPoints();
+    }
+}
+
+static int64_t cross(const IntPoint& o, const IntPoint& a, const IntPoint& b) {
+    return (int64_t(a.x) - o.x) * (int64_t(b.y) - o.y) - (int64_t(a.y) - o.y) * (int64_t(b.x) - o.x);
+}
+
+/* Andrew's monotone chain */
+static std::vector<IntPoint> convexHull(std::vector<IntPoint> sorted) {
+    auto less = [](const IntPoint& a, const IntPoint& b) { return a.x < b.x || (a.x == b.x && a.y < b.y); };
+    std::sort(sorted.begin(), sorted.end(), less);
+    sorted.erase(std::unique(sorted.begin(), sorted.end()), sorted.end());
+    if (sorted.size() < 3) {
+        return sorted;
+    }
+
+    std::vector<IntPoint> hull;
+    hull.reserve(sorted.size() + 1);
+    /* lower chain */
+    for (const auto& p: sorted) {
+        while (hull.size() >= 2 && cross(hull[hull.size() - 2], hull.back(), p) <= 0)
+            hull.pop_back();
+        hull.push_back(p);
+    }
+    /* upper chain */
+    size_t lower_size = hull.size() + 1;
+    for (auto it = sorted.rbegin() + 1; it != sorted.rend(); ++it) {
+        while (hull.size() >= lower_size && cross(hull[hull.size() - 2], hull.back(), *it) <= 0)
+            hull.pop_back();
+        hull.push_back(*it);
+    }
+    /* the first point is repeated at the end */
+    hull.pop_back();
+    return hull;
+}
+
+/* Fold the pending points into the hull. Raster hulls are recomputed from the outermost cells of each row. */
+void Hull::foldPoints() {
+    if (data.raster) {
+        if (data.rasterFolded)
+            return;
+        std::vector<IntPoint> extremes;
+        for (const auto& span: data.cells.rowSpans()) {
+            extremes.emplace_back(span.xmin, span.y);
+            extremes.emplace_back(span.xmax, span.y);
+        }
+        data.hull = convexHull(std::move(extremes));
+        data.rasterFolded = true;
+        return;
+    }
+
+    if (data.points.empty()) {
+        return;
+    }
+
+    std::vector<IntPoint> sorted(data.hull);
+    sorted.insert(sorted.end(), data.points.begin(), data.points.end());
+    data.points.clear();
+    data.hull = convexHull(std::move(sorted));
+}
+
+/* Add the points of another hull, e.g. one collected from a different part of the file */
+void Hull::merge(Hull& other) {
+    other.foldPoints();
+    auto added = data.added + other.data.added;
+    if (other.data.precision == data.precision && data.raster && other.data.raster) {
+        data.floatPointsValid = false;
+        data.cells.merge(other.data.cells);
+        data.rasterFolded = false;
+    } else if (other.data.precision == data.precision && !data.raster) {
+        data.floatPointsValid = false;
+        for (const auto& p: other.data.hull) {
+            data.points.insert(p);
+        }
+        if (data.points.size() >= FOLD_THRESHOLD + data.hull.size()) {
+            foldPoints();
+        }
+    } else {
+        for (const auto& p: other.data.hull) {
+            addPoint(p.toPoint(other.data.precision));
+        }
+    }
+    data.added = added;
 }
 
 void Hull::regenPoints() {
+    foldPoints();
     if (!data.floatPointsValid) {
         data.floatPoints.clear();
-        for (const auto &p: data.points) {
+        for (const auto &p: data.hull) {
             data.floatPoints.push_back(p.toPoint(data.precision));
         }
         data.floatPointsValid = true;
     }
 }
 
+bool Hull::checkBusy() {
+    if (data.busy) {
+        PyErr_SetString(PyExc_RuntimeError, "the hull is being used by another thread");
+        return true;
+    }
+    return false;
+}
+
+/* Run work on the hull data without holding the GIL. The hull is marked busy meanwhile, so that other threads get an
+ * error instead of racing with it. */
+template<typename F>
+static bool withoutGil(Hull *self, F work) {
+    if (self->checkBusy())
+        return false;
+    self->data.busy = true;
+    Py_BEGIN_ALLOW_THREADS
+    work();
+    Py_END_ALLOW_THREADS
+    self->data.busy = false;
+    return true;
+}
+
 void Hull::py_dealloc(PyObject *self) {
     reinterpret_cast<Hull*>(self)->data.~HullData();
     Py_TYPE(self)->tp_free(self);
 }
 
 PyObject* Hull::py_get_points(Hull *self, void *closure) {
-    self->regenPoints();
+    if (!withoutGil(self, [self] { self->regenPoints(); }))
+        return nullptr;
 
     const auto& points = self->data.floatPoints;
     PyRef list = PyRef::from_strong(PyList_New(points.size()));
@@ -67,23 +191,33 @@ int Hull::py_set_points(Hull *self, PyObject *list, void *closure) {
         }
     }
 
-    self->data.floatPointsValid = false;
-    points.clear();
-    points.reserve(size);
+    std::vector<Point> newPoints;
+    newPoints.reserve(size);
     for (size_t i = 0; i < size; i++) {
-        auto p = reinterpret_cast<PyPoint*>(PyList_GetItem(list, i));
-        self->addPoint(p->point);
+        newPoints.push_back(reinterpret_cast<PyPoint*>(PyList_GetItem(list, i))->point);
     }
-    return 0;
+
+    bool done = withoutGil(self, [self, &points, &newPoints] {
+        self->data.floatPointsValid = false;
+        self->data.hull.clear();
+        self->data.cells.clear();
+        self->data.rasterFolded = true;
+        points.clear();
+        points.reserve(newPoints.size());
+        for (const auto& p: newPoints) {
+            self->addPoint(p);
+        }
+    });
+    return done ? 0 : -1;
 }
 
 PyObject* Hull::py_bounding_box(Hull *self, PyObject *args) {
-    if (self->data.points.empty()) {
+    if (!withoutGil(self, [self] { self->regenPoints(); }))
+        return nullptr;
+    if (self->data.floatPoints.empty()) {
         Py_RETURN_NONE;
     }
 
-    self->regenPoints();
-
     double xmin = std::numeric_limits<double>::infinity();
     double ymin = std::numeric_limits<double>::infinity();
     double xmax = -xmin;
@@ -105,29 +239,225 @@ PyObject* Hull::py_bounding_box(Hull *self, PyObject *args) {
     );
 }
 
+static PyObject* packPoints(const std::vector<Point>& points) {
+    return PyBytes_FromStringAndSize(reinterpret_cast<const char*>(points.data()), sizeof(Point) * points.size());
+}
+
 PyObject* Hull::py_point_bytes(Hull *self, PyObject *args) {
+    if (!withoutGil(self, [self] { self->regenPoints(); }))
+        return nullptr;
+    return packPoints(self->data.floatPoints);
+}
+
+/* The polygon algorithms below follow GEOS (as used by shapely), so that the results match */
+
+/* Closed clockwise ring starting at the lowest point (leftmost of those), like the GEOS convex hull.
+ * Hulls with less than three points are returned as they are. */
+std::vector<Point> Hull::ring() {
+    regenPoints();
+    const auto& ccw = data.floatPoints;
+    if (ccw.size() < 3) {
+        return ccw;
+    }
+
+    size_t lowest = 0;
+    for (size_t i = 1; i < ccw.size(); i++) {
+        if (ccw[i].y < ccw[lowest].y || (ccw[i].y == ccw[lowest].y && ccw[i].x < ccw[lowest].x))
+            lowest = i;
+    }
 
-    uint32_t pointsCount = self->data.points.size();
+    std::vector<Point> ring;
+    ring.reserve(ccw.size() + 1);
+    for (size_t i = 0; i <= ccw.size(); i++) {
+        ring.push_back(ccw[(lowest + ccw.size() - i) % ccw.size()]);
+    }
+    return ring;
+}
+
+/* Closed clockwise ring through the outermost cells of each row, starting at the lowest one (leftmost of those). Unlike
+ * the convex hull, it follows the concave parts of the footprint on the sides. Only raster hulls keep the cells, the
+ * ring of other hulls is the convex one. */
+std::vector<Point> Hull::outline() {
+    if (!data.raster)
+        return ring();
+
+    auto spans = data.cells.rowSpans();
+    std::vector<Point> ring;
+    ring.reserve(2 * spans.size() + 1);
+    for (const auto& span: spans)
+        ring.push_back(IntPoint(span.xmin, span.y).toPoint(data.precision));
+    for (auto it = spans.rbegin(); it != spans.rend(); ++it) {
+        if (it->xmax != it->xmin || spans.size() == 1)
+            ring.push_back(IntPoint(it->xmax, it->y).toPoint(data.precision));
+    }
+    if (!ring.empty())
+        ring.push_back(ring.front());
+    return ring;
+}
 
-    PyObject *buf = PyBytes_FromStringAndSize(NULL, 0);
-    _PyBytes_Resize(&buf, sizeof(Point) * pointsCount);
-    if (!buf)
+static double distance(const Point& a, const Point& b) {
+    double dx = a.x - b.x;
+    double dy = a.y - b.y;
+    return std::sqrt(dx * dx + dy * dy);
+}
+
+static double pointToSegment(const Point& p, const Point& a, const Point& b) {
+    if (a.x == b.x && a.y == b.y)
+        return distance(p, a);
+    double len2 = (b.x - a.x) * (b.x - a.x) + (b.y - a.y) * (b.y - a.y);
+    double r = ((p.x - a.x) * (b.x - a.x) + (p.y - a.y) * (b.y - a.y)) / len2;
+    if (r <= 0.0)
+        return distance(p, a);
+    if (r >= 1.0)
+        return distance(p, b);
+    double s = ((a.y - p.y) * (b.x - a.x) - (a.x - p.x) * (b.y - a.y)) / len2;
+    return std::fabs(s) * std::sqrt(len2);
+}
+
+static void simplifySection(const std::vector<Point>& pts, std::vector<bool>& use, size_t i, size_t j, double tolerance) {
+    if (i + 1 >= j)
+        return;
+    double maxDistance = -1.0;
+    size_t maxIndex = i;
+    for (size_t k = i + 1; k < j; k++) {
+        double d = pointToSegment(pts[k], pts[i], pts[j]);
+        if (d > maxDistance) {
+            maxDistance = d;
+            maxIndex = k;
+        }
+    }
+    if (maxDistance <= tolerance) {
+        for (size_t k = i + 1; k < j; k++)
+            use[k] = false;
+    } else {
+        simplifySection(pts, use, i, maxIndex, tolerance);
+        simplifySection(pts, use, maxIndex, j, tolerance);
+    }
+}
+
+/* Douglas-Peucker, including the simplification of the ring endpoint */
+static std::vector<Point> simplifyRing(const std::vector<Point>& ring, double tolerance) {
+    if (ring.size() < 4)
+        return ring;
+
+    std::vector<bool> use(ring.size(), true);
+    simplifySection(ring, use, 0, ring.size() - 1, tolerance);
+    std::vector<Point> simplified;
+    for (size_t i = 0; i < ring.size(); i++) {
+        if (use[i])
+            simplified.push_back(ring[i]);
+    }
+
+    if (simplified.size() >= 4
+            && pointToSegment(simplified[0], simplified[1], simplified[simplified.size() - 2]) <= tolerance) {
+        simplified.erase(simplified.begin());
+        simplified.back() = simplified.front();
+    }
+    return simplified;
+}
+
+/* Area centroid, computed from triangles fanning out of the first point */
+static Point ringCentroid(const std::vector<Point>& ring) {
+    if (ring.size() < 4) {
+        Point sum(0, 0);
+        for (const auto& p: ring) {
+            sum.x += p.x / ring.size();
+            sum.y += p.y / ring.size();
+        }
+        return sum;
+    }
+
+    const Point& base = ring[0];
+    double cx = 0, cy = 0, areasum2 = 0;
+    for (size_t i = 0; i + 1 < ring.size(); i++) {
+        const Point& p1 = ring[i];
+        const Point& p2 = ring[i + 1];
+        /* clockwise rings have positive area */
+        double a2 = -((p1.x - base.x) * (p2.y - base.y) - (p2.x - base.x) * (p1.y - base.y));
+        cx += a2 * (base.x + p1.x + p2.x);
+        cy += a2 * (base.y + p1.y + p2.y);
+        areasum2 += a2;
+    }
+    return Point(cx / 3 / areasum2, cy / 3 / areasum2);
+}
+
+PyObject* Hull::py_convex_hull(Hull *self, PyObject *args) {
+    std::vector<Point> ring;
+    if (!withoutGil(self, [self, &ring] { ring = self->ring(); }))
+        return nullptr;
+    return packPoints(ring);
+}
+
+PyObject* Hull::py_simplify(Hull *self, PyObject *args) {
+    double tolerance;
+    if (!PyArg_ParseTuple(args, "d", &tolerance))
         return nullptr;
-        
-    Py_buffer buf_view;
-    if (PyObject_GetBuffer(buf, &buf_view, 0) < 0)
+    std::vector<Point> ring;
+    if (!withoutGil(self, [self, &ring, tolerance] { ring = simplifyRing(self->ring(), tolerance); }))
         return nullptr;
+    return packPoints(ring);
+}
+
+PyObject* Hull::py_centroid(Hull *self, PyObject *args) {
+    double tolerance = 0;
+    if (!PyArg_ParseTuple(args, "|d", &tolerance))
+        return nullptr;
+    std::vector<Point> ring;
+    Point center(0, 0);
+    bool done = withoutGil(self, [self, &ring, &center, tolerance] {
+        ring = simplifyRing(self->ring(), tolerance);
+        if (!ring.empty())
+            center = ringCentroid(ring);
+    });
+    if (!done)
+        return nullptr;
+    if (ring.empty()) {
+        Py_RETURN_NONE;
+    }
+    PyRef p(PyRef::from_strong(_PyObject_New(&Point_type)));
+    if (!p)
+        return nullptr;
+    p.cast<PyPoint>()->point = center;
+    return p.release();
+}
+
+
+PyObject* Hull::py_outline(Hull *self, PyObject *args) {
+    double tolerance = 0;
+    if (!PyArg_ParseTuple(args, "|d", &tolerance))
+        return nullptr;
+    std::vector<Point> ring;
+    if (!withoutGil(self, [self, &ring, tolerance] { ring = simplifyRing(self->outline(), tolerance); }))
+        return nullptr;
+    return packPoints(ring);
+}
 
-    self->regenPoints();
-    memcpy(buf_view.buf, self->data.floatPoints.data(), sizeof(Point) * pointsCount);
+PyObject* Hull::py_get_cells(Hull *self, void *closure) {
+    if (self->checkBusy())
+        return nullptr;
+    return PyLong_FromSize_t(self->data.cells.cells());
+}
 
-    PyBuffer_Release(&buf_view);
-    return buf;
+PyObject* Hull::py_merge(Hull *self, PyObject *args) {
+    Hull *other;
+    if (!PyArg_ParseTuple(args, "O!", &Hull_type, &other))
+        return nullptr;
+    if (other == self)
+        Py_RETURN_NONE;
+    if (other->checkBusy())
+        return nullptr;
+    other->data.busy = true;
+    bool done = withoutGil(self, [self, other] { self->merge(*other); });
+    other->data.busy = false;
+    if (!done)
+        return nullptr;
+    Py_RETURN_NONE;
 }
 
 
 static PyGetSetDef Hull_getset[] = {
-    {"points", (getter) Hull::py_get_points, (setter) Hull::py_set_points, "list of collected points for hull calculation"},
+    {"points", (getter) Hull::py_get_points, (setter) Hull::py_set_points, "list of collected points on the convex hull"},
+    {"cells", (getter) Hull::py_get_cells, nullptr, "number of occupied grid cells of a raster hull"},
     {NULL}
 };
 
@@ -138,11 +468,29 @@ static PyMethodDef Hull_methods[] = {
     {"point_bytes", (PyCFunction) Hull::py_point_bytes, METH_NOARGS,
         "Packed points"
     },
+    {"convex_hull", (PyCFunction) Hull::py_convex_hull, METH_NOARGS,
+        "Packed points of the convex hull as a closed clockwise ring"
+    },
+    {"simplify", (PyCFunction) Hull::py_simplify, METH_VARARGS,
+        "Packed points of the convex hull ring simplified with the given tolerance"
+    },
+    {"centroid", (PyCFunction) Hull::py_centroid, METH_VARARGS,
+        "Centroid of the convex hull, optionally simplified with the given tolerance"
+    },
+    {"merge", (PyCFunction) Hull::py_merge, METH_VARARGS,
+        "Add the points of another hull"
+    },
+    {"outline", (PyCFunction) Hull::py_outline, METH_VARARGS,
+        "Packed points of the row outline of a raster hull (the convex hull otherwise) as a closed clockwise ring, "
+        "optionally simplified with the given tolerance"
+    },
     {NULL}
 };
 
 static PyMemberDef Hull_members[] = {
     {"precision", T_DOUBLE, offsetof(Hull, data.precision), 0, "point rounding and merging"},
+    {"points_added", T_ULONGLONG, offsetof(Hull, data.added), 0, "number of points added to the hull"},
+    {"raster", T_BOOL, offsetof(Hull, data.raster), READONLY, "points are kept as grid cells"},
     {NULL} 
 };
 
@@ -6,13 +6,29 @@
 #include <vector>
 #include <unordered_set>
 #include "point.h"
+#include "raster.h"
 
 
+/* Points are collected into a set and folded into their convex hull once the set grows too large, so memory is
+ * proportional to the hull size, not to the number of extrusions. Raster hulls mark the points in a grid instead,
+ * which keeps the footprint for concave outlines, and the hull is computed from the row extents. */
 struct HullData {
-    HullData(): floatPointsValid(false), precision(1) {}
+    HullData(): floatPointsValid(false), busy(false), raster(false), rasterFolded(true), precision(1), added(0) {}
     bool floatPointsValid;
+    /* Some thread is working on the hull without the GIL */
+    bool busy;
+    /* Points go to cells instead of points */
+    bool raster;
+    /* The hull includes all the cells */
+    bool rasterFolded;
     double precision;
+    /* Number of points added, including those that did not end up on the hull */
+    unsigned long long added;
+    /* Points not yet folded into the hull */
     std::unordered_set<IntPoint> points;
+    Raster cells;
+    /* Convex hull of the folded points, counter-clockwise without collinear points */
+    std::vector<IntPoint> hull;
     std::vector<Point> floatPoints;
 };
 
@@ -22,7 +38,12 @@ struct Hull {
     HullData data;
 
     void addPoint(const Point& p);
+    void foldPoints();
+    void merge(Hull& other);
     void regenPoints();
+    std::vector<Point> ring();
+    std::vector<Point> outline();
+    bool checkBusy();
 
     static PyObject *py_new(PyTypeObject *type, PyObject *args, PyObject *kwds);
     static void py_dealloc(PyObject *self);
@@ -32,6 +53,12 @@ struct Hull {
 
     static PyObject *py_bounding_box(Hull *self, PyObject *args);
     static PyObject *py_point_bytes(Hull *self, PyObject *args);
+    static PyObject *py_convex_hull(Hull *self, PyObject *args);
+    static PyObject *py_simplify(Hull *self, PyObject *args);
+    static PyObject *py_centroid(Hull *self, PyObject *args);
+    static PyObject *py_merge(Hull *self, PyObject *args);
+    static PyObject *py_outline(Hull *self, PyObject *args);
+    static PyObject *py_get_cells(Hull *self, void *closure);
 };
 
 extern PyTypeObject Hull_type;
\ No newline at end of file
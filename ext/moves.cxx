@@ -0,0 +1,301 @@
+#include "moves.h"
+#include "number.h"
+#include "pyref.h"
+#include <algorithm>
+#include <cmath>
+#include <cstdlib>
+#include <string>
+
+/* Make room for the moves expected in the buffer, keeping the growth geometric over many small scans */
+template<typename T>
+static void reserveColumn(std::vector<T>& column, size_t expected) {
+    size_t needed = column.size() + expected;
+    if (needed > column.capacity())
+        column.reserve(std::max(needed, 2 * column.capacity()));
+}
+
+/* Slicers write about 25 bytes per move */
+static const size_t BYTES_PER_MOVE = 25;
+
+void MoveTableData::scan(const char *line, const char *end, int32_t objectId) {
+    size_t expected = (end - line) / BYTES_PER_MOVE;
+    reserveColumn(this->line, expected);
+    reserveColumn(command, expected);
+    reserveColumn(xs, expected);
+    reserveColumn(ys, expected);
+    reserveColumn(zs, expected);
+    reserveColumn(es, expected);
+    reserveColumn(fs, expected);
+    reserveColumn(object, expected);
+
+    while (line < end) {
+        auto newline = static_cast<const char*>(memchr(line, '\n', end - line));
+        const char *line_end = newline ? newline : end;
+        int64_t index = lines++;
+
+        const char *p = line;
+        line = newline ? newline + 1 : end;
+
+        while (p < line_end && (*p == ' ' || *p == '\t' || *p == '\r'))
+            p++;
+        if (p == line_end || (*p != 'G' && *p != 'g'))
+            continue;
+        p++;
+
+        int cmd = 0;
+        const char *digits = p;
+        while (p < line_end && *p >= '0' && *p <= '9')
+            cmd = cmd * 10 + (*p++ - '0');
+        if (p == digits || cmd > 3 || (p < line_end && *p == '.'))
+            continue;
+
+        double e = NAN;
+        while (p < line_end && *p != ';') {
+            double value;
+            /* ASCII upper case, faster than the locale aware toupper */
+            switch (*p++ & ~0x20) {
+                case 'X':
+                    if (parseNumber(p, line_end, value)) x = value;
+                    break;
+                case 'Y':
+                    if (parseNumber(p, line_end, value)) y = value;
+                    break;
+                case 'Z':
+                    if (parseNumber(p, line_end, value)) z = value;
+                    break;
+                case 'E':
+                    if (parseNumber(p, line_end, value)) e = value;
+                    break;
+                case 'F':
+                    if (parseNumber(p, line_end, value)) f = value;
+                    break;
+            }
+        }
+
+        this->line.push_back(index);
+        command.push_back(cmd);
+        xs.push_back(x);
+        ys.push_back(y);
+        zs.push_back(z);
+        es.push_back(e);
+        fs.push_back(f);
+        object.push_back(objectId);
+    }
+}
+
+PyObject *MoveTable::py_new(PyTypeObject *type, PyObject *args, PyObject *kwds) {
+    if (!PyArg_ParseTuple(args, ""))
+        return nullptr;
+    PyRef self = PyRef::from_strong(type->tp_alloc(type, 0));
+    if (!self)
+        return nullptr;
+    auto typed = self.cast<MoveTable>();
+    new (&typed->data) MoveTableData();
+    return self.release();
+}
+
+void MoveTable::py_dealloc(PyObject *self) {
+    reinterpret_cast<MoveTable*>(self)->data.~MoveTableData();
+    Py_TYPE(self)->tp_free(self);
+}
+
+Py_ssize_t MoveTable::py_len(MoveTable *self) {
+    return self->data.line.size();
+}
+
+/* Scan the lines in buffer[start:end] and append their moves, belonging to object_id. Lines are numbered
+ * continuously over all scanned buffers. The GIL is released while scanning. */
+PyObject *MoveTable::py_scan(MoveTable *self, PyObject *args, PyObject *kwds) {
+    static const char *names[] = {"buffer", "start", "end", "object_id", NULL};
+    Py_buffer view;
+    Py_ssize_t start = 0;
+    Py_ssize_t end = -1;
+    int object_id = -1;
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "y*|nni", const_cast<char**>(names),
+            &view, &start, &end, &object_id))
+        return nullptr;
+
+    if (end < 0 || end > view.len)
+        end = view.len;
+    if (start < 0 || start > end) {
+        PyBuffer_Release(&view);
+        PyErr_SetString(PyExc_ValueError, "start offset out of range");
+        return nullptr;
+    }
+    if (self->data.busy) {
+        PyBuffer_Release(&view);
+        PyErr_SetString(PyExc_RuntimeError, "the move table is being used by another thread");
+        return nullptr;
+    }
+    if (self->data.exports > 0) {
+        PyBuffer_Release(&view);
+        PyErr_SetString(PyExc_BufferError, "cannot scan into the table while its columns are exported");
+        return nullptr;
+    }
+
+    const char *buf = static_cast<const char*>(view.buf);
+    self->data.busy = true;
+    Py_BEGIN_ALLOW_THREADS
+    self->data.scan(buf + start, buf + end, object_id);
+    Py_END_ALLOW_THREADS
+    self->data.busy = false;
+    PyBuffer_Release(&view);
+    Py_RETURN_NONE;
+}
+
+PyObject *MoveTable::py_get_lines(MoveTable *self, void *closure) {
+    return PyLong_FromLongLong(self->data.lines);
+}
+
+/* A single column of a move table, exporting the column data through the buffer protocol */
+struct MoveColumn {
+    PyObject_HEAD
+
+    PyRef table;
+    int index;
+    Py_ssize_t shape;
+};
+
+struct ColumnInfo {
+    const char *name;
+    const char *format;
+};
+
+static const ColumnInfo COLUMNS[] = {
+    {"line", "q"},
+    {"command", "i"},
+    {"x", "d"},
+    {"y", "d"},
+    {"z", "d"},
+    {"e", "d"},
+    {"f", "d"},
+    {"object", "i"},
+};
+
+template<typename T>
+static void *columnData(std::vector<T>& column, Py_ssize_t& itemsize) {
+    static T empty;
+    itemsize = sizeof(T);
+    return column.empty() ? &empty : column.data();
+}
+
+static void *columnData(MoveTableData& data, int index, Py_ssize_t& itemsize) {
+    switch (index) {
+        case 0: return columnData(data.line, itemsize);
+        case 1: return columnData(data.command, itemsize);
+        case 2: return columnData(data.xs, itemsize);
+        case 3: return columnData(data.ys, itemsize);
+        case 4: return columnData(data.zs, itemsize);
+        case 5: return columnData(data.es, itemsize);
+        case 6: return columnData(data.fs, itemsize);
+        default: return columnData(data.object, itemsize);
+    }
+}
+
+static void MoveColumn_dealloc(PyObject *self) {
+    reinterpret_cast<MoveColumn*>(self)->table.~PyRef();
+    Py_TYPE(self)->tp_free(self);
+}
+
+static int MoveColumn_getbuffer(PyObject *obj, Py_buffer *view, int flags) {
+    auto self = reinterpret_cast<MoveColumn*>(obj);
+    if (flags & PyBUF_WRITABLE) {
+        PyErr_SetString(PyExc_BufferError, "move table columns are read-only");
+        view->obj = nullptr;
+        return -1;
+    }
+
+    auto& data = self->table.cast<MoveTable>()->data;
+    if (data.busy) {
+        PyErr_SetString(PyExc_BufferError, "the move table is being scanned by another thread");
+        view->obj = nullptr;
+        return -1;
+    }
+    self->shape = data.line.size();
+    data.exports++;
+
+    view->obj = obj;
+    Py_INCREF(obj);
+    view->buf = columnData(data, self->index, view->itemsize);
+    view->len = self->shape * view->itemsize;
+    view->readonly = 1;
+    view->format = (flags & PyBUF_FORMAT) ? const_cast<char*>(COLUMNS[self->index].format) : nullptr;
+    view->ndim = 1;
+    view->shape = (flags & PyBUF_ND) ? &self->shape : nullptr;
+    view->strides = (flags & PyBUF_STRIDES) == PyBUF_STRIDES ? &view->itemsize : nullptr;
+    view->suboffsets = nullptr;
+    view->internal = nullptr;
+    return 0;
+}
+
+static void MoveColumn_releasebuffer(PyObject *obj, Py_buffer *view) {
+    reinterpret_cast<MoveColumn*>(obj)->table.cast<MoveTable>()->data.exports--;
+}
+
+static PyBufferProcs MoveColumn_buffer = {
+    .bf_getbuffer = MoveColumn_getbuffer,
+    .bf_releasebuffer = MoveColumn_releasebuffer,
+};
+
+PyTypeObject MoveColumn_type = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    .tp_name = "MoveColumn",
+    .tp_basicsize = sizeof(MoveColumn),
+    .tp_itemsize = 0,
+    .tp_dealloc = MoveColumn_dealloc,
+    .tp_as_buffer = &MoveColumn_buffer,
+    .tp_flags = Py_TPFLAGS_DEFAULT,
+};
+
+PyObject *MoveTable::py_column(MoveTable *self, PyObject *args) {
+    const char *name;
+    if (!PyArg_ParseTuple(args, "s", &name))
+        return nullptr;
+
+    for (size_t i = 0; i < sizeof(COLUMNS) / sizeof(COLUMNS[0]); i++) {
+        if (strcmp(COLUMNS[i].name, name) == 0) {
+            PyRef column = PyRef::from_strong(MoveColumn_type.tp_alloc(&MoveColumn_type, 0));
+            if (!column)
+                return nullptr;
+            auto typed = column.cast<MoveColumn>();
+            new (&typed->table) PyRef(PyRef::from_borrowed(reinterpret_cast<PyObject*>(self)));
+            typed->index = i;
+            typed->shape = 0;
+            return column.release();
+        }
+    }
+    PyErr_Format(PyExc_KeyError, "unknown move table column \"%s\"", name);
+    return nullptr;
+}
+
+static PyMethodDef MoveTable_methods[] = {
+    {"scan", (PyCFunction) MoveTable::py_scan, METH_VARARGS | METH_KEYWORDS,
+        "Append the moves in a bytes-like buffer, optionally limited to buffer[start:end], for the given object id"
+    },
+    {"column", (PyCFunction) MoveTable::py_column, METH_VARARGS,
+        "Column by name (line, command, x, y, z, e, f or object), supporting the buffer protocol"
+    },
+    {NULL}
+};
+
+static PyGetSetDef MoveTable_getset[] = {
+    {"lines", (getter) MoveTable::py_get_lines, nullptr, "number of lines scanned"},
+    {NULL}
+};
+
+static PySequenceMethods MoveTable_sequence = {
+    .sq_length = (lenfunc) MoveTable::py_len,
+};
+
+PyTypeObject MoveTable_type = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    .tp_name = "MoveTable",
+    .tp_basicsize = sizeof(MoveTable),
+    .tp_itemsize = 0,
+    .tp_dealloc = MoveTable::py_dealloc,
+    .tp_as_sequence = &MoveTable_sequence,
+    .tp_flags = Py_TPFLAGS_DEFAULT,
+    .tp_methods = MoveTable_methods,
+    .tp_getset = MoveTable_getset,
+    .tp_new = MoveTable::py_new,
+};
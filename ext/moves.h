@@ -0,0 +1,47 @@
+#pragma once
+
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+
+#include <cmath>
+#include <cstdint>
+#include <vector>
+
+/* Moves (G0-G3) extracted from G-code, one column per field. The X, Y, Z and F columns hold the position and feed rate
+ * after the move (NaN until first set). E is the value written in the line (NaN without E), as extrusion may be
+ * relative or absolute. */
+struct MoveTableData {
+    MoveTableData(): lines(0), x(NAN), y(NAN), z(NAN), f(NAN), exports(0), busy(false) {}
+    std::vector<int64_t> line;
+    std::vector<int32_t> command;
+    std::vector<double> xs, ys, zs, es, fs;
+    std::vector<int32_t> object;
+
+    /* Number of lines scanned so far, the next line gets this index */
+    int64_t lines;
+    /* Current position and feed rate */
+    double x, y, z, f;
+    /* Number of buffers exported from the columns, the columns must not be reallocated while there are any */
+    Py_ssize_t exports;
+    /* scan is running without the GIL */
+    bool busy;
+
+    void scan(const char *line, const char *end, int32_t objectId);
+};
+
+struct MoveTable {
+    PyObject_HEAD
+
+    MoveTableData data;
+
+    static PyObject *py_new(PyTypeObject *type, PyObject *args, PyObject *kwds);
+    static void py_dealloc(PyObject *self);
+    static Py_ssize_t py_len(MoveTable *self);
+
+    static PyObject *py_scan(MoveTable *self, PyObject *args, PyObject *kwds);
+    static PyObject *py_column(MoveTable *self, PyObject *args);
+    static PyObject *py_get_lines(MoveTable *self, void *closure);
+};
+
+extern PyTypeObject MoveTable_type;
+extern PyTypeObject MoveColumn_type;
@@ -0,0 +1,54 @@
+#pragma once
+
+#include <cstdint>
+#include <cstdlib>
+#include <string>
+
+/* Exact powers of ten, a double division by them is correctly rounded */
+static const double POW10[] = {
+    1e0, 1e1, 1e2, 1e3, 1e4, 1e5, 1e6, 1e7, 1e8, 1e9, 1e10, 1e11,
+    1e12, 1e13, 1e14, 1e15, 1e16, 1e17, 1e18, 1e19, 1e20, 1e21, 1e22,
+};
+
+/* Parse a decimal number without exponent (E is an axis in G-code). Numbers with up to 15 significant digits (all
+ * that slicers write) take the fast path, longer ones go through strtod. Returns false if there is no number. */
+inline bool parseNumber(const char *&p, const char *end, double &out) {
+    const char *start = p;
+    bool negative = false;
+    if (p < end && (*p == '-' || *p == '+')) {
+        negative = *p == '-';
+        p++;
+    }
+
+    uint64_t mantissa = 0;
+    int significant = 0;
+    int fraction = 0;
+    bool any = false;
+    bool dot = false;
+    for (; p < end; p++) {
+        if (*p >= '0' && *p <= '9') {
+            any = true;
+            if (mantissa > 0 || *p != '0')
+                significant++;
+            mantissa = mantissa * 10 + (*p - '0');
+            if (dot)
+                fraction++;
+        } else if (*p == '.' && !dot) {
+            dot = true;
+        } else {
+            break;
+        }
+    }
+    if (!any)
+        return false;
+
+    if (significant <= 15 && fraction <= 22) {
+        out = static_cast<double>(mantissa) / POW10[fraction];
+    } else {
+        out = std::strtod(std::string(start, p).c_str(), nullptr);
+        negative = false;
+    }
+    if (negative)
+        out = -out;
+    return true;
+}
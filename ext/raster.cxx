@@ -0,0 +1,70 @@
+#include "raster.h"
+#include <algorithm>
+#include <cstring>
+
+size_t Raster::tileIndex(uint64_t key) {
+    auto found = index.find(key);
+    if (found != index.end())
+        return found->second;
+
+    Tile tile;
+    tile.x = static_cast<int32_t>(key >> 32);
+    tile.y = static_cast<int32_t>(key & 0xffffffff);
+    memset(tile.rows, 0, sizeof(tile.rows));
+    tiles.push_back(tile);
+    index.emplace(key, tiles.size() - 1);
+    return tiles.size() - 1;
+}
+
+void Raster::merge(const Raster& other) {
+    for (const auto& tile: other.tiles) {
+        auto& target = tiles[tileIndex(tileKey(tile.x, tile.y))];
+        for (int row = 0; row <= TILE_MASK; row++)
+            target.rows[row] |= tile.rows[row];
+    }
+}
+
+void Raster::clear() {
+    tiles.clear();
+    index.clear();
+    lastIndex = NONE;
+}
+
+std::vector<Raster::RowSpan> Raster::rowSpans() const {
+    std::vector<RowSpan> spans;
+    for (const auto& tile: tiles) {
+        for (int row = 0; row <= TILE_MASK; row++) {
+            uint64_t bits = tile.rows[row];
+            if (!bits)
+                continue;
+            int base = tile.x << TILE_BITS;
+            spans.push_back({
+                (tile.y << TILE_BITS) + row,
+                base + __builtin_ctzll(bits),
+                base + TILE_MASK - __builtin_clzll(bits),
+            });
+        }
+    }
+
+    /* Join the spans of the same row from different tiles */
+    std::sort(spans.begin(), spans.end(), [](const RowSpan& a, const RowSpan& b) { return a.y < b.y; });
+    std::vector<RowSpan> joined;
+    for (const auto& span: spans) {
+        if (!joined.empty() && joined.back().y == span.y) {
+            joined.back().xmin = std::min(joined.back().xmin, span.xmin);
+            joined.back().xmax = std::max(joined.back().xmax, span.xmax);
+        } else {
+            joined.push_back(span);
+        }
+    }
+    return joined;
+}
+
+size_t Raster::cells() const {
+    size_t count = 0;
+    for (const auto& tile: tiles) {
+        for (int row = 0; row <= TILE_MASK; row++)
+            count += __builtin_popcountll(tile.rows[row]);
+    }
+    return count;
+}
@@ -0,0 +1,71 @@
+#pragma once
+
+#include <cstdint>
+#include <unordered_map>
+#include <vector>
+#include "point.h"
+
+/* Occupied cells of the integer point grid, stored as a sparse set of 64x64 bit tiles. Inserting a point only sets a
+ * bit (allocating a 512 byte tile the first time its area is touched), so memory is bounded by the printed area. */
+class Raster {
+    public:
+        /* Extent of the occupied cells in one grid row */
+        struct RowSpan {
+            int y, xmin, xmax;
+        };
+
+        Raster(): lastIndex(NONE), lastKey(0) {}
+
+        void insert(const IntPoint& p) {
+            uint64_t key = tileKey(p.x >> TILE_BITS, p.y >> TILE_BITS);
+            if (lastIndex == NONE || key != lastKey) {
+                lastIndex = tileIndex(key);
+                lastKey = key;
+            }
+            tiles[lastIndex].rows[p.y & TILE_MASK] |= uint64_t(1) << (p.x & TILE_MASK);
+        }
+
+        /* Add all the cells of another raster */
+        void merge(const Raster& other);
+        void clear();
+
+        bool empty() const {
+            return tiles.empty();
+        }
+
+        /* Occupied extent of each non-empty row, sorted by y */
+        std::vector<RowSpan> rowSpans() const;
+        /* Number of occupied cells */
+        size_t cells() const;
+
+    private:
+        static const int TILE_BITS = 6;
+        static const int TILE_MASK = (1 << TILE_BITS) - 1;
+        static const size_t NONE = SIZE_MAX;
+
+        struct Tile {
+            int x, y;
+            uint64_t rows[1 << TILE_BITS];
+        };
+
+        /* Final mix of splitmix64, tile keys are regular grid coordinates */
+        struct KeyHash {
+            size_t operator()(uint64_t z) const {
+                z = (z ^ (z >> 30)) * 0xbf58476d1ce4e5b9ULL;
+                z = (z ^ (z >> 27)) * 0x94d049bb133111ebULL;
+                return z ^ (z >> 31);
+            }
+        };
+
+        static uint64_t tileKey(int x, int y) {
+            return (uint64_t(uint32_t(x)) << 32) | uint32_t(y);
+        }
+
+        size_t tileIndex(uint64_t key);
+
+        std::vector<Tile> tiles;
+        std::unordered_map<uint64_t, size_t, KeyHash> index;
+        /* Points come in runs close to each other, remember the last tile */
+        size_t lastIndex;
+        uint64_t lastKey;
+};
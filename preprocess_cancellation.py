@@ -1,33 +1,79 @@
 #!/usr/bin/env python3
 from __future__ import annotations
 
-import argparse
-import json
+# Modules needed only by some of the features are imported where they are used, to keep the startup fast
+import codecs
+import contextlib
+import errno
+import importlib
+import io
+import itertools
 import logging
+import os
 import pathlib
 import re
-import shutil
-import enum
+import struct
 import sys
-import tempfile
+import time
+import zlib
 from typing import Dict, List, NamedTuple, Optional, Set, Tuple, TypeVar
-from preprocess_cancellation_cext import Hull, Point, GCodeParser
+
+try:
+    from preprocess_cancellation_cext import (
+        Hull,
+        Point,
+        GCodeParser,
+        MoveTable,
+        heatshrink_decode,
+        heatshrink_encode,
+        meatpack_decode,
+        meatpack_encode,
+    )
+
+    native_engine = True
+except ImportError:
+    # Not built for this platform, the pure-Python engine gives the same results (several times slower)
+    from preprocess_cancellation_pyext import (
+        Hull,
+        Point,
+        GCodeParser,
+        MoveTable,
+        heatshrink_decode,
+        heatshrink_encode,
+        meatpack_decode,
+        meatpack_encode,
+    )
+
+    native_engine = False
+
+import preprocess_cancellation_bgcode as bgcode
 
 __version__ = "0.2.0"
 
 
-logging.basicConfig(stream=sys.stderr, level=logging.INFO)
 logger = logging.getLogger("prepropress_cancellation")
 precision = 0.5
-
+# Files are scanned in blocks of this many bytes, cut at line boundaries
+block_size = 1 << 20
+# Space reserved for object definitions when processing in a single pass
+header_reserve = 32 * 1024
+# Bytes read from the head and from the tail of the file to identify the slicer, not counting thumbnails
+sniff_bytes = 64 * 1024
+# Threads scanning chunks of a single (large enough) file in parallel
+scan_threads = 1
+# Directory caching the scan results by input content, None to disable
+cache_dir: Optional[pathlib.Path] = None
+# The least recently used cache entries are evicted above this total size
+cache_size = 64 << 20
+# Collect the points of objects in occupancy rasters instead of point sets (same hulls, bounded memory)
+raster_hulls = False
+# Hull polygons are simplified with this tolerance (in mm)
+simplify_tolerance = 0.02
+# Compare the native hull polygons with shapely (if available) and warn about differences
+shapely_cross_check = False
+# The shapely module, imported by _import_shapely when first needed. False if it is not available or disabled.
 shapely = None
-try:
-    import shapely.geometry
-    import numpy
-except ImportError:
-    logger.info("Shapely not found, complex hulls disabled")
-except OSError:
-    logger.exception("Failed to import shapely. Are you missing libgeos?")
+numpy = None
 
 HEADER_MARKER = f"; Pre-Processed for Cancel-Object support by preprocess_cancellation v{__version__}\n"
 
@@ -37,10 +83,25 @@ class KnownObject(NamedTuple):
     name: str
     hull: Hull
 
+
+def _new_hull() -> Hull:
+    hull = Hull(raster=raster_hulls)
+    hull.precision = precision
+    return hull
+
 def _clean_id(id):
     return re.sub(r"\W+", "_", id).strip("_")
 
 
+# GCode is processed as bytes, only the interesting lines are ever decoded. Undecodable bytes survive the roundtrip.
+def _decode(data: bytes) -> str:
+    return data.decode("utf-8", "surrogateescape")
+
+
+def _encode(text: str) -> bytes:
+    return text.encode("utf-8", "surrogateescape")
+
+
 def parse_gcode(line):
     # drop comments
     line = line.split(";", maxsplit=1)[0]
@@ -83,19 +144,195 @@ def object_start_marker(object_name):
 def object_end_marker(object_name):
     yield f"EXCLUDE_OBJECT_END NAME={object_name}\n"
 
+
+# Hull returns polygons as packed (x, y) doubles
+_POINT = struct.Struct("=dd")
+
+
+def _unpack_points(packed) -> List[Point]:
+    return [Point(x, y) for x, y in _POINT.iter_unpack(packed)]
+
+
+def _import_shapely():
+    """Returns shapely, importing it (and numpy) on the first call, or False if that fails"""
+    global shapely, numpy
+    if shapely is None:
+        try:
+            import numpy
+            import shapely.geometry
+        except ImportError:
+            logger.debug("Shapely not found, hulls will not be cross-checked")
+            shapely = False
+        except OSError:
+            logger.exception("Failed to import shapely. Are you missing libgeos?")
+            shapely = False
+    return shapely
+
+
+def _shapely_hull_bounds(hull):
+    """Reference implementation of the native hull polygon"""
+    _import_shapely()
+    points_array = numpy.frombuffer(hull.point_bytes())
+    points_array.shape = (points_array.size // 2, 2)
+    points = shapely.MultiPoint(points_array)
+    polygon = points.convex_hull.simplify(simplify_tolerance, preserve_topology=False)
+    center = polygon.centroid
+    return Point(center.x, center.y), [Point(x, y) for x, y in polygon.exterior.coords]
+
+
+def _check_hull_bounds(hull, center, polygon):
+    expected_center, expected_polygon = _shapely_hull_bounds(hull)
+
+    def close(a, b):
+        return abs(a.x - b.x) < 0.001 and abs(a.y - b.y) < 0.001
+
+    if (
+        not close(center, expected_center)
+        or len(polygon) != len(expected_polygon)
+        or not all(map(close, polygon, expected_polygon))
+    ):
+        logger.warning(
+            "Hull polygon differs from shapely, got %s expected %s",
+            [(p.x, p.y) for p in polygon],
+            [(p.x, p.y) for p in expected_polygon],
+        )
+
+
+# Placeholder for the object definitions in single pass output, they are written once all objects are known
+_RESERVED_HEADER = object()
+
+
+def _header_padding(size):
+    """Comment lines filling exactly size bytes"""
+    line = b";" + b" " * 78 + b"\n"
+    lines, rest = divmod(size, len(line))
+    padding = line * lines
+    if rest == 1:
+        padding += b"\n"
+    elif rest > 1:
+        padding += b";" + b" " * (rest - 2) + b"\n"
+    return padding
+
+class _NoStats:
+    """Stats collection when disabled, all methods do nothing"""
+    enabled = False
+    _no_stage = contextlib.nullcontext()
+
+    def stage(self, name):
+        return self._no_stage
+
+    def hit(self, stage, line):
+        pass
+
+    def count_lines(self, parser):
+        pass
+
+    def add_slicer(self, slicer):
+        pass
+
+
+_NO_STATS = _NoStats()
+
+
+class Stats(_NoStats):
+    """Statistics of processing a file (pass one to process_file_for_cancellation), stage times accumulate"""
+    enabled = True
+
+    def __init__(self):
+        self.file: Optional[str] = None
+        self.result: Optional[bool] = None
+        self.stages: Dict[str, Dict[str, float]] = {}
+        # Size of the input file (left at 0 by preprocessor), and of the G-code it decodes to
+        self.input_bytes = 0
+        self.decoded_bytes = 0
+        self.output_bytes = 0
+        self.lines = 0
+        # Matched marker lines, by stage and interest
+        self.interest_hits: Dict[str, int] = {}
+        # Points added and vertices of the hull, by object
+        self.objects: Dict[str, Dict[str, int]] = {}
+        self.peak_rss: Optional[int] = None
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield
+        finally:
+            stage = self.stages.setdefault(name, {"wall": 0.0, "cpu": 0.0})
+            stage["wall"] += time.perf_counter() - wall
+            stage["cpu"] += time.process_time() - cpu
+
+    def hit(self, stage, line):
+        key = f"{stage}: {line}"
+        self.interest_hits[key] = self.interest_hits.get(key, 0) + 1
+
+    def count_lines(self, parser):
+        self.lines += parser.lines
+
+    def add_slicer(self, slicer):
+        self.decoded_bytes = slicer.input_size
+        for known in slicer.known_objects.values():
+            self.objects[known.name] = {"points": known.hull.points_added, "vertices": len(known.hull.points)}
+
+    def finish(self):
+        try:
+            import resource
+        except ImportError:
+            return
+        # KiB on Linux, bytes on macOS
+        scale = 1 if sys.platform == "darwin" else 1024
+        self.peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+    def as_dict(self):
+        return {
+            "file": self.file,
+            "result": self.result,
+            "stages": self.stages,
+            "input_bytes": self.input_bytes,
+            "decoded_bytes": self.decoded_bytes,
+            "output_bytes": self.output_bytes,
+            "lines": self.lines,
+            "interest_hits": self.interest_hits,
+            "objects": self.objects,
+            "peak_rss": self.peak_rss,
+        }
+
+
 class SlicerProcessor:
     known_objects: Dict[str, KnownObject]
     interest_map: Dict[int, function]
+    interest_lines: Dict[int, str]
+    # (start offset, end offset, line) of every line the output stage may be interested in
+    markers: List[Tuple[int, int, bytes]]
+    # Byte ranges of the file where each object hull was current during the scan, between the marker lines
+    object_ranges: Dict[Hull, List[Tuple[int, int]]]
+    # Whether the output stage only needs the scan results for the object definitions, so that both can run together
+    single_pass = True
     def __init__(self):
         self.known_objects = {}
         self.interest_map = {}
+        self.interest_lines = {}
+        self.markers = []
+        self.object_ranges = {}
+        self.range_start = 0
+        self.input_size = 0
         self.parser = GCodeParser()
         self.current_object_id = None
+        self.reserve_header = False
+        self.stats = _NO_STATS
 
     def register_interest(self, line, callback):
         id = len(self.interest_map) + 1
         self.parser.register_interest(line, id)
         self.interest_map[id] = callback
+        self.interest_lines[id] = line
+
+    def clear_interests(self):
+        self.interest_map = {}
+        self.interest_lines = {}
+        self.parser.clear_interests()
         
     # Registers interesting lines for the first stage where we scan for objects and their boundaries
     def slicer_start_scan(self):
@@ -112,9 +349,7 @@ class SlicerProcessor:
         if name is None:
             name = object_id
         if object_id not in self.known_objects:
-            h = Hull()
-            h.precision = precision
-            self.known_objects[object_id] = KnownObject(_clean_id(name), h)
+            self.known_objects[object_id] = KnownObject(_clean_id(name), _new_hull())
         return self.known_objects[object_id].hull
 
     def start_object_id(self, object_id: str, name: str = None):
@@ -123,27 +358,52 @@ class SlicerProcessor:
     def stop_object(self):
         self.parser.hull = None
 
+    def defined_objects(self) -> List[KnownObject]:
+        """The objects the output stage defines"""
+        return list(self.known_objects.values())
+
+    def switch_range(self, previous: Optional[Hull], start, end):
+        """The current hull changed from previous on the line [start, end)"""
+        if previous is not None:
+            self.object_ranges.setdefault(previous, []).append((self.range_start, start))
+        self.range_start = end
+
     def get_hull_bounds(self, hull):
-        if shapely:
-            points_array = numpy.frombuffer(hull.point_bytes())
-            points_array.shape = (points_array.size // 2, 2)
-            points = shapely.MultiPoint(points_array)
-            hull = points.convex_hull.simplify(0.02, preserve_topology=False)
-            #print(len(hull.exterior.coords))
-            center = hull.centroid
-            bb = [Point(x,y) for x,y in hull.exterior.coords]
-        else:
-            xmin, ymin, xmax, ymax = hull.bounding_box()
-            center = Point((xmax + xmin) / 2, (ymax + ymin) / 2)
-            bb = [
-                Point(xmin, ymin),
-                Point(xmin, ymax),
-                Point(xmax, ymax),
-                Point(xmax, ymin),
-            ]
+        with self.stats.stage("hulls"):
+            return self._hull_bounds(hull)
+
+    def _hull_bounds(self, hull):
+        polygon = _unpack_points(hull.simplify(simplify_tolerance))
+        if len(polygon) >= 4:
+            center = hull.centroid(simplify_tolerance)
+            if shapely_cross_check and _import_shapely():
+                with self.stats.stage("shapely"):
+                    _check_hull_bounds(hull, center, polygon)
+            return center, polygon
+
+        # The hull has no area, fall back to the bounding box
+        xmin, ymin, xmax, ymax = hull.bounding_box()
+        center = Point((xmax + xmin) / 2, (ymax + ymin) / 2)
+        bb = [
+            Point(xmin, ymin),
+            Point(xmin, ymax),
+            Point(xmax, ymax),
+            Point(xmax, ymin),
+        ]
         return center, bb
 
+    # Slicer state collected by the scan that the output stage needs, must be JSON serializable
+    def scan_state(self):
+        return {}
+
+    def restore_scan_state(self, state):
+        pass
+
     def output_object_definitions(self):
+        if self.reserve_header:
+            yield _RESERVED_HEADER
+            return
+
         yield from header(len(self.known_objects))
         for object_id, hull in self.known_objects.values():
             center, polygon = self.get_hull_bounds(hull)
@@ -167,7 +427,7 @@ class SlicerProcessor:
 class SlicerSlic3rFamily(SlicerProcessor):
     @staticmethod
     def _get_id(line):
-        return line.split("printing object")[1].strip()
+        return _decode(line.split(b"printing object")[1].strip())
 
     def slicer_start_scan(self):
         self.register_interest('; printing object ', 
@@ -183,16 +443,25 @@ class SlicerSlic3rFamily(SlicerProcessor):
         yield from self.output_object_definitions()
 
 class SlicerCura(SlicerProcessor):
-    last_time_elapsed: str
+    last_time_elapsed: bytes
+    # The object end is detected using the last TIME_ELAPSED marker in the file
+    single_pass = False
 
     def _scan_elapsed(self, line):
         self.last_time_elapsed = line
 
+    def scan_state(self):
+        return {"last_time_elapsed": None if self.last_time_elapsed is None else _decode(self.last_time_elapsed)}
+
+    def restore_scan_state(self, state):
+        last_time_elapsed = state["last_time_elapsed"]
+        self.last_time_elapsed = None if last_time_elapsed is None else _encode(last_time_elapsed)
+
     def _scan_mesh(self, line):
-        object_name = line.split(":", maxsplit=1)[1].strip()
-        if object_name == 'NONMESH':
+        object_name = line.split(b":", maxsplit=1)[1].strip()
+        if object_name == b'NONMESH':
             return
-        self.start_object_id(object_name)
+        self.start_object_id(_decode(object_name))
 
     def slicer_start_scan(self):
         self.last_time_elapsed = None
@@ -204,10 +473,10 @@ class SlicerCura(SlicerProcessor):
         yield from self.output_object_definitions()
 
     def _output_mesh(self, line):
-        object_name = line.split(":", maxsplit=1)[1].strip()
-        if object_name == 'NONMESH':
+        object_name = line.split(b":", maxsplit=1)[1].strip()
+        if object_name == b'NONMESH':
             return []
-        yield from self.output_object_start(object_name)
+        yield from self.output_object_start(_decode(object_name))
 
     def _output_elapsed(self, line):
         if self.last_time_elapsed == line and self.current_object_id:
@@ -219,10 +488,10 @@ class SlicerCura(SlicerProcessor):
 
 class SlicerIdeamaker(SlicerProcessor):
     def _scan_printing(self, line):
-        self.ideamaker_object_name = line.split(":")[1].strip()
+        self.ideamaker_object_name = _decode(line.split(b":")[1].strip())
 
     def _scan_printing_id(self, line):
-        id = line.split(":")[1].strip()
+        id = _decode(line.split(b":")[1].strip())
         # Ignore the internal non-object meshes
         if id == "-1":
             return
@@ -239,7 +508,7 @@ class SlicerIdeamaker(SlicerProcessor):
         #   ;PRINTING_ID: 0
 
     def _output_printing_id(self, line):
-        printing_id = line.split(":")[1].strip()
+        printing_id = _decode(line.split(b":")[1].strip())
         if printing_id == "-1":
             return
         yield from self.output_object_start(printing_id)
@@ -254,8 +523,11 @@ class SlicerIdeamaker(SlicerProcessor):
         self.register_interest(';REMAINING_TIME: 0', self._output_end)
 
 class SlicerM486(SlicerProcessor):
+    # The output removes the "-1" object that the rest of the scan would define again
+    single_pass = False
+
     def _scan_m486(self, line):
-        _, params = parse_gcode(line)
+        _, params = parse_gcode(_decode(line))
         if "T" in params:
             for i in range(-1, int(params["T"])):
                 self.define_object_id(str(i))
@@ -264,6 +536,7 @@ class SlicerM486(SlicerProcessor):
             self.start_object_id(params["S"])
 
     def _output_m486(self, line):
+        line = _decode(line)
         _, params = parse_gcode(line)
         if "T" in params:
             del self.known_objects["-1"]
@@ -277,9 +550,24 @@ class SlicerM486(SlicerProcessor):
     def slicer_start_scan(self):
         self.register_interest('M486', self._scan_m486)
 
+    def defined_objects(self):
+        return [known for object_id, known in self.known_objects.items() if object_id != "-1"]
+
     def slicer_start_output(self):
         self.register_interest('M486', self._output_m486)
 
+class _SlicerExcludeObject(SlicerProcessor):
+    """Scans already processed files by their EXCLUDE_OBJECT markers, it has no output stage"""
+
+    def _scan_start(self, line):
+        name = _decode(line).split("NAME=", maxsplit=1)[1].split()
+        if name:
+            self.start_object_id(name[0])
+
+    def slicer_start_scan(self):
+        self.register_interest("EXCLUDE_OBJECT_START NAME=", self._scan_start)
+        self.register_interest("EXCLUDE_OBJECT_END", lambda _: self.stop_object())
+
 # Note:
 #   Slic3r:     does not output any markers into GCode
 #   Kisslicer:  does not output any markers into GCode
@@ -301,115 +589,1308 @@ def identify_slicer_marker(line):
             logger.debug("Identified slicer %s", name)
             return processor
 
-def _process_lines(infile, slicer_factory):
-    slicer: SlicerProcessor = slicer_factory()
+# GCodeParser.feed_buffer returns matches as packed (start, end, code) int64 triples
+_MATCH = struct.Struct("=qqq")
 
-    # Identify objects
-    infile.seek(0)
-    slicer.slicer_start_scan()
-    for line in infile:
-        r = slicer.parser.feed_line(line) 
-        if r is not None:
-            slicer.interest_map[r](line)
+
+def _read_blocks(infile):
+    """Yield the binary file contents in blocks, each ending with a complete line."""
+    carry = b""
+    while True:
+        data = infile.read(block_size)
+        if not data:
+            break
+        data = carry + data
+        cut = data.rfind(b"\n") + 1
+        carry = data[cut:]
+        if cut:
+            yield data[:cut]
+    if carry:
+        yield carry
+
+
+def _iter_matches(packed):
+    return _MATCH.iter_unpack(packed)
+
+
+def _encoded(items):
+    """Generated GCode is built as text, encode it for output."""
+    for item in items:
+        yield _encode(item) if isinstance(item, str) else item
+
+
+def _as_binary(infile):
+    """Get a binary file for text files passed in by API users."""
+    if not isinstance(infile, io.TextIOBase):
+        return infile
+    buffer = getattr(infile, "buffer", None)
+    if buffer is not None:
+        return buffer
+    return io.BytesIO(_encode(infile.read()))
 
 
-    # Replacement & Output
-    slicer.interest_map = {}
+class _Span(NamedTuple):
+    """Unchanged part of the input file, to be copied to the output"""
+    start: int
+    end: int
+
+
+def _collect_interests(slicer: SlicerProcessor, start_stage) -> List[Tuple[str, callable]]:
+    """Lines and callbacks registered by one of the slicer stages"""
+    slicer.clear_interests()
+    start_stage()
+    interests = [(slicer.interest_lines[id], callback) for id, callback in slicer.interest_map.items()]
+    slicer.clear_interests()
+    return interests
+
+
+class _InterestMatcher:
+    """Matches single lines against interests of one stage, with the same rules as the scanning parser"""
+    def __init__(self, interests: List[Tuple[str, callable]]):
+        self.callbacks = [callback for _, callback in interests]
+        self.parser = GCodeParser()
+        for code, (line, _) in enumerate(interests):
+            self.parser.register_interest(line, code)
+
+    def match(self, line: bytes):
+        packed = self.parser.feed_buffer(line)
+        if not packed:
+            return None
+        return self.callbacks[_MATCH.unpack(packed)[2]]
+
+
+def _scan_objects(infile, slicer_factory, stats=_NO_STATS) -> SlicerProcessor:
+    """First pass, collects object hulls and indexes the lines interesting for the output pass."""
+    slicer: SlicerProcessor = slicer_factory()
+    slicer.stats = stats
+
+    # The scan does not act on lines the output stage is interested in, but it must remember where they are
+    scan_interests = _collect_interests(slicer, slicer.slicer_start_scan)
+    output_interests = _collect_interests(slicer, slicer.slicer_start_output)
+    for line, callback in scan_interests:
+        slicer.register_interest(line, callback)
+    for line, _ in output_interests:
+        if line not in slicer.interest_lines.values():
+            slicer.register_interest(line, None)
+
+    fd = _file_descriptor(infile)
+    if scan_threads > 1 and fd is not None and os.fstat(fd).st_size >= 2 * block_size:
+        _scan_parallel(fd, slicer)
+        slicer.switch_range(slicer.parser.hull, slicer.input_size, slicer.input_size)
+        slicer.parser.hull = None
+        return slicer
+
+    # Callbacks may switch the current hull, so the parser stops after each match.
+    infile.seek(0)
+    offset = 0
+    for block in _read_blocks(infile):
+        pos = 0
+        while True:
+            packed = slicer.parser.feed_buffer(block, pos, max_matches=1)
+            if not packed:
+                break
+            start, pos, r = _MATCH.unpack(packed)
+            _scan_marker(slicer, offset + start, offset + pos, r, block[start:pos])
+        offset += len(block)
+
+    slicer.input_size = offset
+    slicer.switch_range(slicer.parser.hull, offset, offset)
     slicer.parser.hull = None
-    slicer.parser.clear_interests()
+    stats.count_lines(slicer.parser)
+    return slicer
+
+
+def _scan_marker(slicer: SlicerProcessor, start, end, code, line):
+    slicer.markers.append((start, end, line))
+    callback = slicer.interest_map[code]
+    if callback is not None:
+        slicer.stats.hit("scan", slicer.interest_lines[code])
+        hull = slicer.parser.hull
+        callback(line)
+        if slicer.parser.hull is not hull:
+            slicer.switch_range(hull, start, end)
+
+
+def _scan_chunk(buffer, start, end, interest_lines):
+    """Scan a chunk of the file into (hull, match) segments, the hull has the points before the match (or the end)"""
+    parser = GCodeParser()
+    for code, line in interest_lines.items():
+        parser.register_interest(line, code)
+
+    segments = []
+    pos = start
+    while True:
+        hull = _new_hull()
+        parser.hull = hull
+        packed = parser.feed_buffer(buffer, pos, end, max_matches=1)
+        if not packed:
+            segments.append((hull, None))
+            return segments, parser
+        match = _MATCH.unpack(packed)
+        segments.append((hull, match))
+        pos = match[1]
+
+
+def _scan_parallel(fd, slicer: SlicerProcessor):
+    """Scan line aligned chunks of the file in threads, then replay their markers to the slicer in order"""
+    import concurrent.futures
+    import mmap
+
+    with mmap.mmap(fd, 0, access=mmap.ACCESS_READ) as buffer:
+        size = len(buffer)
+        bounds = [0]
+        for i in range(1, scan_threads):
+            newline = buffer.find(b"\n", max(bounds[-1], size * i // scan_threads))
+            if newline < 0:
+                break
+            bounds.append(newline + 1)
+        bounds.append(size)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=scan_threads) as executor:
+            chunks = [
+                executor.submit(_scan_chunk, buffer, start, end, slicer.interest_lines)
+                for start, end in zip(bounds, bounds[1:])
+            ]
+            for chunk in chunks:
+                segments, parser = chunk.result()
+                slicer.stats.count_lines(parser)
+                for hull, match in segments:
+                    if slicer.parser.hull is not None:
+                        slicer.parser.hull.merge(hull)
+                    if match is not None:
+                        start, end, code = match
+                        _scan_marker(slicer, start, end, code, buffer[start:end])
+
+    slicer.input_size = size
+
+
+def _output_pieces(slicer: SlicerProcessor):
+    """Second pass, yields generated bytes and _Spans of the input that are copied unchanged."""
+    slicer.clear_interests()
     slicer.slicer_start_output()
+
+    yield from _encoded(slicer.slicer_header())
+    pos = 0
+    for start, end, line in slicer.markers:
+        # The marker lines are matched again, now against the output interests only
+        packed = slicer.parser.feed_buffer(line)
+        if not packed:
+            continue
+        _, _, r = _MATCH.unpack(packed)
+        if start > pos:
+            yield _Span(pos, start)
+        slicer.stats.hit("output", slicer.interest_lines[r])
+        more = slicer.interest_map[r](line)
+        if more is not None:
+            yield from _encoded(more)
+        pos = end
+    if pos < slicer.input_size:
+        yield _Span(pos, slicer.input_size)
+
+    if slicer.current_object_id is not None:
+        yield from _encoded(slicer.output_object_end())
+
+
+def _read_span(infile, span: _Span):
+    infile.seek(span.start)
+    remaining = span.end - span.start
+    while remaining > 0:
+        data = infile.read(min(remaining, block_size))
+        if not data:
+            raise EOFError("GCode file was truncated while being processed")
+        remaining -= len(data)
+        yield data
+
+
+def _file_descriptor(f) -> Optional[int]:
+    """File descriptor of a plain binary file that we can use for positioned I/O, or None"""
+    plain = (io.FileIO, io.BufferedReader, io.BufferedWriter, io.BufferedRandom)
+    if not hasattr(os, "pread") or not isinstance(f, plain):
+        return None
+    return f.fileno()
+
+
+def _write_all(fd, data):
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+def _copy_file_range(in_fd, out_fd, offset, count):
+    return os.copy_file_range(in_fd, out_fd, count, offset)
+
+
+def _sendfile(in_fd, out_fd, offset, count):
+    return os.sendfile(out_fd, in_fd, offset, count)
+
+
+def _pread_write(in_fd, out_fd, offset, count):
+    data = os.pread(in_fd, min(count, block_size), offset)
+    _write_all(out_fd, data)
+    return len(data)
+
+
+# Span copy methods from the fastest. The kernel copies may be unsupported for the given pair of files.
+_COPY_METHODS = [
+    method
+    for method, available in (
+        (_copy_file_range, hasattr(os, "copy_file_range")),
+        (_sendfile, hasattr(os, "sendfile") and sys.platform.startswith("linux")),
+        (_pread_write, True),
+    )
+    if available
+]
+_COPY_FALLBACK_ERRNOS = {errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP, errno.EBADF}
+# ioctl sharing the extents of a whole file (Linux FICLONE), on filesystems with reflinks (btrfs, xfs)
+_FICLONE = 0x40049409
+
+
+def _reflink(in_fd, out_fd) -> bool:
+    """Make out_fd a copy-on-write clone of in_fd, returns False if the filesystem can't"""
+    if not sys.platform.startswith("linux"):
+        return False
+    import fcntl
+
+    try:
+        fcntl.ioctl(out_fd, _FICLONE, in_fd)
+    except OSError:
+        return False
+    return True
+
+
+def _write_pieces(pieces, infile, outfile):
+    in_fd = _file_descriptor(infile)
+    out_fd = _file_descriptor(outfile)
+    if in_fd is None or out_fd is None:
+        for piece in pieces:
+            if isinstance(piece, _Span):
+                for data in _read_span(infile, piece):
+                    outfile.write(data)
+            else:
+                outfile.write(piece)
+        return
+
+    # We write directly to the file descriptor, bypassing the buffers of outfile
+    outfile.flush()
+    methods = list(_COPY_METHODS)
+    pending = []
+    for piece in pieces:
+        if not isinstance(piece, _Span):
+            pending.append(piece)
+            continue
+
+        _write_all(out_fd, b"".join(pending))
+        pending = []
+        offset, end = piece
+        while offset < end:
+            try:
+                copied = methods[0](in_fd, out_fd, offset, end - offset)
+            except OSError as e:
+                if len(methods) == 1 or e.errno not in _COPY_FALLBACK_ERRNOS:
+                    raise
+                methods.pop(0)
+                continue
+            if copied == 0:
+                raise EOFError("GCode file was truncated while being processed")
+            offset += copied
+    _write_all(out_fd, b"".join(pending))
+    outfile.seek(os.lseek(out_fd, 0, os.SEEK_CUR))
+
+
+def _single_pass_pieces(infile, slicer: SlicerProcessor):
+    """Scan and output at once. Yields generated bytes, unchanged input and _RESERVED_HEADER placeholders."""
+    scan_interests = _collect_interests(slicer, slicer.slicer_start_scan)
+    output_interests = _collect_interests(slicer, slicer.slicer_start_output)
+    scan = _InterestMatcher(scan_interests)
+    output = _InterestMatcher(output_interests)
+    # The parser only finds the lines, callbacks of both stages are looked up by the matchers
+    for line, _ in scan_interests + output_interests:
+        if line not in slicer.interest_lines.values():
+            slicer.register_interest(line, None)
+
+    slicer.reserve_header = True
+    yield from _encoded(slicer.slicer_header())
+
     infile.seek(0)
+    offset = 0
+    for block in _read_blocks(infile):
+        view = memoryview(block)
+        pos = 0
+        copied = 0
+        while True:
+            packed = slicer.parser.feed_buffer(block, pos, max_matches=1)
+            if not packed:
+                break
+            start, pos, r = _MATCH.unpack(packed)
+            line = block[start:pos]
+            slicer.markers.append((offset + start, offset + pos, line))
+            slicer.stats.hit("single_pass", slicer.interest_lines[r])
+
+            scan_callback = scan.match(line)
+            if scan_callback is not None:
+                scan_callback(line)
+            output_callback = output.match(line)
+            if output_callback is None:
+                continue
 
-    yield from slicer.slicer_header()
-    for line in infile:
-        r = slicer.parser.feed_line(line) 
-        if r is not None:
-            more = slicer.interest_map[r](line)
+            if start > copied:
+                yield view[copied:start]
+            more = output_callback(line)
             if more is not None:
-                yield from more
-        else:
-            yield line
+                yield from _encoded(more)
+            copied = pos
+        if copied < len(block):
+            yield view[copied:]
+        offset += len(block)
 
+    slicer.input_size = offset
     if slicer.current_object_id is not None:
-        yield from slicer.output_object_end()
+        yield from _encoded(slicer.output_object_end())
+    slicer.parser.hull = None
+    slicer.reserve_header = False
+    slicer.stats.count_lines(slicer.parser)
+
+
+def _write_single_pass(infile, outfile, slicer: SlicerProcessor) -> bool:
+    """Returns False if the object definitions did not fit into the reserved space"""
+    reserved = []
+    for piece in _single_pass_pieces(infile, slicer):
+        if piece is _RESERVED_HEADER:
+            reserved.append(outfile.tell())
+            outfile.write(_header_padding(header_reserve))
+        else:
+            outfile.write(piece)
+
+    definitions = b"".join(_encoded(slicer.output_object_definitions()))
+    if len(definitions) > header_reserve:
+        logger.info("Object definitions need %d bytes, only %d were reserved", len(definitions), header_reserve)
+        return False
+
+    definitions += _header_padding(header_reserve - len(definitions))
+    out_fd = _file_descriptor(outfile)
+    if out_fd is not None:
+        outfile.flush()
+        for offset in reserved:
+            os.pwrite(out_fd, definitions, offset)
+    else:
+        end = outfile.tell()
+        for offset in reserved:
+            outfile.seek(offset)
+            outfile.write(definitions)
+        outfile.seek(end)
+    return True
+
+
+def _cache_key(infile, slicer_factory) -> str:
+    """Hash of the input contents and everything else the scan results depend on"""
+    import hashlib
+    import json
+
+    key = hashlib.blake2b(digest_size=20)
+    key.update(json.dumps([__version__, slicer_factory.__name__, precision]).encode())
+    infile.seek(0)
+    while True:
+        data = infile.read(block_size)
+        if not data:
+            break
+        key.update(data)
+    return key.hexdigest()
+
+
+def _cache_load(key, slicer_factory) -> Optional[SlicerProcessor]:
+    import json
+
+    path = cache_dir / f"{key}.json"
+    try:
+        with path.open() as f:
+            entry = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError):
+        logger.warning("Ignoring unreadable cache entry %s", path, exc_info=True)
+        return None
+
+    # The scan may have fallen back to M486 (_m486_rescan), the key is that of the identified slicer
+    factories = {factory.__name__: factory for _, factory in SLICERS.values()}
+    try:
+        slicer: SlicerProcessor = factories.get(entry["slicer"], slicer_factory)()
+        for object_id, name, points, points_added in entry["objects"]:
+            hull = _new_hull()
+            hull.points = [Point(x, y) for x, y in points]
+            # Setting the points counts them as added, the scan added more
+            hull.points_added = points_added
+            slicer.known_objects[object_id] = KnownObject(name, hull)
+        slicer.markers = [(start, end, _encode(line)) for start, end, line in entry["markers"]]
+        slicer.input_size = entry["input_size"]
+        slicer.restore_scan_state(entry["state"])
+    except (KeyError, TypeError, ValueError):
+        logger.warning("Ignoring invalid cache entry %s", path, exc_info=True)
+        return None
+
+    # Mark the entry as recently used, unless it has just been evicted (it is loaded already)
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        pass
+    logger.debug("Using cached scan %s", path)
+    return slicer
+
+
+def _cache_store(key, slicer: SlicerProcessor):
+    import json
+    import tempfile
+
+    entry = {
+        "slicer": type(slicer).__name__,
+        "objects": [
+            [object_id, known.name, [[p.x, p.y] for p in known.hull.points], known.hull.points_added]
+            for object_id, known in slicer.known_objects.items()
+        ],
+        "markers": [[start, end, _decode(line)] for start, end, line in slicer.markers],
+        "input_size": slicer.input_size,
+        "state": slicer.scan_state(),
+    }
+    try:
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile("w", dir=cache_dir, suffix=".tmp", delete=False) as f:
+            json.dump(entry, f)
+        os.replace(f.name, cache_dir / f"{key}.json")
+        _cache_evict()
+    except OSError:
+        logger.warning("Failed to store the scan results in the cache %s", cache_dir, exc_info=True)
+
+
+def _cache_evict():
+    entries = []
+    for path in cache_dir.glob("*.json"):
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= cache_size:
+            break
+        logger.debug("Evicting cached scan %s", path)
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+def _process_lines(infile, slicer_factory):
+    slicer = _scan_objects(infile, slicer_factory)
+    for piece in _output_pieces(slicer):
+        if isinstance(piece, _Span):
+            yield from _read_span(infile, piece)
+        else:
+            yield piece
+
+def _process_text(infile, slicer_factory):
+    """Process a file opened by the API user, text files get text back."""
+    output = _process_lines(_as_binary(infile), slicer_factory)
+    if isinstance(infile, io.TextIOBase):
+        return _decode_pieces(output)
+    return output
+
+def _decode_pieces(pieces):
+    """Decode output pieces, a character may be split between two of them"""
+    decoder = codecs.getincrementaldecoder("utf-8")("surrogateescape")
+    for piece in pieces:
+        text = decoder.decode(piece)
+        if text:
+            yield text
+    text = decoder.decode(b"", final=True)
+    if text:
+        yield text
 
 # These methods are for compatibility with Moonraker and other API users
 def preprocess_pipe(infile):
     yield from infile
 
 def preprocess_slicer(infile):
-    yield from _process_lines(infile, slicer_factory=SlicerSlic3rFamily)
+    yield from _process_text(infile, slicer_factory=SlicerSlic3rFamily)
 
 def preprocess_cura(infile):
-    yield from _process_lines(infile, slicer_factory=SlicerCura)
+    yield from _process_text(infile, slicer_factory=SlicerCura)
 
 def preprocess_ideamaker(infile):
-    yield from _process_lines(infile, slicer_factory=SlicerIdeamaker)
+    yield from _process_text(infile, slicer_factory=SlicerIdeamaker)
 
 def preprocess_m486(infile):
-    yield from _process_lines(infile, slicer_factory=SlicerM486)
+    yield from _process_text(infile, slicer_factory=SlicerM486)
+
+_I_PROCESSED = 1
+_I_SLICER_MARKER = 2
+_I_THUMBNAIL = 3
+# "; thumbnail begin 64x64 3012", the last number is the length of the base64 data
+_THUMBNAIL_SIZE = re.compile(rb"begin\s+\d+x\d+\s+(\d+)")
+
+
+def _sniff_matches(infile, parser, start, budget):
+    """Yield (interest, line) for the lines within budget bytes from start, jumping over thumbnail images."""
+    pos = start
+    partial = start > 0
+    while budget > 0:
+        infile.seek(pos)
+        data = infile.read(budget)
+        offset = data.find(b"\n") + 1 if partial else 0
+        # Only complete lines, unless the data ends with the file
+        end = data.rfind(b"\n") + 1 if len(data) == budget else len(data)
+        jumped = False
+        while offset < end:
+            packed = parser.feed_buffer(data, offset, end, max_matches=1)
+            if not packed:
+                break
+            line_start, offset, interest = _MATCH.unpack(packed)
+            if interest != _I_THUMBNAIL:
+                yield interest, data[line_start:offset]
+                continue
+            size = _THUMBNAIL_SIZE.search(data, line_start, offset)
+            if size:
+                # The base64 lines are longer than the data because of their "; " prefixes, this lands inside them
+                budget -= offset
+                pos += offset + int(size[1])
+                partial = jumped = True
+                break
+        if not jumped:
+            return
+
+
+def _identify_slicer(infile, known=None):
+    """Returns the slicer processor factory (None if not identified) and whether the file is already processed"""
+    # Slicers identify themselves in the head and we put our header there, the whole file is scanned only if the head
+    # and the tail don't tell (M486 files of unknown slicers). known is the slicer named by the binary G-code metadata,
+    # the G-code then only tells whether the file is processed or uses M486.
+    parser = _identify_parser()
+    logger.debug("Identifying slicer")
+    size = _known_size(infile)
+    found = None
+    if size is None or size > 2 * sniff_bytes:
+        matches = _sniff_matches(infile, parser, 0, sniff_bytes)
+        # The size of compressed streams is only known after decompressing them, skip the tail
+        if size is not None:
+            matches = itertools.chain(matches, _sniff_matches(infile, parser, size - sniff_bytes, sniff_bytes))
+        found = _identify_matches(matches)
+        if found == (None, False) and known is None:
+            logger.debug("Nothing found in the head and tail, scanning the whole file")
+            found = None
+
+    if found is None:
+        found = _identify_whole(infile, parser)
+    slicer_factory, processed = found
+    if known is not None and not processed and slicer_factory is not SlicerM486:
+        slicer_factory = known
+    return slicer_factory, processed
+
+
+def _identify_whole(infile, parser):
+    infile.seek(0)
+    return _identify_matches(
+        (interest, block[start:end])
+        for block in _read_blocks(infile)
+        for start, end, interest in _iter_matches(parser.feed_buffer(block))
+    )
+
+
+def _m486_rescan(infile, slicer: SlicerProcessor, stats=_NO_STATS) -> SlicerProcessor:
+    """The M486 scan if the slicer found no objects and the file uses M486 past what _identify_slicer sniffs"""
+    if slicer.defined_objects() or isinstance(slicer, SlicerM486):
+        return slicer
+    if _identify_whole(infile, _identify_parser())[0] is not SlicerM486:
+        return slicer
+    logger.info("No objects found by the slicer markers, using the M486 objects")
+    return _scan_objects(infile, SlicerM486, stats)
+
+
+def _producer_slicer(producer: Optional[str]):
+    """Slicer processor factory of the producer of binary G-code, e.g. "PrusaSlicer 2.7.0+linux-x64" """
+    name = (producer or "").split(" ")[0].lower()
+    if name in SLICERS and name != "m486":
+        logger.debug("Identified slicer %s from the metadata", name)
+        return SLICERS[name][1]
+    return None
+
+
+def _bgcode_slicer(infile, header, blocks, gcode):
+    """_identify_slicer for binary G-code infile, decoded into gcode"""
+    producer = bgcode.producer(infile, blocks, bgcode.checksum_type(header))
+    return _identify_slicer(gcode, _producer_slicer(producer))
+
 
-def preprocessor(infile, outfile, slicer_factory=None):
-    I_PROCESSED = 1
-    I_SLICER_MARKER = 2
+def _identify_parser():
     parser = GCodeParser()
+    parser.register_interest(HEADER_MARKER.split(" by ")[0], _I_PROCESSED)
+    parser.register_interest('EXCLUDE_OBJECT_DEFINE', _I_PROCESSED)
+    parser.register_interest('DEFINE_OBJECT', _I_PROCESSED)
+    for marker, _ in SLICERS.values():
+        parser.register_interest(marker, _I_SLICER_MARKER)
+
+    parser.register_interest('; thumbnail', _I_THUMBNAIL)
+    return parser
+
+
+def _known_size(infile) -> Optional[int]:
+    """Size of plain files and in-memory buffers, None if finding it out needs reading the whole file"""
+    fd = _file_descriptor(infile)
+    if fd is not None:
+        return os.fstat(fd).st_size
+    if isinstance(infile, io.BytesIO):
+        return infile.getbuffer().nbytes
+    return None
+
+
+def _copy_file(infile, outfile):
+    """Copy the whole infile, cloning it if outfile is an empty plain file on the same filesystem"""
+    fd = _file_descriptor(infile)
+    out_fd = _file_descriptor(outfile)
+    if fd is not None and out_fd is not None and outfile.tell() == 0:
+        outfile.flush()
+        if _reflink(fd, out_fd):
+            outfile.seek(0, io.SEEK_END)
+            return
+    if fd is not None:
+        _write_pieces([_Span(0, os.fstat(fd).st_size)], infile, outfile)
+    else:
+        import shutil
+
+        infile.seek(0)
+        shutil.copyfileobj(infile, outfile, block_size)
+
+
+def _identify_matches(matches):
+    slicer_factory = None
+    for interest, line in matches:
+        if interest == _I_PROCESSED:
+            return None, True
+        if interest == _I_SLICER_MARKER and slicer_factory is not SlicerM486:
+            slicer_factory = identify_slicer_marker(_decode(line))
+    return slicer_factory, False
 
-    # Stage 1, identify slicers
-    if slicer_factory is None:
-        logger.debug("Identifying slicer")
-        parser.register_interest('EXCLUDE_OBJECT_DEFINE', I_PROCESSED)
-        parser.register_interest('DEFINE_OBJECT', I_PROCESSED)
-        for marker, _ in SLICERS.values():
-            parser.register_interest(marker, I_SLICER_MARKER)
-
-        for line in infile:
-            interest = parser.feed_line(line)
-            if interest is None:
-                continue
 
-            if interest == I_PROCESSED:
+def _preprocess_bgcode(infile, outfile, slicer_factory, single_pass, stats):
+    """_preprocess for binary G-code, the metadata and thumbnail blocks are copied as they are"""
+    import tempfile
+
+    with tempfile.TemporaryFile() as gcode, tempfile.TemporaryFile() as output:
+        with stats.stage("decode"):
+            header, blocks = bgcode.extract(infile, gcode)
+        checksum_type = bgcode.checksum_type(header)
+        gcode_blocks = [block for block in blocks if block.type == bgcode.GCODE]
+
+        if slicer_factory is None:
+            # PrusaSlicer names itself in the file metadata, not in the G-code
+            with stats.stage("detect"):
+                slicer_factory, processed = _bgcode_slicer(infile, header, blocks, gcode)
+            if processed:
                 logger.info("GCode already supports cancellation")
-                infile.seek(0)
-                outfile.write(infile.read())
-                return True
-            elif interest == I_SLICER_MARKER:
-                slicer_factory = identify_slicer_marker(line)
+                # Keep the original encoding
+                with stats.stage("output"):
+                    _copy_file(infile, outfile)
+                return None
+            if slicer_factory is None:
+                logger.warning("Could not identify slicer")
+                return False
+
+        slicer = _preprocess(gcode, output, slicer_factory, single_pass, stats)
+
+        # The processed G-code doesn't split into the same blocks, all of them get the compression and the encoding of
+        # the first one (PrusaSlicer writes them all alike)
+        compression = gcode_blocks[0].compression if gcode_blocks else 0
+        encoding = gcode_blocks[0].encoding if gcode_blocks else 0
+        first = gcode_blocks[0].offset if gcode_blocks else None
+        with stats.stage("encode"):
+            outfile.write(header)
+            output.seek(0)
+            for block in blocks:
+                if block.offset == first:
+                    for text in bgcode.split_text(output):
+                        outfile.write(bgcode.encode(text, compression, encoding, checksum_type))
+                if block.type != bgcode.GCODE:
+                    _write_pieces([_Span(block.offset, block.offset + block.size)], infile, outfile)
+    return slicer
+
+
+def preprocessor(infile, outfile, slicer_factory=None, single_pass=False, stats: Optional[Stats] = None):
+    """Process binary infile into binary outfile (seekable for single_pass), False if the slicer is not identified"""
+    infile = _as_binary(infile)
+    if stats is None:
+        stats = _NO_STATS
+    start = outfile.tell() if stats.enabled and outfile.seekable() else None
+
+    slicer = _preprocess(infile, outfile, slicer_factory, single_pass, stats)
+
+    if slicer is not None:
+        stats.add_slicer(slicer)
+    if start is not None:
+        stats.output_bytes = outfile.tell() - start
+    return slicer is not False
+
+
+def _preprocess(infile, outfile, slicer_factory, single_pass, stats):
+    """Returns the slicer processor, None for already processed files and False if the slicer is not identified"""
+    if bgcode.is_bgcode(infile):
+        return _preprocess_bgcode(infile, outfile, slicer_factory, single_pass, stats)
+
+    # Stage 1, identify slicers
+    if slicer_factory is None:
+        with stats.stage("detect"):
+            slicer_factory, processed = _identify_slicer(infile)
+        if processed:
+            logger.info("GCode already supports cancellation")
+            with stats.stage("output"):
+                _copy_file(infile, outfile)
+            return None
 
     if slicer_factory is None:
         logger.warn("Could not identify slicer")
         return False
 
     # Stage 2, output & replacement
-    for line in _process_lines(infile, slicer_factory):
-        outfile.write(line)
+    slicer = None
+    cache_key = None
+    if cache_dir is not None:
+        with stats.stage("cache"):
+            cache_key = _cache_key(infile, slicer_factory)
+            slicer = _cache_load(cache_key, slicer_factory)
+        if slicer is not None:
+            slicer.stats = stats
+
+    if slicer is None and single_pass and slicer_factory.single_pass and outfile.seekable():
+        start = outfile.tell()
+        slicer = slicer_factory()
+        slicer.stats = stats
+        with stats.stage("single_pass"):
+            done = _write_single_pass(infile, outfile, slicer)
+        if done and not slicer.defined_objects():
+            # The objects may be defined with M486 further than the slicer was identified from
+            done = False
+        if done:
+            if cache_key:
+                with stats.stage("cache"):
+                    _cache_store(cache_key, slicer)
+            return slicer
+        logger.info("Falling back to two pass processing")
+        outfile.seek(start)
+        outfile.truncate()
+        slicer = None
+
+    if slicer is None:
+        with stats.stage("scan"):
+            slicer = _m486_rescan(infile, _scan_objects(infile, slicer_factory, stats), stats)
+        if cache_key:
+            with stats.stage("cache"):
+                _cache_store(cache_key, slicer)
+    with stats.stage("output"):
+        _write_pieces(_output_pieces(slicer), infile, outfile)
+    return slicer
+
+class ObjectInfo(NamedTuple):
+    """Object found by scan_objects"""
+
+    name: str
+    center: Point
+    # Closed ring, as in the EXCLUDE_OBJECT_DEFINE polygon
+    polygon: List[Point]
+    # Number of extrusion moves collected for the footprint
+    extrusions: int
+    # (start, end) byte offsets of the G-code printing the object, between its marker lines
+    byte_ranges: List[Tuple[int, int]]
+
+    def as_dict(self):
+        return {
+            "name": self.name,
+            "center": [self.center.x, self.center.y],
+            "polygon": [[p.x, p.y] for p in self.polygon],
+            "extrusions": self.extrusions,
+            "byte_ranges": [list(r) for r in self.byte_ranges],
+        }
+
+
+def scan_objects(path_or_file, slicer_factory=None) -> Optional[List[ObjectInfo]]:
+    """Objects of a G-code file (a path or a binary file) with their footprints, None if the slicer is not identified"""
+    if isinstance(path_or_file, (str, os.PathLike)):
+        path = pathlib.Path(path_or_file)
+        with _open_codec(path, detect_codec(path), "rb") as f:
+            return scan_objects(f, slicer_factory)
+
+    infile = _as_binary(path_or_file)
+    if bgcode.is_bgcode(infile):
+        import tempfile
+
+        with tempfile.TemporaryFile() as gcode:
+            header, blocks = bgcode.extract(infile, gcode)
+            if slicer_factory is None:
+                slicer_factory = _scan_slicer(*_bgcode_slicer(infile, header, blocks, gcode))
+                if slicer_factory is None:
+                    return None
+            return scan_objects(gcode, slicer_factory)
+
+    if slicer_factory is None:
+        slicer_factory = _scan_slicer(*_identify_slicer(infile))
+        if slicer_factory is None:
+            return None
+
+    slicer = _m486_rescan(infile, _scan_objects(infile, slicer_factory))
+    objects = []
+    for known in slicer.defined_objects():
+        if not known.hull.points:
+            continue
+        center, polygon = slicer.get_hull_bounds(known.hull)
+        objects.append(
+            ObjectInfo(
+                known.name, center, polygon, known.hull.points_added, slicer.object_ranges.get(known.hull, [])
+            )
+        )
+    return objects
+
+
+def _scan_slicer(slicer_factory, processed):
+    """The slicer processor factory for scan_objects, processed files are scanned by their EXCLUDE_OBJECT markers"""
+    if processed:
+        return _SlicerExcludeObject
+    if slicer_factory is None:
+        logger.warning("Could not identify slicer")
+    return slicer_factory
+
+
+class Moves(NamedTuple):
+    """Moves extracted by extract_moves, the table columns are line, command, x, y, z, e, f and object."""
+
+    table: MoveTable
+    # Object names, indexed by the object column (-1 outside of objects)
+    objects: List[str]
+
+    def column(self, name: str) -> memoryview:
+        return memoryview(self.table.column(name))
+
+
+def extract_moves(infile, slicer_factory=None) -> Moves:
+    """Extract all G0-G3 moves of binary infile into columns, numpy.asarray(moves.column("x")) doesn't copy them"""
+    infile = _as_binary(infile)
+    if slicer_factory is None:
+        slicer_factory, _ = _identify_slicer(infile)
+
+    table = MoveTable()
+    if slicer_factory is None:
+        infile.seek(0)
+        for block in _read_blocks(infile):
+            table.scan(block)
+        return Moves(table, [])
+
+    slicer: SlicerProcessor = slicer_factory()
+    for line, callback in _collect_interests(slicer, slicer.slicer_start_scan):
+        slicer.register_interest(line, callback)
+    # The slicer callbacks switch slicer.parser.hull, a separate parser only finds the markers without collecting points
+    markers = GCodeParser()
+    for code, line in slicer.interest_lines.items():
+        markers.register_interest(line, code)
+
+    hull_indices = {}
+    object_index = -1
+    infile.seek(0)
+    for block in _read_blocks(infile):
+        pos = 0
+        while pos < len(block):
+            packed = markers.feed_buffer(block, pos, max_matches=1)
+            start, end, code = _MATCH.unpack(packed) if packed else (None, len(block), None)
+            table.scan(block, pos, end, object_index)
+            pos = end
+            if code is None:
+                break
+
+            slicer.interest_map[code](block[start:end])
+            hull = slicer.parser.hull
+            if hull is None:
+                object_index = -1
+                continue
+            if id(hull) not in hull_indices:
+                hull_indices = {id(known.hull): i for i, known in enumerate(slicer.known_objects.values())}
+            object_index = hull_indices[id(hull)]
+
+    return Moves(table, [known.name for known in slicer.known_objects.values()])
+
+
+# Compressed G-code, detected by the magic bytes: (magic, module, file extension)
+CODECS = {
+    "gzip": (b"\x1f\x8b", "gzip", ".gz"),
+    "xz": (b"\xfd7zXZ\x00", "lzma", ".xz"),
+    "bz2": (b"BZh", "bz2", ".bz2"),
+}
 
-    return True
 
-def process_file_for_cancellation(filename: PathLike, output_suffix=None) -> int:
+def detect_codec(filepath: pathlib.Path) -> Optional[str]:
+    """Name of the codec the file is compressed with, None for plain files"""
+    with filepath.open("rb") as f:
+        start = f.read(8)
+    for name, (magic, _, _) in CODECS.items():
+        if start.startswith(magic):
+            return name
+    return None
+
+
+def _open_codec(file, codec: Optional[str], mode):
+    """Open a path or wrap an open binary file (left open) with the codec"""
+    if codec is None:
+        return file.open(mode) if isinstance(file, pathlib.Path) else contextlib.nullcontext(file)
+    module = importlib.import_module(CODECS[codec][1])
+    if codec == "gzip" and "w" in mode:
+        # The default level 9 is several times slower, for little gain on G-code
+        return module.open(file, mode, compresslevel=6)
+    return module.open(file, mode)
+
+
+def _fsync_directory(path: pathlib.Path):
+    """Make a rename in the directory durable, where directories can be opened"""
+    try:
+        fd = os.open(path, os.O_RDONLY | getattr(os, "O_DIRECTORY", 0))
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+# Cleared when linking an O_TMPFILE file fails, e.g. in some sandboxes
+_link_anonymous = True
+
+
+class _AtomicFile:
+    """Binary output file in the directory of path (anonymous on Linux), replacing path on commit"""
+
+    def __init__(self, path: pathlib.Path):
+        self.path = path
+        self.temppath: Optional[pathlib.Path] = None
+        fd = self._open_anonymous()
+        if fd is None:
+            fd = self._open_named()
+        self.file = open(fd, "wb")
+
+    def _open_anonymous(self) -> Optional[int]:
+        # Linking the file needs /proc
+        if not _link_anonymous or not hasattr(os, "O_TMPFILE") or not os.path.isdir("/proc/self/fd"):
+            return None
+        try:
+            # Readable, to copy it if linking fails
+            return os.open(self.path.parent, os.O_TMPFILE | os.O_RDWR, 0o666)
+        except OSError as e:
+            # Not supported by the kernel or the filesystem
+            if e.errno in (errno.EOPNOTSUPP, errno.EISDIR, errno.EINVAL):
+                return None
+            raise
+
+    def _temporary_name(self) -> pathlib.Path:
+        return self.path.with_name(f".{self.path.name}.{os.urandom(4).hex()}.tmp")
+
+    def _open_named(self) -> int:
+        while True:
+            self.temppath = self._temporary_name()
+            try:
+                return os.open(self.temppath, os.O_CREAT | os.O_EXCL | os.O_WRONLY | getattr(os, "O_BINARY", 0), 0o666)
+            except FileExistsError:
+                continue
+
+    def _link(self):
+        # The name can't be linked over an existing file, link a temporary name and rename that
+        temppath = self._temporary_name()
+        try:
+            os.link(f"/proc/self/fd/{self.file.fileno()}", temppath, follow_symlinks=True)
+            self.temppath = temppath
+        except OSError as e:
+            global _link_anonymous
+            _link_anonymous = False
+            logger.debug("Linking an anonymous temporary file failed (%s), using named temporary files", e)
+            with open(self.file.fileno(), "rb", closefd=False) as anonymous, open(self._open_named(), "wb") as named:
+                _copy_file(anonymous, named)
+                named.flush()
+                os.fsync(named.fileno())
+
+    def commit(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        if self.temppath is None:
+            self._link()
+        self.file.close()
+        os.replace(self.temppath, self.path)
+        self.temppath = None
+        _fsync_directory(self.path.parent)
+
+    def close(self):
+        self.file.close()
+        if self.temppath is not None:
+            with contextlib.suppress(FileNotFoundError):
+                self.temppath.unlink()
+            self.temppath = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def process_file_for_cancellation(
+    filename: PathLike, output_suffix=None, single_pass=False, stats: Optional[Stats] = None, compress=None
+) -> int:
+    """Process a G-code file in place (or into a file with output_suffix), compressed like the input unless compress"""
+    if stats is not None:
+        stats.file = str(filename)
+        with stats.stage("total"):
+            stats.result = bool(_process_file(filename, output_suffix, single_pass, stats, compress))
+        stats.finish()
+        return stats.result
+    return _process_file(filename, output_suffix, single_pass, stats, compress)
+
+
+def _process_file(filename: PathLike, output_suffix, single_pass, stats, compress) -> int:
     filepath = pathlib.Path(filename)
     outfilepath = filepath
+    codec = detect_codec(filepath)
+    out_codec = codec if compress is None else None if compress == "none" else compress
+
+    if output_suffix or out_codec != codec:
+        # The suffix goes before the compression extension (part.testing.gcode.gz), which follows the output codec
+        name = filepath.name
+        if codec is not None and name.endswith(CODECS[codec][2]):
+            name = name[: -len(CODECS[codec][2])]
+        if output_suffix:
+            stem, dot, suffix = name.rpartition(".")
+            name = f"{stem}{output_suffix}.{suffix}" if dot and stem else name + output_suffix
+        if out_codec is not None:
+            name += CODECS[out_codec][2]
+        outfilepath = filepath.with_name(name)
+
+    if out_codec is not None and single_pass:
+        logger.debug("Compressed output can't be patched in place, processing in two passes")
+        single_pass = False
+
+    with _open_codec(filepath, codec, "rb") as fin:
+        if stats is not None:
+            stats.input_bytes = os.stat(filepath).st_size
+        slicer_factory = None
+        binary = bgcode.is_bgcode(fin)
+        with (stats or _NO_STATS).stage("detect"):
+            if binary:
+                # Our header is in the first G-code block, the slicer is identified when processing the decoded G-code
+                processed = _identify_slicer(io.BytesIO(bgcode.head(fin, sniff_bytes)))[1]
+            else:
+                slicer_factory, processed = _identify_slicer(fin)
+        if processed and out_codec == codec:
+            logger.info("GCode already supports cancellation")
+            if outfilepath != filepath:
+                with _AtomicFile(outfilepath) as output:
+                    _copy_file(fin, output.file)
+                    output.commit()
+            return True
+        if slicer_factory is None and not processed and not binary:
+            logger.warning("Could not identify slicer")
+            return False
+
+        output = _AtomicFile(outfilepath)
+        try:
+            with _open_codec(output.file, out_codec, "wb") as fout:
+                res = preprocessor(fin, fout, slicer_factory, single_pass=single_pass, stats=stats)
+        except BaseException:
+            output.close()
+            raise
+
+    # The input is closed first, files that are open can't be replaced on Windows
+    with output:
+        if res:
+            output.commit()
+    return res
 
-    if output_suffix:
-        outfilepath = outfilepath.with_name(outfilepath.stem + output_suffix + outfilepath.suffix)
 
-    tempfilepath = pathlib.Path(tempfile.mktemp())
+async def preprocess_file_async(
+    filename: PathLike,
+    output_suffix=None,
+    single_pass=False,
+    executor: Optional[concurrent.futures.Executor] = None,
+    compress=None,
+) -> int:
+    """Asyncio variant of process_file_for_cancellation, running it in executor (the loop's default one if None)"""
+    import asyncio
+
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        executor, process_file_for_cancellation, filename, output_suffix, single_pass, None, compress
+    )
 
-    with filepath.open("r") as fin:
-        with tempfilepath.open("w") as fout:
-            res = preprocessor(fin, fout)
 
-    if res:
-        if outfilepath.exists():
-            outfilepath.unlink()
-        shutil.move(tempfilepath, outfilepath)
+# Module settings that the command line changes, worker processes need them too
+_SETTINGS = (
+    "precision",
+    "block_size",
+    "header_reserve",
+    "scan_threads",
+    "raster_hulls",
+    "sniff_bytes",
+    "simplify_tolerance",
+    "shapely_cross_check",
+    "shapely",
+    "cache_dir",
+    "cache_size",
+)
+
+
+def _get_settings():
+    settings = {name: globals()[name] for name in _SETTINGS}
+    # Modules can't be pickled, just remember whether shapely was disabled
+    settings["shapely"] = shapely is not False
+    # Spawned workers don't inherit the logging configuration of _main
+    settings["log_level"] = logger.getEffectiveLevel()
+    return settings
+
+
+def _apply_settings(settings):
+    for name, value in settings.items():
+        if name == "shapely":
+            if not value:
+                globals()["shapely"] = False
+        elif name == "log_level":
+            logger.setLevel(value)
+        else:
+            globals()[name] = value
+
+
+def _process_file_job(filename, output_suffix, single_pass, collect_stats, compress=None):
+    """Process pool job, returns the result, the log records and the stats as a dict (if collected)"""
+    import logging.handlers
+    import queue
+
+    records = queue.SimpleQueue()
+    handler = logging.handlers.QueueHandler(records)
+    logger.addHandler(handler)
+    logger.propagate = False
+    stats = Stats() if collect_stats else None
+    try:
+        res = process_file_for_cancellation(
+            filename, output_suffix, single_pass=single_pass, stats=stats, compress=compress
+        )
+    except Exception:
+        logger.exception("Failed to process %s", filename)
+        res = False
+    finally:
+        logger.removeHandler(handler)
+        logger.propagate = True
+
+    logs = []
+    while not records.empty():
+        logs.append(records.get())
+    return res, logs, stats.as_dict() if stats is not None else None
+
+
+def _process_pool(jobs):
+    """Pool of worker processes using the settings of this one"""
+    import concurrent.futures
+
+    return concurrent.futures.ProcessPoolExecutor(
+        max_workers=jobs, initializer=_apply_settings, initargs=(_get_settings(),)
+    )
 
+
+def _process_files_parallel(filenames, jobs, output_suffix, single_pass, stats_output=None, compress=None) -> bool:
+    """Process files in a process pool, returns False if any of them failed"""
+    import concurrent.futures
+
+    def size(filename):
+        try:
+            return os.path.getsize(filename)
+        except OSError:
+            return 0
+
+    # Large files go first, so that the workers finish at about the same time
+    filenames = sorted(filenames, key=size, reverse=True)
+    success = True
+    with _process_pool(jobs) as executor:
+        futures = [
+            executor.submit(
+                _process_file_job, filename, output_suffix, single_pass, stats_output is not None, compress
+            )
+            for filename in filenames
+        ]
+        for future in concurrent.futures.as_completed(futures):
+            res, logs, stats = future.result()
+            for record in logs:
+                logger.handle(record)
+            if stats is not None:
+                _write_stats(stats_output, stats)
+            success = success and bool(res)
+    return success
+
+
+def _write_stats(output, stats: dict):
+    """Write the stats as a JSON line to output ("-" for stderr)"""
+    import json
+
+    line = json.dumps(stats) + "\n"
+    if output == "-":
+        sys.stderr.write(line)
+        sys.stderr.flush()
     else:
-        tempfilepath.unlink()
+        with open(output, "a") as f:
+            f.write(line)
 
-    return res
+
+def _is_processed(path) -> bool:
+    """Whether the file already supports cancellation, only its head is sniffed (like _identify_slicer does first)"""
+    with _open_codec(path, detect_codec(path), "rb") as f:
+        if bgcode.is_bgcode(f):
+            f = io.BytesIO(bgcode.head(f, sniff_bytes))
+        return _identify_matches(_sniff_matches(f, _identify_parser(), 0, sniff_bytes))[1]
+
+
+def _daemon():
+    # The daemon and the watcher are given this module, which may be running as __main__
+    import preprocess_cancellation_daemon
+
+    return preprocess_cancellation_daemon
+
+
+def _print_objects(filename, as_json) -> bool:
+    objects = scan_objects(filename)
+    if as_json:
+        import json
+
+        listed = None if objects is None else [o.as_dict() for o in objects]
+        print(json.dumps({"file": str(filename), "objects": listed}))
+    elif objects is not None:
+        print(f"{filename}: {len(objects)} objects")
+        for o in objects:
+            print(f"  {o.name} center {o.center.x:0.3f},{o.center.y:0.3f} extrusions {o.extrusions}")
+    return objects is not None
+
+
+def _process_files(args, stats_output) -> bool:
+    if args.jobs > 1 and len(args.gcode) > 1:
+        return _process_files_parallel(
+            args.gcode, args.jobs, args.output_suffix, args.single_pass, stats_output, args.compress
+        )
+
+    success = True
+    for filename in args.gcode:
+        stats = Stats() if stats_output is not None else None
+        if not process_file_for_cancellation(
+            filename, args.output_suffix, single_pass=args.single_pass, stats=stats, compress=args.compress
+        ):
+            success = False
+        if stats is not None:
+            _write_stats(stats_output, stats.as_dict())
+    return success
 
 
 def _main():
+    import argparse
+
+    logging.basicConfig(stream=sys.stderr, level=logging.INFO)
+    if not native_engine:
+        logger.info("The native extension is not available, using the pure-Python engine")
     argparser = argparse.ArgumentParser()
     argparser.add_argument(
         "--output-suffix",
@@ -417,7 +1898,70 @@ def _main():
         help="Add a suffix to gcoode output. Without this, gcode will be rewritten in place",
     )
     argparser.add_argument(
-        "--disable-shapely", help="Disable using shapely to generate a hull polygon for objects", action="store_true"
+        "--disable-shapely", help="Disable using shapely, hull polygons are computed without it", action="store_true"
+    )
+    argparser.add_argument(
+        "--shapely-cross-check",
+        help="Compare the hull polygons with the ones computed by shapely and warn about differences",
+        action="store_true",
+    )
+    argparser.add_argument(
+        "--single-pass",
+        help="Read the input only once, reserving space for the object definitions at the start of the output",
+        action="store_true",
+    )
+    argparser.add_argument("--jobs", "-j", type=int, default=1, help="Number of files to process in parallel")
+    argparser.add_argument(
+        "--threads", type=int, default=1, help="Number of threads scanning each (large) file in parallel chunks"
+    )
+    argparser.add_argument(
+        "--raster-hulls",
+        help="Collect object footprints in occupancy rasters, bounding the memory use by the printed area",
+        action="store_true",
+    )
+    argparser.add_argument(
+        "--cache",
+        nargs="?",
+        const=pathlib.Path.home() / ".cache" / "preprocess_cancellation",
+        type=pathlib.Path,
+        metavar="DIR",
+        help="Cache the scan results of files by their content (in ~/.cache/preprocess_cancellation by default)",
+    )
+    argparser.add_argument("--cache-size", type=int, default=64, help="Cache size limit in MiB")
+    argparser.add_argument(
+        "--stats", help="Write processing statistics of each file as a JSON line to stderr", action="store_true"
+    )
+    argparser.add_argument("--stats-file", help="Append the processing statistics to a file instead")
+    argparser.add_argument(
+        "--compress",
+        choices=[*CODECS, "none"],
+        help="Compression of the output, by default the same as the input (gzip, xz and bz2 inputs are detected)",
+    )
+    argparser.add_argument(
+        "--scan-only", help="Only list the objects of the files and their footprints, without rewriting them",
+        action="store_true",
+    )
+    argparser.add_argument("--json", help="With --scan-only, print a JSON line for each file", action="store_true")
+    argparser.add_argument(
+        "--serve",
+        metavar="SOCKET",
+        help="Run as a daemon processing files for clients connecting to the Unix socket, with --jobs workers",
+    )
+    argparser.add_argument(
+        "--watch",
+        metavar="DIR",
+        help="Keep processing the G-code files that appear in the directory in place, with --jobs workers",
+    )
+    argparser.add_argument(
+        "--settle",
+        type=float,
+        default=2.0,
+        help="Seconds for which a watched file must not change to be considered complete",
+    )
+    argparser.add_argument(
+        "--connect",
+        metavar="SOCKET",
+        help="Let the daemon on the Unix socket process the files (they are processed here if it is not running)",
     )
     argparser.add_argument("gcode", nargs="*")
 
@@ -426,10 +1970,45 @@ def _main():
     args = argparser.parse_args()
     if args.disable_shapely:
         global shapely
-        shapely = None
-
-    for filename in args.gcode:
-        if not process_file_for_cancellation(filename, args.output_suffix):
+        shapely = False
+    if args.shapely_cross_check:
+        global shapely_cross_check
+        shapely_cross_check = True
+    global scan_threads, raster_hulls
+    scan_threads = args.threads
+    raster_hulls = args.raster_hulls
+    global cache_dir, cache_size
+    cache_dir = args.cache
+    cache_size = args.cache_size << 20
+
+    if args.json and not args.scan_only:
+        argparser.error("--json requires --scan-only")
+
+    stats_output = args.stats_file or ("-" if args.stats else None)
+    if args.serve:
+        if not _daemon().serve(sys.modules[__name__], args.serve, args.jobs):
+            exitcode = 1
+    elif args.watch:
+        _daemon().watch(
+            sys.modules[__name__], args.watch, args.jobs, args.output_suffix, args.single_pass, stats_output,
+            args.compress, args.settle
+        )
+    elif args.scan_only:
+        for filename in args.gcode:
+            if not _print_objects(filename, args.json):
+                exitcode = 1
+    else:
+        res = None
+        if args.connect and args.gcode:
+            res = _daemon().client(
+                sys.modules[__name__], args.connect, args.gcode, args.output_suffix, args.single_pass, stats_output,
+                args.compress
+            )
+            if res is None:
+                logger.warning("No daemon on %s, processing the files here", args.connect)
+        if res is None:
+            res = _process_files(args, stats_output)
+        if not res:
             exitcode = 1
 
     sys.exit(exitcode)
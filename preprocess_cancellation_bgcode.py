@@ -0,0 +1,196 @@
+"""Binary G-code (.bgcode) container of preprocess_cancellation, a sequence of checksummed blocks"""
+import struct
+import zlib
+from typing import Dict, NamedTuple, Optional
+
+try:
+    from preprocess_cancellation_cext import heatshrink_decode, heatshrink_encode, meatpack_decode, meatpack_encode
+except ImportError:
+    from preprocess_cancellation_pyext import heatshrink_decode, heatshrink_encode, meatpack_decode, meatpack_encode
+
+MAGIC = b"GCDE"
+# Magic, version, checksum type
+HEADER = struct.Struct("<4sIH")
+# Type, compression, uncompressed size (followed by the compressed size if compressed)
+BLOCK = struct.Struct("<HHI")
+SIZE = struct.Struct("<I")
+PARAMETER = struct.Struct("<H")
+CRC32 = 1
+FILE_METADATA = 0
+GCODE = 1
+THUMBNAIL = 5
+DEFLATE = 1
+# Compression types using heatshrink: (window bits, lookahead bits)
+HEATSHRINK = {2: (11, 4), 3: (12, 4)}
+MEATPACK = (1, 2)
+MEATPACK_COMMENTS = 2
+# PrusaSlicer writes G-code blocks of 64 KiB
+GCODE_BLOCK = 64 * 1024
+
+
+class Block(NamedTuple):
+    offset: int
+    # The whole block, including the header and the checksum
+    size: int
+    type: int
+    compression: int
+    uncompressed_size: int
+    # Offset and size of the (possibly compressed) data
+    data_offset: int
+    data_size: int
+    encoding: int
+
+
+def is_bgcode(infile) -> bool:
+    infile.seek(0)
+    magic = infile.read(len(MAGIC))
+    infile.seek(0)
+    return magic == MAGIC
+
+
+def read_header(infile) -> bytes:
+    header = infile.read(HEADER.size)
+    _, version, _ = HEADER.unpack(header)
+    if version != 1:
+        raise ValueError(f"Unsupported binary G-code version {version}")
+    return header
+
+
+def checksum_type(header: bytes) -> int:
+    return HEADER.unpack(header)[2]
+
+
+def blocks(infile, checksum_type):
+    """Block headers following the file header, seeking over the block data"""
+    offset = infile.tell()
+    while True:
+        header = infile.read(BLOCK.size)
+        if not header:
+            return
+        if len(header) < BLOCK.size:
+            raise ValueError(f"Truncated binary G-code block at offset {offset}")
+        type, compression, uncompressed_size = BLOCK.unpack(header)
+        header_size = BLOCK.size
+        data_size = uncompressed_size
+        if compression:
+            (data_size,) = SIZE.unpack(infile.read(SIZE.size))
+            header_size += SIZE.size
+        parameters = infile.read(6 if type == THUMBNAIL else PARAMETER.size)
+        (encoding,) = PARAMETER.unpack(parameters[: PARAMETER.size])
+        data_offset = offset + header_size + len(parameters)
+        size = data_offset + data_size - offset + (SIZE.size if checksum_type == CRC32 else 0)
+        yield Block(offset, size, type, compression, uncompressed_size, data_offset, data_size, encoding)
+        offset += size
+        infile.seek(offset)
+
+
+def decode(infile, block: Block, checksum_type) -> bytes:
+    """Data of a block (the text of G-code and INI metadata blocks), checking the block checksum"""
+    infile.seek(block.offset)
+    raw = infile.read(block.size)
+    if len(raw) < block.size:
+        raise ValueError(f"Truncated binary G-code block at offset {block.offset}")
+    if checksum_type == CRC32:
+        (crc,) = SIZE.unpack(raw[-SIZE.size :])
+        if zlib.crc32(raw[: -SIZE.size]) != crc:
+            raise ValueError(f"Checksum mismatch in binary G-code block at offset {block.offset}")
+
+    start = block.data_offset - block.offset
+    data = raw[start : start + block.data_size]
+    if block.compression == DEFLATE:
+        data = zlib.decompress(data)
+    elif block.compression in HEATSHRINK:
+        data = heatshrink_decode(data, *HEATSHRINK[block.compression], block.uncompressed_size)
+    elif block.compression:
+        raise ValueError(f"Unknown binary G-code compression {block.compression}")
+
+    if block.encoding in MEATPACK:
+        data = meatpack_decode(data)
+    elif block.encoding:
+        raise ValueError(f"Unknown binary G-code encoding {block.encoding}")
+    return data
+
+
+def encode(text: bytes, compression, encoding, checksum_type) -> bytes:
+    """G-code block with the text, encoded and compressed like the input blocks"""
+    data = text
+    if encoding in MEATPACK:
+        try:
+            data = meatpack_encode(text)
+        except ValueError:
+            encoding = 0
+        else:
+            # Our header is made of comments, even if the slicer stripped its own
+            if b";" in text:
+                encoding = MEATPACK_COMMENTS
+
+    payload = data
+    if compression == DEFLATE:
+        payload = zlib.compress(data)
+    elif compression in HEATSHRINK:
+        payload = heatshrink_encode(data, *HEATSHRINK[compression])
+
+    block = BLOCK.pack(GCODE, compression, len(data))
+    if compression:
+        block += SIZE.pack(len(payload))
+    block += PARAMETER.pack(encoding) + payload
+    if checksum_type == CRC32:
+        block += SIZE.pack(zlib.crc32(block))
+    return block
+
+
+def metadata(infile, block: Block, checksum_type) -> Dict[str, str]:
+    pairs = {}
+    for line in decode(infile, block, checksum_type).decode("utf-8", "replace").splitlines():
+        key, equals, value = line.partition("=")
+        if equals:
+            pairs[key.strip()] = value.strip()
+    return pairs
+
+
+def producer(infile, blocks, checksum_type) -> Optional[str]:
+    """Producer of the file metadata, e.g. "PrusaSlicer 2.7.0" """
+    for block in blocks:
+        if block.type == FILE_METADATA:
+            return metadata(infile, block, checksum_type).get("Producer")
+    return None
+
+
+def split_text(infile):
+    """Split the text into G-code blocks at line boundaries"""
+    rest = b""
+    while True:
+        data = rest + infile.read(GCODE_BLOCK - len(rest))
+        if not data:
+            return
+        cut = len(data)
+        if cut == GCODE_BLOCK:
+            cut = data.rfind(b"\n") + 1 or cut
+        yield data[:cut]
+        rest = data[cut:]
+
+
+def extract(infile, gcode):
+    """Decode the G-code of infile into gcode (rewound), returns the file header and the blocks"""
+    header = read_header(infile)
+    all_blocks = list(blocks(infile, checksum_type(header)))
+    for block in all_blocks:
+        if block.type == GCODE:
+            gcode.write(decode(infile, block, checksum_type(header)))
+    gcode.seek(0)
+    return header, all_blocks
+
+
+def head(infile, size) -> bytes:
+    """The first size bytes (at least) of the G-code of infile, decoding only the blocks needed"""
+    checksum = checksum_type(read_header(infile))
+    texts = []
+    length = 0
+    for block in blocks(infile, checksum):
+        if block.type == GCODE:
+            texts.append(decode(infile, block, checksum))
+            length += len(texts[-1])
+            if length >= size:
+                break
+    infile.seek(0)
+    return b"".join(texts)
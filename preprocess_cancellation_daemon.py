@@ -0,0 +1,401 @@
+"""The --serve daemon, its --connect client and the --watch mode of preprocess_cancellation"""
+from __future__ import annotations
+
+import errno
+import json
+import logging
+import os
+import pathlib
+import struct
+import sys
+import time
+from typing import Dict, List, Optional, Set, Tuple
+
+# The logger of preprocess_cancellation
+logger = logging.getLogger("prepropress_cancellation")
+
+# core is the preprocess_cancellation module, as loaded by the command line
+
+
+class Server:
+    """Daemon processing files for the clients connected to a Unix socket, one JSON line per request and response"""
+
+    # Requests have an "id", the absolute path of the "file", "output_suffix", "single_pass", "compress" and "stats".
+    # Responses (out of order) the same "id" and "file", the "status", an "error" or the "log" and the "stats".
+
+    def __init__(self, core, jobs):
+        self.core = core
+        self.jobs = jobs
+        self.executor = core._process_pool(jobs)
+
+    async def job(self, request: dict) -> dict:
+        import asyncio
+        import concurrent.futures
+
+        response = {"id": request.get("id"), "file": request.get("file")}
+        filename = request.get("file")
+        if not isinstance(filename, str) or not os.path.isabs(filename):
+            return {**response, "status": "error", "error": "file must be an absolute path"}
+        compress = request.get("compress")
+        if compress is not None and compress not in self.core.CODECS and compress != "none":
+            return {**response, "status": "error", "error": f"unknown compression {compress}"}
+
+        executor = self.executor
+        start = time.perf_counter()
+        try:
+            res, records, stats = await asyncio.get_running_loop().run_in_executor(
+                executor,
+                self.core._process_file_job,
+                filename,
+                request.get("output_suffix"),
+                bool(request.get("single_pass")),
+                bool(request.get("stats")),
+                compress,
+            )
+        except concurrent.futures.process.BrokenProcessPool:
+            logger.error("Worker died while processing %s", filename)
+            # Other jobs of the broken pool fail as well, only one of them replaces it
+            if self.executor is executor:
+                self.executor = self.core._process_pool(self.jobs)
+                executor.shutdown(wait=False)
+            return {**response, "status": "error", "error": "worker process died"}
+
+        for record in records:
+            logger.handle(record)
+        status = "processed" if res else "failed"
+        logger.info("%s %s in %0.2fs", filename, status, time.perf_counter() - start)
+        return {
+            **response,
+            "status": status,
+            "log": [[record.levelno, record.getMessage()] for record in records],
+            "stats": stats,
+        }
+
+    async def connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        import asyncio
+
+        lock = asyncio.Lock()
+
+        async def answer(request):
+            response = await self.job(request) if isinstance(request, dict) else {
+                "id": None, "status": "error", "error": "invalid request"
+            }
+            async with lock:
+                writer.write(json.dumps(response).encode() + b"\n")
+                await writer.drain()
+
+        tasks = []
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                except ValueError:
+                    request = None
+                tasks.append(asyncio.ensure_future(answer(request)))
+            await asyncio.gather(*tasks)
+        except ConnectionError:
+            # The jobs still finish, the client just does not learn about it
+            logger.warning("Client disconnected")
+        finally:
+            writer.close()
+
+    async def serve(self, socket_path):
+        import asyncio
+        import signal
+        import socket
+
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, stop.set)
+
+        # Only the user may connect, the socket is made private before it listens
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.bind(str(socket_path))
+            os.chmod(socket_path, 0o600)
+        except BaseException:
+            sock.close()
+            raise
+        server = await asyncio.start_unix_server(self.connection, sock=sock)
+        logger.info("Serving on %s with %d workers", socket_path, self.jobs)
+        try:
+            async with server:
+                await stop.wait()
+        finally:
+            os.unlink(socket_path)
+            self.executor.shutdown()
+
+
+def serve(core, socket_path, jobs) -> bool:
+    """Run the daemon until it is interrupted, returns False if the socket is in use"""
+    if os.path.exists(socket_path):
+        # Left over from a daemon that did not exit cleanly?
+        sock = connect(socket_path)
+        if sock is not None:
+            sock.close()
+            logger.error("Another daemon is serving on %s", socket_path)
+            return False
+        os.unlink(socket_path)
+    import asyncio
+
+    asyncio.run(Server(core, jobs).serve(socket_path))
+    return True
+
+
+def connect(socket_path):
+    import socket
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(str(socket_path))
+    except OSError:
+        sock.close()
+        return None
+    return sock
+
+
+def client(core, socket_path, filenames, output_suffix, single_pass, stats_output, compress) -> Optional[bool]:
+    """Let the daemon process the files, returns None if none is listening on socket_path"""
+    sock = connect(socket_path)
+    if sock is None:
+        return None
+
+    success = True
+    with sock, sock.makefile("rwb") as stream:
+        for i, filename in enumerate(filenames):
+            request = {
+                "id": i,
+                # The daemon reads the file directly, its working directory may differ
+                "file": os.path.abspath(filename),
+                "output_suffix": output_suffix,
+                "single_pass": single_pass,
+                "compress": compress,
+                "stats": stats_output is not None,
+            }
+            stream.write(json.dumps(request).encode() + b"\n")
+        stream.flush()
+
+        for _ in filenames:
+            line = stream.readline()
+            if not line:
+                logger.error("The daemon closed the connection")
+                return False
+            response = json.loads(line)
+            for level, message in response.get("log", ()):
+                logger.log(level, "%s", message)
+            if response["status"] == "error":
+                logger.error("Could not process %s: %s", response["file"], response["error"])
+            if response.get("stats") is not None:
+                core._write_stats(stats_output, response["stats"])
+            success = success and response["status"] == "processed"
+    return success
+
+
+class Inotify:
+    """New and replaced files of a directory, reported by inotify (called through ctypes)"""
+
+    _IN_CLOSE_WRITE = 0x8
+    _IN_MOVED_TO = 0x80
+    _EVENT = struct.Struct("iIII")
+
+    def __init__(self, directory):
+        import ctypes
+        import ctypes.util
+
+        if not sys.platform.startswith("linux"):
+            raise OSError(errno.ENOSYS, "inotify is only available on Linux")
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory), self._IN_CLOSE_WRITE | self._IN_MOVED_TO) < 0:
+            err = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(err, f"Can't watch {directory}")
+
+    def read(self, timeout) -> List[str]:
+        """Names of the files written or moved into the directory, waits up to timeout seconds for them"""
+        import select
+
+        select.select([self.fd], [], [], timeout)
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        names = []
+        offset = 0
+        while offset < len(data):
+            _, _, _, length = self._EVENT.unpack_from(data, offset)
+            offset += self._EVENT.size
+            names.append(os.fsdecode(data[offset : offset + length].rstrip(b"\0")))
+            offset += length
+        return names
+
+    def close(self):
+        os.close(self.fd)
+
+
+# Extensions of the files picked up by --watch, possibly followed by the extension of a codec
+WATCH_EXTENSIONS = (".gcode", ".gco", ".g", ".bgcode")
+
+
+class Watcher:
+    """Processes the files that appear in a directory once they did not change for settle seconds, smallest first"""
+
+    def __init__(self, core, directory, jobs, output_suffix, single_pass, stats_output, compress, settle):
+        self.core = core
+        self.directory = pathlib.Path(directory)
+        self.jobs = jobs
+        self.output_suffix = output_suffix
+        self.single_pass = single_pass
+        self.stats_output = stats_output
+        self.compress = compress
+        self.settle = settle
+        # Files that are changing: name -> (size, mtime), time of the last change
+        self.pending: Dict[str, Tuple[Tuple[int, int], float]] = {}
+        # Size and mtime of the files that were dealt with, including our own output
+        self.done: Dict[str, Tuple[int, int]] = {}
+        self.queue: List[Tuple[int, str]] = []
+        self.queued: Set[str] = set()
+        self.running: Dict[concurrent.futures.Future, str] = {}
+        try:
+            self.inotify = Inotify(self.directory)
+        except (OSError, AttributeError) as e:
+            logger.info("Polling %s, inotify is not available: %s", self.directory, e)
+            self.inotify = None
+        self.executor = core._process_pool(jobs)
+
+    def _wanted(self, name) -> bool:
+        if name.startswith("."):
+            # Hidden files, including the temporary outputs
+            return False
+        for codec in self.core.CODECS.values():
+            if name.endswith(codec[2]):
+                name = name[: -len(codec[2])]
+        stem, ext = os.path.splitext(name)
+        if self.output_suffix and stem.endswith(self.output_suffix):
+            return False
+        return ext.lower() in WATCH_EXTENSIONS
+
+    def _stat(self, name) -> Optional[Tuple[int, int]]:
+        try:
+            st = os.stat(self.directory / name)
+        except FileNotFoundError:
+            return None
+        return st.st_size, st.st_mtime_ns
+
+    def _changed(self):
+        """Names of the files that may have changed since the last call"""
+        if self.inotify is not None:
+            return self.inotify.read(min(1.0, self.settle))
+        time.sleep(min(1.0, self.settle))
+        with os.scandir(self.directory) as entries:
+            return [
+                entry.name for entry in entries if entry.name not in self.pending and entry.name not in self.queued
+            ]
+
+    def step(self, changed):
+        import heapq
+
+        now = time.monotonic()
+        for name in changed:
+            if self._wanted(name) and name not in self.pending:
+                self.pending[name] = (None, now)
+
+        for future in [future for future in self.running if future.done()]:
+            self._finished(self.running.pop(future), future)
+
+        busy = set(self.running.values())
+        for name, (stat, since) in list(self.pending.items()):
+            current = self._stat(name)
+            if current is None or current == self.done.get(name):
+                del self.pending[name]
+            elif current != stat:
+                self.pending[name] = (current, now)
+            elif now - since >= self.settle and name not in busy:
+                del self.pending[name]
+                self._enqueue(name, current)
+
+        while self.queue and len(self.running) < self.jobs:
+            _, name = heapq.heappop(self.queue)
+            self.queued.discard(name)
+            future = self.executor.submit(
+                self.core._process_file_job,
+                self.directory / name,
+                self.output_suffix,
+                self.single_pass,
+                self.stats_output is not None,
+                self.compress,
+            )
+            self.running[future] = name
+
+    def _enqueue(self, name, stat):
+        try:
+            processed = self.core._is_processed(self.directory / name)
+        except (OSError, EOFError, ValueError) as e:
+            logger.warning("Can't read %s: %s", name, e)
+            processed = False
+        if processed:
+            logger.debug("%s is already processed", name)
+            self.done[name] = stat
+        elif name not in self.queued:
+            import heapq
+
+            heapq.heappush(self.queue, (stat[0], name))
+            self.queued.add(name)
+
+    def _finished(self, name, future):
+        import concurrent.futures
+
+        try:
+            res, records, stats = future.result()
+        except concurrent.futures.process.BrokenProcessPool:
+            logger.error("Worker died while processing %s", name)
+            self.executor.shutdown(wait=False)
+            self.executor = self.core._process_pool(self.jobs)
+            res, records, stats = False, [], None
+        for record in records:
+            logger.handle(record)
+        if stats is not None:
+            self.core._write_stats(self.stats_output, stats)
+        logger.info("%s %s", name, "processed" if res else "failed")
+        # Do not pick up the result (or a file that failed) again, unless it changes
+        current = self._stat(name)
+        if current is not None:
+            self.done[name] = current
+
+    def stop(self, *_):
+        self.stopped = True
+
+    def run(self):
+        with os.scandir(self.directory) as entries:
+            existing = [entry.name for entry in entries if entry.is_file()]
+        logger.info("Watching %s", self.directory)
+        self.stopped = False
+        try:
+            self.step(existing)
+            while not self.stopped:
+                self.step(self._changed())
+        finally:
+            for future in self.running:
+                future.cancel()
+            self.executor.shutdown()
+            if self.inotify is not None:
+                self.inotify.close()
+
+
+def watch(core, directory, jobs, output_suffix, single_pass, stats_output, compress, settle):
+    import signal
+
+    watcher = Watcher(core, directory, jobs, output_suffix, single_pass, stats_output, compress, settle)
+    # Finish the running jobs on SIGTERM
+    signal.signal(signal.SIGTERM, watcher.stop)
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        pass
+    logger.info("Stopped watching %s", directory)
@@ -0,0 +1,750 @@
+"""Pure-Python implementation of the preprocess_cancellation_cext extension, used when it is not available"""
+# Same API and results as ext/. Whole buffers are scanned by regular expressions, only unusual lines are parsed alone.
+import array
+import math
+import re
+import struct
+from typing import Dict, List, Optional, Tuple
+
+_MATCH = struct.Struct("=qqq")
+# Whitespace as in C isspace(), but without the line end
+_SPACE = rb"[ \t\v\f\r]"
+
+# Fold the pending points once there is this many of them (plus the hull size, to keep folding amortized)
+_FOLD_THRESHOLD = 4096
+
+
+def _round(value: float) -> int:
+    """C round(), halfway cases away from zero"""
+    whole = int(value)
+    if abs(value - whole) >= 0.5:
+        return whole + 1 if value > 0 else whole - 1
+    return whole
+
+
+class Point:
+    __slots__ = ("x", "y")
+
+    def __init__(self, x: float, y: float):
+        self.x = float(x)
+        self.y = float(y)
+
+
+def _pack(points: List[Point]) -> bytes:
+    return array.array("d", [c for p in points for c in (p.x, p.y)]).tobytes()
+
+
+def _cross(o, a, b) -> int:
+    return (a[0] - o[0]) * (b[1] - o[1]) - (a[1] - o[1]) * (b[0] - o[0])
+
+
+def _convex_hull(points) -> List[Tuple[int, int]]:
+    """Andrew's monotone chain, counter-clockwise without collinear points"""
+    points = sorted(set(points))
+    if len(points) < 3:
+        return points
+
+    hull = []
+    for p in points:
+        while len(hull) >= 2 and _cross(hull[-2], hull[-1], p) <= 0:
+            hull.pop()
+        hull.append(p)
+    lower_size = len(hull) + 1
+    for p in reversed(points[:-1]):
+        while len(hull) >= lower_size and _cross(hull[-2], hull[-1], p) <= 0:
+            hull.pop()
+        hull.append(p)
+    # The first point is repeated at the end
+    hull.pop()
+    return hull
+
+
+def _row_spans(cells) -> List[Tuple[int, int, int]]:
+    """(y, xmin, xmax) of each non-empty row, sorted by y"""
+    rows: Dict[int, List[int]] = {}
+    for x, y in cells:
+        span = rows.get(y)
+        if span is None:
+            rows[y] = [x, x]
+        elif x < span[0]:
+            span[0] = x
+        elif x > span[1]:
+            span[1] = x
+    return [(y, xmin, xmax) for y, (xmin, xmax) in sorted(rows.items())]
+
+
+def _distance(a: Point, b: Point) -> float:
+    return ((a.x - b.x) ** 2 + (a.y - b.y) ** 2) ** 0.5
+
+
+def _point_to_segment(p: Point, a: Point, b: Point) -> float:
+    if a.x == b.x and a.y == b.y:
+        return _distance(p, a)
+    len2 = (b.x - a.x) * (b.x - a.x) + (b.y - a.y) * (b.y - a.y)
+    r = ((p.x - a.x) * (b.x - a.x) + (p.y - a.y) * (b.y - a.y)) / len2
+    if r <= 0.0:
+        return _distance(p, a)
+    if r >= 1.0:
+        return _distance(p, b)
+    s = ((a.y - p.y) * (b.x - a.x) - (a.x - p.x) * (b.y - a.y)) / len2
+    return abs(s) * len2 ** 0.5
+
+
+def _simplify_section(points, use, i, j, tolerance):
+    if i + 1 >= j:
+        return
+    max_distance = -1.0
+    max_index = i
+    for k in range(i + 1, j):
+        d = _point_to_segment(points[k], points[i], points[j])
+        if d > max_distance:
+            max_distance = d
+            max_index = k
+    if max_distance <= tolerance:
+        for k in range(i + 1, j):
+            use[k] = False
+    else:
+        _simplify_section(points, use, i, max_index, tolerance)
+        _simplify_section(points, use, max_index, j, tolerance)
+
+
+def _simplify_ring(ring: List[Point], tolerance: float) -> List[Point]:
+    """Douglas-Peucker, including the simplification of the ring endpoint"""
+    if len(ring) < 4:
+        return ring
+    use = [True] * len(ring)
+    _simplify_section(ring, use, 0, len(ring) - 1, tolerance)
+    simplified = [p for p, used in zip(ring, use) if used]
+    if len(simplified) >= 4 and _point_to_segment(simplified[0], simplified[1], simplified[-2]) <= tolerance:
+        del simplified[0]
+        simplified[-1] = simplified[0]
+    return simplified
+
+
+def _ring_centroid(ring: List[Point]) -> Point:
+    """Area centroid, computed from triangles fanning out of the first point"""
+    if len(ring) < 4:
+        cx = cy = 0.0
+        for p in ring:
+            cx += p.x / len(ring)
+            cy += p.y / len(ring)
+        return Point(cx, cy)
+
+    base = ring[0]
+    cx = cy = areasum2 = 0.0
+    for p1, p2 in zip(ring, ring[1:]):
+        # Clockwise rings have positive area
+        a2 = -((p1.x - base.x) * (p2.y - base.y) - (p2.x - base.x) * (p1.y - base.y))
+        cx += a2 * (base.x + p1.x + p2.x)
+        cy += a2 * (base.y + p1.y + p2.y)
+        areasum2 += a2
+    return Point(cx / 3 / areasum2, cy / 3 / areasum2)
+
+
+class Hull:
+    """Points rounded to a grid of precision, folded into their convex hull (see ext/hull.h)"""
+
+    def __init__(self, raster: bool = False):
+        self._raster = bool(raster)
+        self.precision = 1.0
+        self._added = 0
+        # Points not yet folded into the hull
+        self._points = set()
+        self._cells = set()
+        # The hull includes all the cells
+        self._raster_folded = True
+        self._hull: List[Tuple[int, int]] = []
+
+    @property
+    def raster(self) -> bool:
+        return self._raster
+
+    @property
+    def points_added(self) -> int:
+        return self._added
+
+    @points_added.setter
+    def points_added(self, added: int):
+        self._added = int(added)
+
+    @property
+    def cells(self) -> int:
+        return len(self._cells)
+
+    def _add_points(self, points):
+        """Add (x, y) float coordinates"""
+        precision = self.precision
+        rounded = [(_round(x / precision), _round(y / precision)) for x, y in points]
+        self._added += len(rounded)
+        if self._raster:
+            self._cells.update(rounded)
+            self._raster_folded = False
+            return
+        self._points.update(rounded)
+        if len(self._points) >= _FOLD_THRESHOLD + len(self._hull):
+            self._fold()
+
+    def _fold(self):
+        if self._raster:
+            if not self._raster_folded:
+                extremes = []
+                for y, xmin, xmax in _row_spans(self._cells):
+                    extremes += [(xmin, y), (xmax, y)]
+                self._hull = _convex_hull(extremes)
+                self._raster_folded = True
+        elif self._points:
+            self._points.update(self._hull)
+            self._hull = _convex_hull(self._points)
+            self._points = set()
+
+    def _float_points(self) -> List[Point]:
+        self._fold()
+        precision = self.precision
+        return [Point(x * precision, y * precision) for x, y in self._hull]
+
+    @property
+    def points(self) -> List[Point]:
+        return self._float_points()
+
+    @points.setter
+    def points(self, points):
+        if not isinstance(points, list):
+            raise TypeError(f'the points member must be set to a list of Point objects, not a "{type(points).__name__}"')
+        if not all(isinstance(p, Point) for p in points):
+            raise TypeError("the points member must be set to a list of Point objects")
+        self._hull = []
+        self._cells = set()
+        self._raster_folded = True
+        self._points = set()
+        self._add_points([(p.x, p.y) for p in points])
+
+    def bounding_box(self) -> Optional[Tuple[float, float, float, float]]:
+        points = self._float_points()
+        if not points:
+            return None
+        xs = [p.x for p in points]
+        ys = [p.y for p in points]
+        return min(xs), min(ys), max(xs), max(ys)
+
+    def point_bytes(self) -> bytes:
+        return _pack(self._float_points())
+
+    def _ring(self) -> List[Point]:
+        """Closed clockwise ring starting at the lowest point (leftmost of those), like the GEOS convex hull"""
+        ccw = self._float_points()
+        if len(ccw) < 3:
+            return ccw
+        lowest = min(range(len(ccw)), key=lambda i: (ccw[i].y, ccw[i].x))
+        return [ccw[(lowest - i) % len(ccw)] for i in range(len(ccw) + 1)]
+
+    def _outline(self) -> List[Point]:
+        if not self._raster:
+            return self._ring()
+        spans = _row_spans(self._cells)
+        precision = self.precision
+        ring = [Point(xmin * precision, y * precision) for y, xmin, _ in spans]
+        ring += [
+            Point(xmax * precision, y * precision)
+            for y, xmin, xmax in reversed(spans)
+            if xmax != xmin or len(spans) == 1
+        ]
+        if ring:
+            ring.append(ring[0])
+        return ring
+
+    def convex_hull(self) -> bytes:
+        return _pack(self._ring())
+
+    def simplify(self, tolerance: float) -> bytes:
+        return _pack(_simplify_ring(self._ring(), tolerance))
+
+    def centroid(self, tolerance: float = 0) -> Optional[Point]:
+        ring = _simplify_ring(self._ring(), tolerance)
+        if not ring:
+            return None
+        return _ring_centroid(ring)
+
+    def outline(self, tolerance: float = 0) -> bytes:
+        return _pack(_simplify_ring(self._outline(), tolerance))
+
+    def merge(self, other: "Hull"):
+        if not isinstance(other, Hull):
+            raise TypeError(f"argument 1 must be Hull, not {type(other).__name__}")
+        if other is self:
+            return
+        other._fold()
+        added = self._added + other._added
+        if other.precision == self.precision and self._raster and other._raster:
+            self._cells.update(other._cells)
+            self._raster_folded = False
+        elif other.precision == self.precision and not self._raster:
+            self._points.update(other._hull)
+            if len(self._points) >= _FOLD_THRESHOLD + len(self._hull):
+                self._fold()
+        else:
+            self._add_points([(x * other.precision, y * other.precision) for x, y in other._hull])
+        self._added = added
+
+
+# A number the way parseNumber in ext/number.h reads it (without exponent, E is an axis), possibly followed by junk
+# that it ignores. The group is empty if there is no number.
+_NUMBER = rb"((?:[-+]?(?:[0-9]+(?:\.[0-9]*)?|\.[0-9]+))?)[-+.0-9]*"
+
+# Extrusion move candidates: lines starting with G, where the parameters are either all plain words (the X, Y and E
+# groups get the last value of each), or the rest of the line is captured for _parse_parameters
+_G_LINE = re.compile(
+    rb"^" + _SPACE + rb"*[Gg][^\s;\0]*"
+    rb"(?:(?:" + _SPACE + rb"+(?:[Xx]" + _NUMBER + rb"|[Yy]" + _NUMBER + rb"|[Ee]" + _NUMBER
+    + rb"|[A-DF-WZa-df-wz][-+.0-9]*))*" + _SPACE + rb"*(?:;[^\n]*)?$|(.+))",
+    re.M,
+)
+_PARAMETER = re.compile(rb"[;\0]|([XxYyEe])([^\s;\0]*)|[^;\0XxYyEe]+")
+_PARSE_NUMBER = re.compile(rb"[-+]?(?:[0-9]+(?:\.[0-9]*)?|\.[0-9]+)")
+
+
+def _parse_number(text: bytes) -> Optional[float]:
+    """The number at the start of text, None if there is none"""
+    number = _PARSE_NUMBER.match(text)
+    return None if number is None else float(number[0])
+
+
+def _parse_parameters(rest: bytes) -> Optional[Tuple[float, float, float]]:
+    """X, Y and E of a line that is not made of plain words, parsed exactly like the native parser does"""
+    values = {}
+    for match in _PARAMETER.finditer(rest.lstrip(b" \t\n\v\f\r")):
+        axis = match[1]
+        if axis is None:
+            if match[0] in (b";", b"\0"):
+                break
+            continue
+        values[axis.upper()] = match[2]
+    if not all(values.get(axis) for axis in (b"X", b"Y", b"E")):
+        return None
+    x, y, e = _parse_number(values[b"X"]), _parse_number(values[b"Y"]), _parse_number(values[b"E"])
+    if x is None or y is None or e is None:
+        return None
+    return x, y, e
+
+
+def _extrusions(buffer, start: int, end: int) -> List[Tuple[float, float]]:
+    """Positions of the extrusion moves of the lines in buffer[start:end], start is at a line start"""
+    points = []
+    for x, y, e, rest in _G_LINE.findall(buffer, start, end):
+        if rest:
+            parsed = _parse_parameters(rest)
+            if parsed is not None and parsed[2] > 0:
+                points.append(parsed[:2])
+        elif x and y and e and float(e) > 0:
+            points.append((float(x), float(y)))
+    # Numbers too long for a double can't be rounded to the grid
+    return [p for p in points if math.isfinite(p[0]) and math.isfinite(p[1])]
+
+
+def _count_lines(buffer, start: int, end: int) -> int:
+    if end <= start:
+        return 0
+    return buffer.count(b"\n", start, end) + (buffer[end - 1] != 0x0A)
+
+
+class GCodeParser:
+    """Finds lines starting with registered prefixes and feeds extrusion moves to the current hull
+    (see ext/gcode_parser.cxx)"""
+
+    def __init__(self):
+        self._hull: Optional[Hull] = None
+        self._interests: List[Tuple[bytes, int]] = []
+        self._markers = None
+        self._lines = 0
+
+    @property
+    def lines(self) -> int:
+        return self._lines
+
+    @property
+    def hull(self) -> Optional[Hull]:
+        return self._hull
+
+    @hull.setter
+    def hull(self, hull):
+        if hull is not None and not isinstance(hull, Hull):
+            raise TypeError(f'the hull member must be set to a Hull object, not a"{type(hull).__name__}"')
+        self._hull = hull
+
+    def register_interest(self, line_start: str, code: int):
+        self._interests.append((line_start.encode(), int(code)))
+        self._markers = None
+
+    def clear_interests(self):
+        self._interests = []
+        self._markers = None
+
+    def _marker_pattern(self):
+        """One regular expression for all the interests, the first registered one that matches wins. The lookahead and
+        the backreference skip the leading whitespace without backtracking, like the native parser."""
+        if self._markers is None and self._interests:
+            alternatives = b"|".join(b"(" + re.escape(prefix) + b")" for prefix, _ in self._interests)
+            self._markers = re.compile(rb"^(?=(" + _SPACE + rb"*))\1(?:" + alternatives + rb")", re.M | re.I)
+            # Group 1 is the whitespace
+            self._codes = [None, None] + [code for _, code in self._interests]
+        return self._markers
+
+    def _process_line(self, line: bytes) -> Optional[int]:
+        markers = self._marker_pattern()
+        match = markers.match(line) if markers is not None else None
+        if match:
+            return self._codes[match.lastindex]
+        if self._hull is not None:
+            self._hull._add_points(_extrusions(line, 0, len(line)))
+        return None
+
+    def feed_line(self, line: str) -> Optional[int]:
+        self._lines += 1
+        return self._process_line(line.encode())
+
+    def feed_buffer(self, buffer, start: int = 0, end: int = -1, max_matches: int = 0) -> bytes:
+        if not hasattr(buffer, "count"):
+            buffer = bytes(buffer)
+        size = len(buffer)
+        if end < 0 or end > size:
+            end = size
+        if start < 0 or start > end:
+            raise ValueError("start offset out of range")
+
+        matches = []
+        pos = start
+        if 0 < start < end and buffer[start - 1] != 0x0A:
+            # The patterns only match at line starts, process the rest of this line on its own
+            line_end = buffer.find(b"\n", start, end) + 1 or end
+            self._lines += 1
+            code = self._process_line(bytes(buffer[start:line_end]))
+            if code is not None:
+                matches.append((start, line_end, code))
+            pos = line_end
+
+        counted = pos
+        markers = self._marker_pattern()
+        hull = self._hull
+        if markers is not None and not (max_matches > 0 and len(matches) >= max_matches):
+            for match in markers.finditer(buffer, pos, end):
+                line_start = match.start()
+                if line_start >= end:
+                    # An empty prefix matching past the last line end
+                    break
+                if hull is not None:
+                    hull._add_points(_extrusions(buffer, pos, line_start))
+                pos = buffer.find(b"\n", match.end(), end) + 1 or end
+                matches.append((line_start, pos, self._codes[match.lastindex]))
+                if max_matches > 0 and len(matches) >= max_matches:
+                    break
+        if not (max_matches > 0 and len(matches) >= max_matches):
+            if hull is not None:
+                hull._add_points(_extrusions(buffer, pos, end))
+            pos = end
+
+        self._lines += _count_lines(buffer, counted, pos)
+        return b"".join(_MATCH.pack(*m) for m in matches)
+
+
+# A move (G0 to G3), the rest of the line up to the comment is parsed by _MOVE_PARAMETER
+_MOVE = re.compile(rb"^[ \t\r]*[Gg]([0-9]+)(?![0-9.])([^;\n]*)", re.M)
+_MOVE_PARAMETER = re.compile(rb"([XxYyZzEeFf])((?:[-+]?(?:[0-9]+\.?[0-9]*|\.[0-9]+))?)")
+_COLUMNS = {"line": "q", "command": "i", "x": "d", "y": "d", "z": "d", "e": "d", "f": "d", "object": "i"}
+_NAN = float("nan")
+
+
+class MoveTable:
+    """Moves (G0-G3) extracted from G-code, one column per field (see ext/moves.h). The columns are arrays, supporting
+    the buffer protocol."""
+
+    def __init__(self):
+        self._columns = {name: array.array(code) for name, code in _COLUMNS.items()}
+        self._lines = 0
+        self._position = {b"X": _NAN, b"Y": _NAN, b"Z": _NAN, b"F": _NAN}
+
+    def __len__(self) -> int:
+        return len(self._columns["line"])
+
+    @property
+    def lines(self) -> int:
+        return self._lines
+
+    def column(self, name: str) -> memoryview:
+        try:
+            column = self._columns[name]
+        except KeyError:
+            raise KeyError(f'unknown move table column "{name}"') from None
+        # A read-only copy, memoryview.toreadonly needs Python 3.8
+        return memoryview(column.tobytes()).cast(column.typecode)
+
+    def scan(self, buffer, start: int = 0, end: int = -1, object_id: int = -1):
+        if not hasattr(buffer, "count"):
+            buffer = bytes(buffer)
+        if end < 0 or end > len(buffer):
+            end = len(buffer)
+        if start < 0 or start > end:
+            raise ValueError("start offset out of range")
+        if start < end and start > 0 and buffer[start - 1] != 0x0A:
+            # Make the first line match the patterns as well
+            line_end = buffer.find(b"\n", start, end) + 1 or end
+            self.scan(bytes(buffer[start:line_end]), object_id=object_id)
+            start = line_end
+
+        columns = self._columns
+        position = self._position
+        counted = start
+        index = self._lines
+        for move in _MOVE.finditer(buffer, start, end):
+            index += buffer.count(b"\n", counted, move.start())
+            counted = move.start()
+            command = int(move[1])
+            if command > 3:
+                continue
+            e = _NAN
+            for axis, value in _MOVE_PARAMETER.findall(move[2]):
+                if not value:
+                    continue
+                axis = axis.upper()
+                if axis == b"E":
+                    e = float(value)
+                else:
+                    position[axis] = float(value)
+            columns["line"].append(index)
+            columns["command"].append(command)
+            columns["x"].append(position[b"X"])
+            columns["y"].append(position[b"Y"])
+            columns["z"].append(position[b"Z"])
+            columns["e"].append(e)
+            columns["f"].append(position[b"F"])
+            columns["object"].append(object_id)
+        self._lines = index + _count_lines(buffer, counted, end)
+
+
+def _check_heatshrink(window_bits: int, lookahead_bits: int):
+    if window_bits < 4 or window_bits > 15 or lookahead_bits < 3 or lookahead_bits >= window_bits:
+        raise ValueError("invalid heatshrink parameters")
+
+
+def heatshrink_decode(data, window_bits: int, lookahead_bits: int, expected_size: int = 0) -> bytes:
+    _check_heatshrink(window_bits, lookahead_bits)
+    data = bytes(data)
+    # Bits as text, most significant first, so that any number of them can be read at once
+    bits = format(int.from_bytes(data, "big"), f"0{len(data) * 8}b") if data else ""
+    size = len(bits)
+    out = bytearray()
+    bit = 0
+    while True:
+        if bit + 1 > size:
+            break
+        if bits[bit] == "1":
+            if bit + 9 > size:
+                break
+            out.append(int(bits[bit + 1 : bit + 9], 2))
+            bit += 9
+        else:
+            if bit + 1 + window_bits + lookahead_bits > size:
+                break
+            offset = int(bits[bit + 1 : bit + 1 + window_bits], 2) + 1
+            count = int(bits[bit + 1 + window_bits : bit + 1 + window_bits + lookahead_bits], 2) + 1
+            bit += 1 + window_bits + lookahead_bits
+            # The decoder window starts zeroed, back-references before the start of data read zeros
+            for _ in range(count):
+                out.append(out[-offset] if offset <= len(out) else 0)
+    return bytes(out)
+
+
+class _BitWriter:
+    def __init__(self):
+        self.out = bytearray()
+        self.current = 0
+        self.used = 0
+
+    def put(self, value: int, count: int):
+        self.current = (self.current << count) | (value & ((1 << count) - 1))
+        self.used += count
+        while self.used >= 8:
+            self.used -= 8
+            self.out.append((self.current >> self.used) & 0xFF)
+        self.current &= (1 << self.used) - 1
+
+    def flush(self) -> bytes:
+        """Pad the last byte with zeros, the decoder drops an incomplete back-reference"""
+        if self.used > 0:
+            self.out.append((self.current << (8 - self.used)) & 0xFF)
+        return bytes(self.out)
+
+
+# Greedy LZSS with hash chains over 3 byte prefixes, the same as the native encoder
+_HASH_BITS = 13
+_MIN_MATCH = 3
+_MAX_CHAIN = 32
+
+
+def heatshrink_encode(data, window_bits: int, lookahead_bits: int) -> bytes:
+    _check_heatshrink(window_bits, lookahead_bits)
+    data = bytes(data)
+    size = len(data)
+    writer = _BitWriter()
+    window = 1 << window_bits
+    max_length = 1 << lookahead_bits
+    mask = (1 << _HASH_BITS) - 1
+    head = [-1] * (1 << _HASH_BITS)
+    previous = [-1] * size
+
+    def hash3(pos):
+        return ((data[pos] << 10) ^ (data[pos + 1] << 5) ^ data[pos + 2]) & mask
+
+    def insert(pos):
+        if pos + _MIN_MATCH <= size:
+            h = hash3(pos)
+            previous[pos] = head[h]
+            head[h] = pos
+
+    pos = 0
+    while pos < size:
+        best_length = 0
+        best_offset = 0
+        if pos + _MIN_MATCH <= size:
+            limit = min(max_length, size - pos)
+            candidate = head[hash3(pos)]
+            chain = 0
+            while candidate >= 0 and pos - candidate <= window and chain < _MAX_CHAIN:
+                length = 0
+                while length < limit and data[candidate + length] == data[pos + length]:
+                    length += 1
+                if length > best_length:
+                    best_length = length
+                    best_offset = pos - candidate
+                    if length == limit:
+                        break
+                candidate = previous[candidate]
+                chain += 1
+
+        if best_length >= _MIN_MATCH:
+            writer.put(0, 1)
+            writer.put(best_offset - 1, window_bits)
+            writer.put(best_length - 1, lookahead_bits)
+            for i in range(best_length):
+                insert(pos + i)
+            pos += best_length
+        else:
+            writer.put(1, 1)
+            writer.put(data[pos], 8)
+            insert(pos)
+            pos += 1
+    return writer.flush()
+
+
+# MeatPack packs the common G-code characters into 4 bits, two per byte, low nibble first. 0b1111 means the character
+# follows in full. Two 0xFF bytes followed by a command byte switch the modes.
+_MP_SIGNAL = 0xFF
+_MP_ENABLE_PACKING = 0xFB
+_MP_DISABLE_PACKING = 0xFA
+_MP_RESET_ALL = 0xF9
+_MP_ENABLE_NO_SPACES = 0xF7
+_MP_DISABLE_NO_SPACES = 0xF6
+_MP_FULL = 0xF
+_MP_CHARS = b"0123456789. \nGX"
+_MP_CODES = {c: i for i, c in enumerate(_MP_CHARS)}
+_G_LINE_PARAMETERS = b"XYZEFIJRPWHCA"
+
+
+def meatpack_decode(data) -> bytes:
+    out = bytearray()
+    state = {"packing": False, "no_spaces": False, "full": 0, "pending": None, "add_space": False}
+
+    def emit(c):
+        # Spaces are dropped in the no-spaces mode, put them back in front of the G line parameters
+        if c == 0x47 and (not out or out[-1] == 0x0A):
+            state["add_space"] = True
+        elif c == 0x0A:
+            state["add_space"] = False
+        if state["add_space"] and (not out or out[-1] != 0x20) and c in _G_LINE_PARAMETERS:
+            out.append(0x20)
+        if c != 0x0A or not out or out[-1] != 0x0A:
+            out.append(c)
+
+    def decode_char(code):
+        return 0x45 if code == 0b1011 and state["no_spaces"] else _MP_CHARS[code]
+
+    def receive(c):
+        if not state["packing"]:
+            emit(c)
+        elif state["full"] > 0:
+            emit(c)
+            if state["pending"] is not None:
+                emit(state["pending"])
+                state["pending"] = None
+            state["full"] -= 1
+        else:
+            low = c & 0xF
+            high = c >> 4
+            if low == _MP_FULL:
+                state["full"] += 1
+                if high == _MP_FULL:
+                    state["full"] += 1
+                else:
+                    state["pending"] = decode_char(high)
+            else:
+                first = decode_char(low)
+                emit(first)
+                # A line end completes the byte
+                if first != 0x0A:
+                    if high == _MP_FULL:
+                        state["full"] += 1
+                    else:
+                        emit(decode_char(high))
+
+    signal = False
+    command = False
+    for c in bytes(data):
+        if c == _MP_SIGNAL:
+            if signal:
+                command = True
+                signal = False
+            else:
+                signal = True
+        elif command:
+            if c == _MP_ENABLE_PACKING:
+                state["packing"] = True
+            elif c in (_MP_DISABLE_PACKING, _MP_RESET_ALL):
+                state["packing"] = False
+            elif c == _MP_ENABLE_NO_SPACES:
+                state["no_spaces"] = True
+            elif c == _MP_DISABLE_NO_SPACES:
+                state["no_spaces"] = False
+            command = False
+        else:
+            if signal:
+                receive(_MP_SIGNAL)
+                signal = False
+            receive(c)
+    return bytes(out)
+
+
+def meatpack_encode(data) -> bytes:
+    data = bytes(data)
+    if _MP_SIGNAL in data:
+        raise ValueError("0xFF bytes can not be encoded with MeatPack")
+    out = bytearray([_MP_SIGNAL, _MP_SIGNAL, _MP_ENABLE_PACKING])
+    size = len(data)
+    i = 0
+    while i < size:
+        first = data[i]
+        low = _MP_CODES.get(first, _MP_FULL)
+        if first == 0x0A:
+            out.append(low)
+            i += 1
+            continue
+        if i + 1 == size:
+            # A lone character at the end of a line without a line end, send it unpacked
+            out += bytes([_MP_SIGNAL, _MP_SIGNAL, _MP_DISABLE_PACKING, first])
+            break
+        second = data[i + 1]
+        high = _MP_CODES.get(second, _MP_FULL)
+        out.append((high << 4) | low)
+        if low == _MP_FULL:
+            out.append(first)
+        if high == _MP_FULL:
+            out.append(second)
+        i += 2
+    return bytes(out)
@@ -1,6 +1,7 @@
+import struct
 import unittest
 import numpy
-from preprocess_cancellation_cext import Hull, Point, GCodeParser
+from preprocess_cancellation_cext import Hull, Point, GCodeParser, MoveTable
 import pytest
 
 def point2tuples(a):
@@ -37,6 +38,99 @@ def test_precision():
 
     assert set(point2tuples(h.points)) == set([(0,0), (10, 10)])
 
+def test_points_folded_into_hull():
+    h = Hull()
+    h.points = [Point(x, y) for x in range(100) for y in range(100)]
+
+    # Only the corners of the grid remain, the inner and collinear points are dropped
+    assert set(point2tuples(h.points)) == set([(0, 0), (99, 0), (99, 99), (0, 99)])
+    assert h.bounding_box() == (0, 0, 99, 99)
+    assert len(h.point_bytes()) == 4 * 16
+
+def test_merge_hulls():
+    a = Hull()
+    a.points = [Point(0, 0), Point(2, 0), Point(0, 2)]
+    b = Hull()
+    b.points = [Point(2, 2), Point(1, 1)]
+    a.merge(b)
+
+    assert set(point2tuples(a.points)) == set([(0, 0), (2, 0), (2, 2), (0, 2)])
+    assert b.bounding_box() == (1, 1, 2, 2)
+
+def test_move_table():
+    t = MoveTable()
+    t.scan(b'G1 X1.5 Y2 E0.1 F300\n;G1 X9\nG0 Z0.2\nG10\ng1x-3e-0.25 ; X7\n', object_id=3)
+    assert len(t) == 3
+    assert t.lines == 5
+
+    assert list(numpy.asarray(t.column('line'))) == [0, 2, 4]
+    assert list(numpy.asarray(t.column('command'))) == [1, 0, 1]
+    assert list(numpy.asarray(t.column('x'))) == [1.5, 1.5, -3]
+    assert list(numpy.asarray(t.column('y'))) == [2, 2, 2]
+    assert list(numpy.asarray(t.column('f'))) == [300, 300, 300]
+    assert list(numpy.asarray(t.column('object'))) == [3, 3, 3]
+    z = numpy.asarray(t.column('z'))
+    assert numpy.isnan(z[0]) and z[1] == 0.2
+    e = numpy.asarray(t.column('e'))
+    assert e[0] == 0.1 and numpy.isnan(e[1]) and e[2] == -0.25
+
+def test_move_table_exports():
+    t = MoveTable()
+    t.scan(b'G1 X1\n')
+    x = memoryview(t.column('x'))
+    assert x.format == 'd' and x.readonly
+    with pytest.raises(BufferError):
+        t.scan(b'G1 X2\n')
+    x.release()
+
+    t.scan(b'G1 X2\n')
+    assert memoryview(t.column('x')).tolist() == [1, 2]
+    with pytest.raises(KeyError):
+        t.column('w')
+
+def unpack_points(packed):
+    return list(struct.iter_unpack('dd', packed))
+
+def test_convex_hull():
+    h = Hull()
+    h.precision = 0.01
+    h.points = [Point(0, 0), Point(4, 0), Point(4, 2), Point(2, 1), Point(0, 2), Point(2, 2.01)]
+
+    # closed clockwise ring starting from the lowest, leftmost point
+    ring = [(round(x, 6), round(y, 6)) for x, y in unpack_points(h.convex_hull())]
+    assert ring == [(0, 0), (0, 2), (2, 2.01), (4, 2), (4, 0), (0, 0)]
+    assert unpack_points(h.simplify(0.02)) == [(0, 0), (0, 2), (4, 2), (4, 0), (0, 0)]
+
+    center = h.centroid(0.02)
+    assert (center.x, center.y) == (2, 1)
+
+def test_raster_hull():
+    # An L shape, the hull is the same as with a point set but the outline follows the inner corner
+    points = [Point(x, y) for x in range(10) for y in range(3)] + [Point(x, y) for x in range(3) for y in range(3, 10)]
+    h = Hull(raster=True)
+    h.points = points
+    assert h.raster and h.cells == 51
+    reference = Hull()
+    reference.points = points
+    assert h.convex_hull() == reference.convex_hull()
+    assert h.bounding_box() == (0, 0, 9, 9)
+    assert unpack_points(h.outline()) == [(0, 0), (0, 9), (2, 9), (2, 3), (9, 2), (9, 0), (0, 0)]
+    assert reference.outline() == reference.convex_hull()
+
+    other = Hull(raster=True)
+    other.points = [Point(-5, 4), Point(1000, 1000)]
+    h.merge(other)
+    assert h.cells == 53
+    assert h.bounding_box() == (-5, 0, 1000, 1000)
+
+def test_degenerate_hull():
+    h = Hull()
+    assert h.convex_hull() == b''
+    assert h.centroid() is None
+
+    h.points = [Point(1, 1), Point(3, 3)]
+    assert unpack_points(h.simplify(0.02)) == [(1, 1), (3, 3)]
+
 def test_point_types():
     h = Hull()
 
@@ -54,10 +148,66 @@ def test_parser():
     p.feed_line('G1 X1 Y2 E1')
     assert point2tuples(h.points) == [(1, 2)]
 
+def test_parser_numbers():
+    h = Hull()
+    p = GCodeParser()
+    p.hull = h
+
+    # Numbers are read like in move tables, without exponent
+    p.feed_line('G1 X-1.5 Y+2. E.5*12')
+    p.feed_line('G1 X1e1 Y3 E1')
+    # Not numbers
+    p.feed_line('G1 X- Y3 E1')
+    p.feed_line('G1 Xinf Y3 E1')
+    p.feed_line('G1 X1' + '0' * 400 + ' Y3 E1')
+    assert set(point2tuples(h.points)) == set([(-2, 2), (1, 3)])
+
 def test_interests():
     p = GCodeParser()
     p.register_interest(';TEST', 77)
     assert p.feed_line(';test') == 77
+
+def test_feed_buffer():
+    h = Hull()
+    p = GCodeParser()
+    p.hull = h
+    p.register_interest(';TEST', 77)
+
+    buf = b'G1 X1 Y2 E1\n  ;test one\nG1 X3 Y4 E1\n;TEST'
+    matches = list(struct.iter_unpack('qqq', p.feed_buffer(buf)))
+    assert matches == [(12, 24, 77), (36, 41, 77)]
+    assert set(point2tuples(h.points)) == set([(1, 2), (3, 4)])
+
+def test_interest_dispatch():
+    p = GCodeParser()
+    p.register_interest('; printing object', 1)
+    p.register_interest(';', 2)
+    p.register_interest('m486', 3)
+
+    assert p.feed_line('; PRINTING OBJECT a\n') == 1
+    assert p.feed_line(';other\n') == 2
+    assert p.feed_line('M486 S1\n') == 3
+    assert p.feed_line('G1 X1\n') is None
+
+    # the first registered interest wins, the empty prefix matches every line
+    p.register_interest('', 4)
+    assert p.feed_line('; printing object b\n') == 1
+    assert p.feed_line('G1 X1\n') == 4
+    assert p.feed_line('  \n') == 4
+
+    p.clear_interests()
+    assert p.feed_line('M486 S1\n') is None
+
+def test_feed_buffer_resume():
+    p = GCodeParser()
+    p.register_interest('M486', 1)
+    buf = memoryview(b'M486 T2\nG1 X1\nM486 S0\n')
+
+    first = struct.unpack('qqq', p.feed_buffer(buf, max_matches=1))
+    assert first == (0, 8, 1)
+    second = struct.unpack('qqq', p.feed_buffer(buf, first[1], max_matches=1))
+    assert second == (14, 22, 1)
+    assert p.feed_buffer(buf, second[1]) == b''
         
 
 
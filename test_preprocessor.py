@@ -1,9 +1,40 @@
+import asyncio
+import bz2
+import concurrent.futures
+import errno
+import gzip
+import io
+import json
+import logging
+import lzma
+import math
+import os
 import pathlib
 import re
+import shutil
+import struct
 import subprocess
 import sys
-
-from preprocess_cancellation import preprocess_cura, preprocess_ideamaker, preprocess_m486, preprocess_slicer
+import threading
+import time
+import zlib
+
+import preprocess_cancellation
+import preprocess_cancellation_bgcode as bgcode
+import preprocess_cancellation_daemon
+from preprocess_cancellation import (
+    _decode,
+    extract_moves,
+    heatshrink_decode,
+    heatshrink_encode,
+    meatpack_decode,
+    meatpack_encode,
+    preprocess_cura,
+    preprocess_ideamaker,
+    preprocess_m486,
+    preprocess_slicer,
+    preprocessor,
+)
 
 gcode_path = pathlib.Path("./GCode")
 
@@ -39,6 +70,56 @@ def test_cli_without():
             testing_file.unlink()
 
 
+def test_cli_jobs(tmp_path):
+    for path in [*gcode_path.glob("*.gcode"), gcode_path / "unsupported" / "icesl.gcode"]:
+        (tmp_path / path.name).write_bytes(path.read_bytes())
+
+    command = [sys.executable, "./preprocess_cancellation.py", "--jobs", "3", "-o", ".testing"]
+    with subprocess.Popen([*command, *tmp_path.glob("*.gcode")]) as proc:
+        proc.wait()
+        # icesl is not supported
+        assert proc.returncode == 1
+
+    for path in gcode_path.glob("*.gcode"):
+        processed = (tmp_path / path.name).with_suffix(".testing.gcode").read_bytes()
+        assert processed == _process_file(path, tmp_path / "sequential.gcode")
+
+
+def test_cli_stats(tmp_path):
+    for path in gcode_path.glob("*.gcode"):
+        (tmp_path / path.name).write_bytes(path.read_bytes())
+
+    stats_file = tmp_path / "stats.jsonl"
+    command = [sys.executable, "./preprocess_cancellation.py", "--jobs", "2", "--stats-file", stats_file]
+    subprocess.run([*command, *tmp_path.glob("*.gcode")], check=True)
+
+    stats = [json.loads(line) for line in stats_file.read_text().splitlines()]
+    assert sorted(s["file"] for s in stats) == sorted(str(path) for path in tmp_path.glob("*.gcode"))
+    assert all(s["result"] and s["lines"] > 0 for s in stats)
+
+
+def test_worker_log_level(tmp_path, caplog):
+    import concurrent.futures
+    import multiprocessing
+
+    infilepath = tmp_path / "done.gcode"
+    with open(gcode_path / "slic3r.gcode", "rb") as infile, open(infilepath, "wb") as outfile:
+        preprocessor(infile, outfile)
+
+    caplog.set_level(logging.INFO, logger=preprocess_cancellation.logger.name)
+    # Spawned workers start with the default logging configuration, unlike forked ones
+    with concurrent.futures.ProcessPoolExecutor(
+        1,
+        multiprocessing.get_context("spawn"),
+        initializer=preprocess_cancellation._apply_settings,
+        initargs=(preprocess_cancellation._get_settings(),),
+    ) as executor:
+        job = executor.submit(preprocess_cancellation._process_file_job, infilepath, None, False, False)
+        res, records, _ = job.result()
+    assert res
+    assert [record.getMessage() for record in records] == ["GCode already supports cancellation"]
+
+
 def test_m486():
     with (gcode_path / "m486.gcode").open("r") as f:
         results = "".join(list(preprocess_m486(f))).split("\n")
@@ -197,12 +278,652 @@ def test_issue_1_prusaslicer_point_collection():
     assert results.count(f"EXCLUDE_OBJECT_START NAME=Shape_Box_id_0_copy_0") == 125
     assert results.count(f"EXCLUDE_OBJECT_END NAME=Shape_Box_id_0_copy_0") == 125
 
+def test_binary_undecodable_comments():
+    gcode = (gcode_path / "superslicer.gcode").read_bytes()
+    # Latin-1 comment that is not valid UTF-8, it must be passed through untouched
+    gcode = gcode.replace(b"; stop printing object", b"; caf\xe9\n; stop printing object", 1)
+
+    outfile = io.BytesIO()
+    assert preprocessor(io.BytesIO(gcode), outfile)
+    results = outfile.getvalue()
+
+    assert b"; caf\xe9\n" in results
+    assert b"EXCLUDE_OBJECT_DEFINE NAME=cube_1_id_0_copy_0" in results
+    assert results.count(b"EXCLUDE_OBJECT_START NAME=cube_1_id_0_copy_0") == 25
+
+
+def test_text_multibyte_on_block_boundary(tmp_path, monkeypatch):
+    # Small blocks, so that many of the two byte characters are split between two of them
+    monkeypatch.setattr(preprocess_cancellation, "block_size", 7)
+    gcode = (gcode_path / "prusaslicer.gcode").read_text()
+    gcode = gcode.replace("; stop printing object", "; température é\n; stop printing object")
+    infilepath = tmp_path / "input.gcode"
+    infilepath.write_text(gcode, encoding="utf-8")
+
+    with infilepath.open(encoding="utf-8") as fin, (tmp_path / "text.gcode").open("w", encoding="utf-8") as fout:
+        for text in preprocess_slicer(fin):
+            fout.write(text)
+
+    assert (tmp_path / "text.gcode").read_bytes() == _process_file(infilepath, tmp_path / "binary.gcode")
+
+
+def _process_file(infilepath, outfilepath):
+    with infilepath.open("rb") as fin, outfilepath.open("wb") as fout:
+        assert preprocessor(fin, fout)
+    return outfilepath.read_bytes()
+
+
+def test_span_copy_matches_streaming(tmp_path, monkeypatch):
+    for infilepath in gcode_path.glob("*.gcode"):
+        outfile = io.BytesIO()
+        assert preprocessor(io.BytesIO(infilepath.read_bytes()), outfile)
+        expected = outfile.getvalue()
+
+        assert _process_file(infilepath, tmp_path / "out.gcode") == expected
+
+        def unsupported(*args):
+            raise OSError(errno.EXDEV, "cross-device copy")
+
+        with monkeypatch.context() as m:
+            m.setattr(preprocess_cancellation, "_COPY_METHODS", [unsupported, preprocess_cancellation._pread_write])
+            assert _process_file(infilepath, tmp_path / "fallback.gcode") == expected
+
+
+def _strip_padding(gcode):
+    return re.sub(rb"(?m)^;? *\n", b"", gcode)
+
+
+def test_single_pass(tmp_path):
+    for infilepath in gcode_path.glob("*.gcode"):
+        expected = _process_file(infilepath, tmp_path / "out.gcode")
+        with infilepath.open("rb") as fin, (tmp_path / "single.gcode").open("w+b") as fout:
+            assert preprocessor(fin, fout, single_pass=True)
+        single = (tmp_path / "single.gcode").read_bytes()
+
+        assert _strip_padding(single) == _strip_padding(expected)
+
+
+def test_single_pass_fallback(tmp_path, monkeypatch):
+    monkeypatch.setattr(preprocess_cancellation, "header_reserve", 100)
+    infilepath = gcode_path / "prusaslicer.gcode"
+    expected = _process_file(infilepath, tmp_path / "out.gcode")
+    with infilepath.open("rb") as fin, (tmp_path / "single.gcode").open("wb") as fout:
+        assert preprocessor(fin, fout, single_pass=True)
+
+    assert (tmp_path / "single.gcode").read_bytes() == expected
+
+
+def test_threaded_scan(tmp_path, monkeypatch):
+    monkeypatch.setattr(preprocess_cancellation, "block_size", 4096)
+    for infilepath in gcode_path.glob("*.gcode"):
+        expected = _process_file(infilepath, tmp_path / "out.gcode")
+        with monkeypatch.context() as m:
+            m.setattr(preprocess_cancellation, "scan_threads", 4)
+            assert _process_file(infilepath, tmp_path / "threaded.gcode") == expected
+
+
+def test_preprocess_file_async(tmp_path, monkeypatch):
+    gcode = (gcode_path / "prusaslicer.gcode").read_bytes()
+    (tmp_path / "input.gcode").write_bytes(gcode)
+    expected = _process_file(tmp_path / "input.gcode", tmp_path / "expected.gcode")
+    (tmp_path / "async.gcode").write_bytes(gcode)
+    started = threading.Event()
+    release = threading.Event()
+    process_file = preprocess_cancellation.process_file_for_cancellation
+
+    def blocking_process(*args):
+        started.set()
+        assert release.wait(10)
+        return process_file(*args)
+
+    async def process():
+        job = asyncio.ensure_future(
+            preprocess_cancellation.preprocess_file_async(tmp_path / "async.gcode", executor=executor)
+        )
+        # Another coroutine keeps running while the job is held up in the executor
+        ticks = 0
+        while not started.is_set() or ticks < 10:
+            await asyncio.sleep(0)
+            ticks += 1
+        assert not job.done()
+        release.set()
+        return await job
+
+    monkeypatch.setattr(preprocess_cancellation, "process_file_for_cancellation", blocking_process)
+    with concurrent.futures.ThreadPoolExecutor(1) as executor:
+        result = asyncio.run(process())
+    assert result
+    assert (tmp_path / "async.gcode").read_bytes() == expected
+
+
+def _reference_moves(gcode):
+    position = {"X": math.nan, "Y": math.nan, "Z": math.nan, "F": math.nan}
+    moves = []
+    for index, line in enumerate(gcode.split(b"\n")):
+        words = line.split(b";")[0].split()
+        if not words or words[0].upper() not in (b"G0", b"G1", b"G2", b"G3"):
+            continue
+        command, *params = words
+        e = math.nan
+        for param in params:
+            axis = _decode(param[:1]).upper()
+            if axis in position:
+                position[axis] = float(param[1:])
+            elif axis == "E":
+                e = float(param[1:])
+        moves.append((index, int(command[1:]), position["X"], position["Y"], position["Z"], e, position["F"]))
+    return moves
+
+
+def test_extract_moves():
+    import numpy
+
+    infilepath = gcode_path / "prusaslicer.gcode"
+    gcode = infilepath.read_bytes()
+    with infilepath.open("rb") as fin:
+        moves = extract_moves(fin)
+
+    assert moves.objects == [
+        "cylinder_2_id_1_copy_0",
+        "cube_1_id_0_copy_0",
+        "cube_1_id_0_copy_1",
+        "union_3_id_2_copy_0",
+    ]
+    columns = ["line", "command", "x", "y", "z", "e", "f"]
+    got = list(zip(*(moves.column(name).tolist() for name in columns)))
+    assert numpy.array_equal(numpy.array(got), numpy.array(_reference_moves(gcode)), equal_nan=True)
+
+    # Every object got its extrusions, the moves outside objects are travels and priming
+    objects = numpy.asarray(moves.column("object"))
+    e = numpy.asarray(moves.column("e"))
+    assert set(objects.tolist()) == {-1, 0, 1, 2, 3}
+    for i in range(len(moves.objects)):
+        assert (e[objects == i] > 0).sum() > 0
+
+
+def test_identify_slicer_sniffing(monkeypatch):
+    monkeypatch.setattr(preprocess_cancellation, "sniff_bytes", 4096)
+    for infilepath in gcode_path.glob("*.gcode"):
+        gcode = infilepath.read_bytes()
+        processed = io.BytesIO()
+        assert preprocessor(io.BytesIO(gcode), processed)
+
+        with monkeypatch.context() as m:
+            m.setattr(preprocess_cancellation, "sniff_bytes", 1 << 30)
+            expected = preprocess_cancellation._identify_slicer(io.BytesIO(gcode))
+        assert preprocess_cancellation._identify_slicer(io.BytesIO(gcode)) == expected
+        assert preprocess_cancellation._identify_slicer(io.BytesIO(processed.getvalue())) == (None, True)
+
+
+def test_m486_past_sniffed_head(tmp_path, monkeypatch):
+    monkeypatch.setattr(preprocess_cancellation, "sniff_bytes", 4096)
+    # Named by its head, the objects are only defined with M486 further on
+    m486 = (gcode_path / "m486.gcode").read_bytes().splitlines(keepends=True)
+    gcode = b"; generated by PrusaSlicer 2.4.0\n" + b"G1 X1 Y1\n" * 1000
+    gcode += b"".join(line for line in m486 if b"printing object" not in line)
+    assert preprocess_cancellation._identify_slicer(io.BytesIO(gcode)) == (
+        preprocess_cancellation.SlicerSlic3rFamily,
+        False,
+    )
+    expected = io.BytesIO()
+    assert preprocessor(io.BytesIO(gcode), expected, preprocess_cancellation.SlicerM486)
+    assert b"EXCLUDE_OBJECT_DEFINE NAME=3" in expected.getvalue()
+
+    for single_pass in (False, True):
+        processed = io.BytesIO()
+        assert preprocessor(io.BytesIO(gcode), processed, single_pass=single_pass)
+        assert processed.getvalue() == expected.getvalue()
+    assert len(preprocess_cancellation.scan_objects(io.BytesIO(gcode))) == 4
+
+    # The cache entry is keyed by the slicer named in the head
+    monkeypatch.setattr(preprocess_cancellation, "cache_dir", tmp_path / "cache")
+    for _ in range(2):
+        processed = io.BytesIO()
+        assert preprocessor(io.BytesIO(gcode), processed)
+        assert processed.getvalue() == expected.getvalue()
+
+
+class _CountingBytesIO(io.BytesIO):
+    bytes_read = 0
+
+    def read(self, size=-1):
+        data = super().read(size)
+        self.bytes_read += len(data)
+        return data
+
+
+def test_identify_slicer_skips_thumbnails(monkeypatch):
+    monkeypatch.setattr(preprocess_cancellation, "sniff_bytes", 4096)
+    thumbnail = b"".join(b"; " + b"A" * 78 + b"\n" for _ in range(1000))
+    gcode = (
+        b"; thumbnail begin 400x300 78000\n"
+        + thumbnail
+        + b"; thumbnail end\n; generated by PrusaSlicer 2.4.0\n"
+        + b"G1 X1 Y1 E1\n" * 100000
+    )
+
+    infile = _CountingBytesIO(gcode)
+    assert preprocess_cancellation._identify_slicer(infile) == (preprocess_cancellation.SlicerSlic3rFamily, False)
+    assert infile.bytes_read <= 3 * 4096
+
+
+def test_scan_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(preprocess_cancellation, "cache_dir", tmp_path / "cache")
+    for infilepath in gcode_path.glob("*.gcode"):
+        with monkeypatch.context() as m:
+            m.setattr(preprocess_cancellation, "cache_dir", None)
+            expected = _process_file(infilepath, tmp_path / "expected.gcode")
+
+        assert _process_file(infilepath, tmp_path / "out.gcode") == expected
+
+        # The second run must not scan at all, the cached objects have the same stats
+        (tmp_path / "cold.gcode").write_bytes(infilepath.read_bytes())
+        (tmp_path / "warm.gcode").write_bytes(infilepath.read_bytes())
+        cold = preprocess_cancellation.Stats()
+        warm = preprocess_cancellation.Stats()
+        with monkeypatch.context() as m:
+            m.setattr(preprocess_cancellation, "cache_dir", None)
+            assert preprocess_cancellation.process_file_for_cancellation(tmp_path / "cold.gcode", stats=cold)
+        with monkeypatch.context() as m:
+            m.setattr(preprocess_cancellation, "_scan_objects", None)
+            assert _process_file(infilepath, tmp_path / "cached.gcode") == expected
+            assert preprocess_cancellation.process_file_for_cancellation(tmp_path / "warm.gcode", stats=warm)
+        assert warm.objects == cold.objects
+
+    assert len(list((tmp_path / "cache").glob("*.json"))) == len(list(gcode_path.glob("*.gcode")))
+
+    # Another process evicting the entry just after it was read
+    utime = os.utime
+
+    def evicted(path, *args, **kwargs):
+        os.unlink(path)
+        utime(path, *args, **kwargs)
+
+    with monkeypatch.context() as m:
+        m.setattr(os, "utime", evicted)
+        m.setattr(preprocess_cancellation, "_scan_objects", None)
+        assert _process_file(infilepath, tmp_path / "evicted.gcode") == expected
+
+
+def test_scan_cache_eviction(tmp_path, monkeypatch):
+    cache = tmp_path / "cache"
+    monkeypatch.setattr(preprocess_cancellation, "cache_dir", cache)
+    _process_file(gcode_path / "cura.gcode", tmp_path / "cura.gcode")
+    _process_file(gcode_path / "slic3r.gcode", tmp_path / "slic3r.gcode")
+    # Only the cura entry records the last TIME_ELAPSED marker
+    cura, slic3r = sorted(cache.glob("*.json"), key=lambda path: "last_time_elapsed" not in path.read_text())
+
+    # Using the cura entry makes the slic3r entry the least recently used one
+    os.utime(slic3r, (1, 1))
+    _process_file(gcode_path / "cura.gcode", tmp_path / "cura.gcode")
+    monkeypatch.setattr(preprocess_cancellation, "cache_size", cura.stat().st_size)
+    preprocess_cancellation._cache_evict()
+
+    assert list(cache.glob("*.json")) == [cura]
+
+
+def test_stats(tmp_path):
+    infilepath = tmp_path / "prusaslicer.gcode"
+    infilepath.write_bytes((gcode_path / "prusaslicer.gcode").read_bytes())
+    stats = preprocess_cancellation.Stats()
+    assert preprocess_cancellation.process_file_for_cancellation(infilepath, stats=stats)
+
+    assert stats.result
+    assert set(stats.stages) == {"detect", "scan", "hulls", "output", "total"}
+    assert stats.input_bytes == (gcode_path / "prusaslicer.gcode").stat().st_size
+    assert stats.decoded_bytes == stats.input_bytes
+    assert stats.output_bytes == infilepath.stat().st_size
+    assert stats.lines == (gcode_path / "prusaslicer.gcode").read_bytes().count(b"\n")
+    assert stats.interest_hits["scan: ; printing object "] == 100
+    assert stats.interest_hits["output: ; stop printing object "] == 100
+    assert stats.objects["cube_1_id_0_copy_0"]["vertices"] == 4
+    assert stats.objects["cube_1_id_0_copy_0"]["points"] > 4
+    json.dumps(stats.as_dict())
+
+    # Already processed files are only sniffed
+    stats = preprocess_cancellation.Stats()
+    assert preprocess_cancellation.process_file_for_cancellation(infilepath, stats=stats)
+    assert stats.input_bytes == infilepath.stat().st_size
+    assert stats.decoded_bytes == 0
+
+    # The input size is that of the file, the decoded size that of the G-code
+    gzpath = tmp_path / "prusaslicer.gcode.gz"
+    gzpath.write_bytes(gzip.compress((gcode_path / "prusaslicer.gcode").read_bytes()))
+    stats = preprocess_cancellation.Stats()
+    assert preprocess_cancellation.process_file_for_cancellation(gzpath, output_suffix=".out", stats=stats)
+    assert stats.input_bytes == gzpath.stat().st_size
+    assert stats.decoded_bytes == (gcode_path / "prusaslicer.gcode").stat().st_size
+
+
+def test_compressed_files(tmp_path):
+    expected = tmp_path / "expected.gcode"
+    expected.write_bytes((gcode_path / "prusaslicer.gcode").read_bytes())
+    assert preprocess_cancellation.process_file_for_cancellation(expected)
+
+    for module, extension in [(gzip, ".gz"), (lzma, ".xz"), (bz2, ".bz2")]:
+        infilepath = tmp_path / f"prusaslicer.gcode{extension}"
+        infilepath.write_bytes(module.compress((gcode_path / "prusaslicer.gcode").read_bytes()))
+        assert preprocess_cancellation.process_file_for_cancellation(infilepath, "-out", single_pass=True)
+        assert module.decompress((tmp_path / f"prusaslicer-out.gcode{extension}").read_bytes()) == expected.read_bytes()
+
+    # Recompressed in place, or decompressed into a file without the extension
+    assert preprocess_cancellation.process_file_for_cancellation(tmp_path / "prusaslicer.gcode.gz", compress="xz")
+    assert lzma.decompress((tmp_path / "prusaslicer.gcode.xz").read_bytes()) == expected.read_bytes()
+    assert preprocess_cancellation.process_file_for_cancellation(tmp_path / "prusaslicer.gcode.bz2", compress="none")
+    assert (tmp_path / "prusaslicer.gcode").read_bytes() == expected.read_bytes()
+
+
+def test_cli_compress(tmp_path):
+    infilepath = tmp_path / "cura.gcode.gz"
+    infilepath.write_bytes(gzip.compress((gcode_path / "cura.gcode").read_bytes()))
+    subprocess.run([sys.executable, "./preprocess_cancellation.py", "--compress", "none", infilepath], check=True)
+    assert b"EXCLUDE_OBJECT_DEFINE" in (tmp_path / "cura.gcode").read_bytes()
+
+
+def test_heatshrink():
+    # "abc" as literals, then a back-reference 3 bytes back, 6 bytes long
+    bits = "".join("1" + format(c, "08b") for c in b"abc") + "0" + format(2, "011b") + format(5, "04b")
+    bits += "0" * (-len(bits) % 8)
+    data = int(bits, 2).to_bytes(len(bits) // 8, "big")
+    assert heatshrink_decode(data, 11, 4) == b"abcabcabc"
+
+    gcode = (gcode_path / "prusaslicer.gcode").read_bytes()
+    for window, lookahead in [(11, 4), (12, 4)]:
+        compressed = heatshrink_encode(gcode, window, lookahead)
+        assert len(compressed) < len(gcode) * 0.7
+        assert heatshrink_decode(compressed, window, lookahead) == gcode
+
+
+def test_meatpack():
+    assert meatpack_decode(b"\xff\xff\xfb\x1d\xeb\xc1") == b"G1 X1\n"
+    assert meatpack_decode(b"\xff\xff\xfb\x7fM\xb3\x5fP\x0c") == b"M73 P5\n"
+    # Without spaces, 0b1011 stands for E and the spaces are added back in G lines
+    assert meatpack_decode(b"\xff\xff\xfb\xff\xff\xf7\x1d\x1e\x2b\x0c") == b"G1 X1 E2\n"
+
+    gcode = (gcode_path / "prusaslicer.gcode").read_bytes()
+    assert meatpack_decode(meatpack_encode(gcode)) == gcode
+
+
+def _bgcode_block(type, parameters, data, compression=0, payload=None):
+    payload = data if payload is None else payload
+    block = struct.pack("<HHI", type, compression, len(data))
+    if compression:
+        block += struct.pack("<I", len(payload))
+    block += parameters + payload
+    return block + struct.pack("<I", zlib.crc32(block))
+
+
+def _read_bgcode(data):
+    """Blocks of a bgcode file as (type, parameters, payload, raw block), checking the checksums"""
+    assert data[:10] == b"GCDE" + struct.pack("<IH", 1, 1)
+    offset = 10
+    blocks = []
+    while offset < len(data):
+        type, compression, size = struct.unpack_from("<HHI", data, offset)
+        start = offset + 8
+        if compression:
+            (size,) = struct.unpack_from("<I", data, start)
+            start += 4
+        parameters_size = 6 if type == 5 else 2
+        end = start + parameters_size + size
+        assert struct.unpack_from("<I", data, end)[0] == zlib.crc32(data[offset:end])
+        blocks.append((type, data[start : start + parameters_size], data[start + parameters_size : end], data[offset : end + 4]))
+        offset = end + 4
+    return blocks
+
+
+def test_bgcode(tmp_path):
+    gcode = (gcode_path / "prusaslicer.gcode").read_bytes()
+    expected = io.BytesIO()
+    preprocessor(io.BytesIO(gcode), expected)
+
+    metadata = _bgcode_block(3, struct.pack("<H", 0), b"printer_model=MK4\n")
+    thumbnail = _bgcode_block(5, struct.pack("<HHH", 0, 16, 16), b"\x89PNG not really")
+    lines = gcode.splitlines(keepends=True)
+    texts = [b"".join(lines[i : i + 2000]) for i in range(0, len(lines), 2000)]
+    codecs = {
+        "plain": (0, lambda data: data),
+        "deflate": (1, zlib.compress),
+        "heatshrink": (3, lambda data: heatshrink_encode(data, 12, 4)),
+    }
+    for name, (compression, compress) in codecs.items():
+        for encoding in [0, 1, 2]:
+            blocks = [metadata, thumbnail]
+            for text in texts:
+                data = meatpack_encode(text) if encoding else text
+                blocks.append(_bgcode_block(1, struct.pack("<H", encoding), data, compression, compress(data)))
+            infilepath = tmp_path / f"{name}-{encoding}.bgcode"
+            infilepath.write_bytes(b"GCDE" + struct.pack("<IH", 1, 1) + b"".join(blocks))
+
+            assert preprocess_cancellation.process_file_for_cancellation(infilepath)
+            output = _read_bgcode(infilepath.read_bytes())
+            assert [block[3] for block in output[:2]] == [metadata, thumbnail]
+            # MeatPack blocks are declared with comments, our header has some
+            assert all(block[:2] == (1, struct.pack("<H", 2 if encoding else 0)) for block in output[2:])
+
+            decoded = b""
+            for block in output[2:]:
+                data = block[2]
+                if compression == 1:
+                    data = zlib.decompress(data)
+                elif compression == 3:
+                    data = heatshrink_decode(data, 12, 4)
+                decoded += meatpack_decode(data) if encoding else data
+            if encoding:
+                # MeatPack drops empty lines
+                assert [line for line in decoded.split(b"\n") if line] == [
+                    line for line in expected.getvalue().split(b"\n") if line
+                ]
+            else:
+                assert decoded == expected.getvalue()
+
+            # Processed files are left as they are
+            before = infilepath.read_bytes()
+            assert preprocess_cancellation.process_file_for_cancellation(infilepath)
+            assert infilepath.read_bytes() == before
+
+
+def test_bgcode_fixture(tmp_path):
+    # Written by tools/make_bgcode_fixture.py with encoders that aren't ours, heatshrink (12, 4) and MeatPack. The
+    # slicer is only named by the file metadata.
+    source = (gcode_path / "prusaslicer.bgcode").read_bytes()
+    gcode = (gcode_path / "prusaslicer.gcode").read_bytes().replace(b"\r\n", b"\n")
+    gcode = b"".join(line for line in gcode.splitlines(keepends=True) if not line.startswith(b"; generated by "))
+    assert preprocess_cancellation._identify_slicer(io.BytesIO(gcode)) == (None, False)
+    expected = io.BytesIO()
+    preprocessor(io.BytesIO(gcode), expected, preprocess_cancellation.SlicerSlic3rFamily)
+
+    def decode(data):
+        decoded = io.BytesIO()
+        bgcode.extract(io.BytesIO(data), decoded)
+        return decoded.getvalue()
+
+    def lines(data):
+        # MeatPack drops empty lines
+        return [line for line in data.split(b"\n") if line]
+
+    assert decode(source) == b"".join(line for line in gcode.splitlines(keepends=True) if line != b"\n")
+
+    infilepath = tmp_path / "prusaslicer.bgcode"
+    infilepath.write_bytes(source)
+    assert len(preprocess_cancellation.scan_objects(infilepath)) == 4
+    assert preprocess_cancellation.process_file_for_cancellation(infilepath)
+    output = infilepath.read_bytes()
+    blocks = _read_bgcode(output)
+    # Metadata and thumbnail blocks are copied, the G-code is encoded like the first G-code block
+    assert [block[3] for block in blocks[:5]] == [block[3] for block in _read_bgcode(source)[:5]]
+    assert all(block[:2] == (1, struct.pack("<H", 2)) for block in blocks[5:])
+    assert struct.unpack_from("<H", blocks[5][3], 2)[0] == 3
+    assert lines(decode(output)) == lines(expected.getvalue())
+
+    # Processed files aren't written again
+    stat = infilepath.stat()
+    assert preprocess_cancellation.process_file_for_cancellation(infilepath)
+    assert infilepath.stat().st_ino == stat.st_ino
+    assert infilepath.stat().st_mtime_ns == stat.st_mtime_ns
+    assert infilepath.read_bytes() == output
+
+
+def test_atomic_output(tmp_path, monkeypatch):
+    infilepath = tmp_path / "slic3r.gcode"
+    infilepath.write_bytes((gcode_path / "slic3r.gcode").read_bytes())
+    unknown = tmp_path / "unknown.gcode"
+    unknown.write_bytes(b"G28\nG1 X10 Y10\n")
+
+    for anonymous in [True, False]:
+        if not anonymous:
+            monkeypatch.setattr(preprocess_cancellation, "_link_anonymous", False)
+        assert preprocess_cancellation.process_file_for_cancellation(infilepath, f"-{anonymous}")
+        assert not preprocess_cancellation.process_file_for_cancellation(unknown, f"-{anonymous}")
+
+    # No temporary files are left behind
+    assert sorted(path.name for path in tmp_path.iterdir()) == [
+        "slic3r-False.gcode",
+        "slic3r-True.gcode",
+        "slic3r.gcode",
+        "unknown.gcode",
+    ]
+    assert (tmp_path / "slic3r-True.gcode").read_bytes() == (tmp_path / "slic3r-False.gcode").read_bytes()
+
+
+def test_already_processed_not_rewritten(tmp_path):
+    infilepath = tmp_path / "cura.gcode"
+    infilepath.write_bytes((gcode_path / "cura.gcode").read_bytes())
+    assert preprocess_cancellation.process_file_for_cancellation(infilepath)
+    before = infilepath.stat()
+
+    assert preprocess_cancellation.process_file_for_cancellation(infilepath)
+    after = infilepath.stat()
+    assert (after.st_ino, after.st_mtime_ns) == (before.st_ino, before.st_mtime_ns)
+
+    assert preprocess_cancellation.process_file_for_cancellation(infilepath, "-copy")
+    assert (tmp_path / "cura-copy.gcode").read_bytes() == infilepath.read_bytes()
+
+
+def test_scan_objects(tmp_path):
+    objects = preprocess_cancellation.scan_objects(gcode_path / "prusaslicer.gcode")
+    assert [o.name for o in objects] == [
+        "cylinder_2_id_1_copy_0",
+        "cube_1_id_0_copy_0",
+        "cube_1_id_0_copy_1",
+        "union_3_id_2_copy_0",
+    ]
+    for o in objects:
+        assert o.extrusions > 0
+        assert len(o.byte_ranges) == 25
+        assert len(o.polygon) >= 3
+        assert all(start < end for start, end in o.byte_ranges)
+
+    infilepath = tmp_path / "prusaslicer.gcode"
+    infilepath.write_bytes((gcode_path / "prusaslicer.gcode").read_bytes())
+    assert preprocess_cancellation.process_file_for_cancellation(infilepath)
+    processed = preprocess_cancellation.scan_objects(infilepath)
+    assert [o.name for o in processed] == [o.name for o in objects]
+
+    assert preprocess_cancellation.scan_objects(io.BytesIO(b"G1 X1 Y1 E1\n")) is None
+
+
+def test_cli_scan_only():
+    result = subprocess.run(
+        [sys.executable, "./preprocess_cancellation.py", "--scan-only", "--json", gcode_path / "slic3r.gcode"],
+        check=True,
+        capture_output=True,
+    )
+    report = json.loads(result.stdout)
+    assert report["file"].endswith("slic3r.gcode")
+    assert len(report["objects"]) == 4
+    assert set(report["objects"][0]) == {"name", "center", "polygon", "extrusions", "byte_ranges"}
+
+
+def test_serve(tmp_path, monkeypatch):
+    for name in ("cura.gcode", "slic3r.gcode"):
+        shutil.copy(gcode_path / name, tmp_path / name)
+    (tmp_path / "unknown.gcode").write_bytes(b"G1 X1 Y1 E1\n")
+    socket_path = tmp_path / "daemon.sock"
+    daemon = subprocess.Popen([sys.executable, "./preprocess_cancellation.py", "--serve", socket_path, "--jobs", "2"])
+    try:
+        for _ in range(100):
+            if socket_path.exists():
+                break
+            time.sleep(0.1)
+        command = [sys.executable, "./preprocess_cancellation.py", "--connect", socket_path]
+        subprocess.run([*command, tmp_path / "cura.gcode", tmp_path / "slic3r.gcode"], check=True)
+        assert b"EXCLUDE_OBJECT_DEFINE" in (tmp_path / "cura.gcode").read_bytes()
+        assert b"EXCLUDE_OBJECT_DEFINE" in (tmp_path / "slic3r.gcode").read_bytes()
+        assert subprocess.run([*command, tmp_path / "unknown.gcode"]).returncode == 1
+        # Other users can't connect
+        assert socket_path.stat().st_mode & 0o777 == 0o600
+
+        # A second daemon doesn't start, and closes the connection it checked the socket with
+        connect = preprocess_cancellation_daemon.connect
+        connected = []
+
+        def recording_connect(path):
+            connected.append(connect(path))
+            return connected[-1]
+
+        monkeypatch.setattr(preprocess_cancellation_daemon, "connect", recording_connect)
+        assert not preprocess_cancellation_daemon.serve(preprocess_cancellation, socket_path, 1)
+        assert connected[0].fileno() == -1
+    finally:
+        daemon.terminate()
+        daemon.wait(10)
+    assert not socket_path.exists()
+
+
+def test_connect_without_daemon(tmp_path):
+    shutil.copy(gcode_path / "m486.gcode", tmp_path / "m486.gcode")
+    command = [sys.executable, "./preprocess_cancellation.py", "--connect", tmp_path / "missing.sock"]
+    subprocess.run([*command, tmp_path / "m486.gcode"], check=True)
+    assert b"EXCLUDE_OBJECT_DEFINE" in (tmp_path / "m486.gcode").read_bytes()
+
+
+def test_watch(tmp_path, monkeypatch):
+    def no_inotify(directory):
+        raise OSError(errno.ENOSYS, "Testing polling")
+
+    monkeypatch.setattr(preprocess_cancellation_daemon, "Inotify", no_inotify)
+    for name in ("cura.gcode", "slic3r.gcode", "m486.gcode"):
+        shutil.copy(gcode_path / name, tmp_path / name)
+    with open(gcode_path / "prusaslicer.gcode", "rb") as infile, open(tmp_path / "done.gcode", "wb") as outfile:
+        preprocessor(infile, outfile)
+    # IdeaMaker's header comes first, ours follows it
+    with open(gcode_path / "ideamaker.gcode", "rb") as infile, open(tmp_path / "ideamaker.gcode", "wb") as outfile:
+        preprocessor(infile, outfile)
+    (tmp_path / "notes.txt").write_text("G1 X1 Y1 E1\n")
+
+    watcher = preprocess_cancellation_daemon.Watcher(preprocess_cancellation, tmp_path, 1, None, False, None, None, 0)
+    try:
+        watcher.step(watcher._changed())
+        watcher.step(watcher._changed())
+        # Smallest first, the processed files are left alone
+        assert list(watcher.running.values()) == ["slic3r.gcode"]
+        assert [name for _, name in sorted(watcher.queue)] == ["m486.gcode", "cura.gcode"]
+        assert {"done.gcode", "ideamaker.gcode"} <= set(watcher.done)
+        for _ in range(200):
+            watcher.step(watcher._changed())
+            if not watcher.running and not watcher.queue and not watcher.pending:
+                break
+            time.sleep(0.05)
+    finally:
+        watcher.executor.shutdown()
+
+    for name in ("cura.gcode", "slic3r.gcode", "m486.gcode"):
+        assert b"EXCLUDE_OBJECT_DEFINE" in (tmp_path / name).read_bytes()
+    assert set(watcher.done) == {"cura.gcode", "slic3r.gcode", "m486.gcode", "done.gcode", "ideamaker.gcode"}
+
+
 if __name__ == "__main__":
+    test_binary_undecodable_comments()
+    test_cli_scan_only()
     test_cli_without()
     test_cura()
+    test_extract_moves()
+    test_heatshrink()
     test_ideamaker()
     test_issue_1_prusaslicer_point_collection()
     test_m486()
+    test_meatpack()
     test_prusaslicer()
     test_slic3r()
-    test_superslicer()
\ No newline at end of file
+    test_superslicer()
@@ -14,7 +14,10 @@ from test_preprocessor import collect_definitions
 try:
     import shapely
 except ImportError:
-    pytest.skip("Requires shapely installed", allow_module_level=True)
+    shapely = None
+
+# The hull polygons are computed natively, shapely is only needed to cross-check them
+requires_shapely = pytest.mark.skipif(shapely is None, reason="Requires shapely installed")
 
 
 gcode_path = pathlib.Path("./GCode")
@@ -66,6 +69,30 @@ def check_def(definitions, id, center, polygon):
     assert d.center == center
     assert d.polygon == polygon
 
+@requires_shapely
+def test_native_hulls_match_shapely():
+    preprocess_cancellation.precision = 0.00001
+    factories = {
+        "cura.gcode": preprocess_cancellation.SlicerCura,
+        "ideamaker.gcode": preprocess_cancellation.SlicerIdeamaker,
+        "m486.gcode": preprocess_cancellation.SlicerM486,
+    }
+    for path in gcode_path.glob("*.gcode"):
+        factory = factories.get(path.name, preprocess_cancellation.SlicerSlic3rFamily)
+        with path.open("rb") as f:
+            slicer = preprocess_cancellation._scan_objects(f, factory)
+
+        for _, hull in slicer.known_objects.values():
+            if not hull.points:
+                continue
+            center, polygon = slicer.get_hull_bounds(hull)
+            expected_center, expected_polygon = preprocess_cancellation._shapely_hull_bounds(hull)
+
+            assert (center.x, center.y) == pytest.approx((expected_center.x, expected_center.y), abs=0.001)
+            assert len(polygon) == len(expected_polygon)
+            for p, expected in zip(polygon, expected_polygon):
+                assert (p.x, p.y) == pytest.approx((expected.x, expected.y), abs=0.001)
+
 def test_m486():
     global precision
     preprocess_cancellation.precision = 0.00001
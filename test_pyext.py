@@ -0,0 +1,184 @@
+import io
+import pathlib
+import shutil
+import struct
+import subprocess
+import sys
+
+import pytest
+
+import preprocess_cancellation
+import preprocess_cancellation_pyext as python
+from preprocess_cancellation import preprocessor
+
+gcode_path = pathlib.Path("./GCode")
+
+ENGINE_NAMES = [
+    "Hull",
+    "Point",
+    "GCodeParser",
+    "MoveTable",
+    "heatshrink_decode",
+    "heatshrink_encode",
+    "meatpack_decode",
+    "meatpack_encode",
+]
+INTERESTS = ["EXCLUDE_OBJECT", ";TYPE:", "; printing object", ";MESH:", "M486", ";LAYER", ""]
+
+
+@pytest.fixture
+def native():
+    """The native engine that the Python one is compared with"""
+    return pytest.importorskip("preprocess_cancellation_cext")
+
+
+def scan(engine, data, interests, max_matches, raster):
+    """Everything the parser and the hull report for a buffer, scanned max_matches lines at a time"""
+    parser = engine.GCodeParser()
+    for code, line_start in enumerate(interests):
+        parser.register_interest(line_start, code)
+    hull = engine.Hull(raster=raster)
+    hull.precision = 0.5
+    parser.hull = hull
+
+    matches = []
+    start = 0
+    while True:
+        found = parser.feed_buffer(data, start, -1, max_matches)
+        matches.append(found)
+        if not found or not max_matches:
+            break
+        start = struct.unpack_from("=q", found, len(found) - 16)[0]
+
+    centroid = hull.centroid(0.02)
+    return (
+        matches,
+        parser.lines,
+        hull.points_added,
+        hull.cells,
+        hull.point_bytes(),
+        hull.convex_hull(),
+        hull.simplify(0.02),
+        hull.outline(0.02),
+        centroid and (centroid.x, centroid.y),
+    )
+
+
+@pytest.mark.parametrize("raster", [False, True])
+@pytest.mark.parametrize("max_matches", [0, 1, 7])
+@pytest.mark.parametrize("interests", [INTERESTS[:-1], INTERESTS[3:5], INTERESTS, []])
+def test_scan_matches_native(interests, max_matches, raster, native):
+    for infilepath in gcode_path.glob("*.gcode"):
+        data = infilepath.read_bytes()
+        assert scan(python, data, interests, max_matches, raster) == scan(native, data, interests, max_matches, raster)
+
+
+def test_lines_match_native(native):
+    # Unusual lines, parsed one by one instead of by the batched regular expression
+    gcode = (
+        b"G1 X1 Y2 E3\nG1X5 Y6 E1\ng1 x7 y8 e.5 ; comment X99\nG1 X1e1 Y-2 E+1*42\nG1 X Y2 E1\nG1 X3 X+ Y1 E1\n"
+        b"G1 A1X9 Y9 E9\nG1 X1.2.3 Y-.5- E0.1\n  \t G1 X4\tY4 E1\r\nG1 X5 Y5 E0\nG1 X5 Y5 E1\0X9\nEXCLUDE_OBJECT\n"
+        b"G1 Xinf Y1 E1\nG1 X1e999 Y1 E1\nG1 X1" + b"0" * 400 + b" Y1 E1\nexclude_object_start NAME=a\n\n   \nG1 X2 Y3 E1"
+    )
+    for start in range(0, 40, 3):
+        results = []
+        for engine in (native, python):
+            parser = engine.GCodeParser()
+            parser.register_interest("EXCLUDE_OBJECT", 1)
+            parser.hull = engine.Hull()
+            results.append((parser.feed_buffer(gcode, start), parser.lines, parser.hull.point_bytes()))
+        assert results[0] == results[1]
+
+    for line in gcode.replace(b"\0", b"").decode().splitlines():
+        parser = python.GCodeParser()
+        parser.register_interest("EXCLUDE_OBJECT", 1)
+        parser.hull = python.Hull()
+        expected = native.GCodeParser()
+        expected.register_interest("EXCLUDE_OBJECT", 1)
+        expected.hull = native.Hull()
+        assert parser.feed_line(line) == expected.feed_line(line)
+        assert parser.hull.point_bytes() == expected.hull.point_bytes()
+
+
+def test_hull_matches_native(native):
+    points = [(x * 0.37 % 17, (x * x) * 0.11 % 13) for x in range(5000)]
+    results = []
+    for engine in (native, python):
+        hull = engine.Hull()
+        hull.points = [engine.Point(x, y) for x, y in points]
+        other = engine.Hull(raster=True)
+        other.precision = 0.3
+        other.points = [engine.Point(x + 10, y) for x, y in points[:100]]
+        hull.merge(other)
+        results.append((hull.points_added, hull.point_bytes(), hull.simplify(1), other.outline(), other.cells))
+    assert results[0] == results[1]
+
+    with pytest.raises(TypeError):
+        python.Hull().points = (python.Point(1, 2),)
+    with pytest.raises(TypeError):
+        python.GCodeParser().hull = python.Point(1, 2)
+
+
+def test_moves_match_native(native):
+    for infilepath in gcode_path.glob("*.gcode"):
+        data = infilepath.read_bytes()
+        tables = []
+        for engine in (native, python):
+            table = engine.MoveTable()
+            # Starting in the middle of a line
+            table.scan(data, 5, len(data) // 2, 1)
+            table.scan(data, len(data) // 2, object_id=2)
+            tables.append(table)
+        assert tables[0].lines == tables[1].lines
+        assert len(tables[0]) == len(tables[1])
+        for name in ["line", "command", "x", "y", "z", "e", "f", "object"]:
+            assert bytes(memoryview(tables[0].column(name))) == bytes(tables[1].column(name))
+            assert tables[1].column(name).format == memoryview(tables[0].column(name)).format
+            assert tables[1].column(name).readonly
+
+
+def test_codecs_match_native(native):
+    gcode = (gcode_path / "prusaslicer.gcode").read_bytes()[:50000]
+    for window, lookahead in [(11, 4), (12, 4)]:
+        compressed = native.heatshrink_encode(gcode, window, lookahead)
+        assert python.heatshrink_encode(gcode, window, lookahead) == compressed
+        assert python.heatshrink_decode(compressed, window, lookahead) == gcode
+
+    packed = native.meatpack_encode(gcode)
+    assert python.meatpack_encode(gcode) == packed
+    assert python.meatpack_decode(packed) == gcode
+    assert python.meatpack_decode(b"\xff\xff\xfb\xff\xff\xf7\x1d\x1e\x2b\x0c") == b"G1 X1 E2\n"
+
+
+@pytest.mark.parametrize("raster_hulls", [False, True])
+def test_output_matches_native(monkeypatch, raster_hulls, native):
+    monkeypatch.setattr(preprocess_cancellation, "raster_hulls", raster_hulls)
+    for infilepath in gcode_path.glob("*.gcode"):
+        expected = io.BytesIO()
+        preprocessor(io.BytesIO(infilepath.read_bytes()), expected)
+
+        with monkeypatch.context() as m:
+            for name in ENGINE_NAMES:
+                m.setattr(preprocess_cancellation, name, getattr(python, name))
+            output = io.BytesIO()
+            preprocessor(io.BytesIO(infilepath.read_bytes()), output)
+
+        assert output.getvalue() == expected.getvalue()
+
+
+def test_without_native(tmp_path):
+    # The module falls back to the Python engine if the extension can't be imported, and processes files the same way
+    outputs = []
+    for blocked in ["preprocess_cancellation_cext", "no_such_module"]:
+        infilepath = tmp_path / f"{blocked}.gcode"
+        shutil.copy(gcode_path / "slic3r.gcode", infilepath)
+        code = (
+            f"import sys; sys.modules[{blocked!r}] = None; import preprocess_cancellation; "
+            f"assert preprocess_cancellation.process_file_for_cancellation({str(infilepath)!r}); "
+            "print(preprocess_cancellation.native_engine, preprocess_cancellation.GCodeParser.__module__)"
+        )
+        engine = subprocess.run([sys.executable, "-c", code], check=True, capture_output=True, text=True).stdout
+        outputs.append(infilepath.read_bytes())
+        if blocked == "preprocess_cancellation_cext":
+            assert engine.split() == ["False", "preprocess_cancellation_pyext"]
+    assert outputs[0] == outputs[1]
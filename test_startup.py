@@ -0,0 +1,32 @@
+import subprocess
+import sys
+
+# Needed only by some features, or by the command line
+LAZY_MODULES = [
+    "shapely",
+    "numpy",
+    "asyncio",
+    "json",
+    "concurrent.futures",
+    "multiprocessing",
+    "tempfile",
+    "hashlib",
+    "socket",
+    "gzip",
+    "bz2",
+    "lzma",
+    "argparse",
+    "logging.handlers",
+    "preprocess_cancellation_daemon",
+]
+
+
+def test_lazy_imports():
+    result = subprocess.run(
+        [sys.executable, "-c", "import sys, preprocess_cancellation; print(' '.join(sys.modules))"],
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    loaded = set(result.stdout.split())
+    assert [module for module in LAZY_MODULES if module in loaded] == []
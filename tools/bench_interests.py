@@ -0,0 +1,29 @@
+#!/usr/bin/python3
+"""Micro-benchmark of the interest matching, scanning the corpus with the slicer identification interests."""
+import pathlib
+import sys
+import time
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+from preprocess_cancellation import SLICERS
+from preprocess_cancellation_cext import GCodeParser
+
+repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+corpus = pathlib.Path(__file__).resolve().parent.parent / "GCode"
+data = b"".join(path.read_bytes() for path in sorted(corpus.glob("*.gcode")))
+
+parser = GCodeParser()
+parser.register_interest("EXCLUDE_OBJECT_DEFINE", 1)
+parser.register_interest("DEFINE_OBJECT", 1)
+for marker, _ in SLICERS.values():
+    parser.register_interest(marker, 2)
+
+best = float("inf")
+for _ in range(repeat):
+    start = time.perf_counter()
+    parser.feed_buffer(data)
+    best = min(best, time.perf_counter() - start)
+
+lines = data.count(b"\n")
+print(f"{len(data) / 1e6:.1f} MB, {lines} lines: {best * 1e3:.1f} ms, {len(data) / best / 1e6:.0f} MB/s")
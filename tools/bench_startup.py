@@ -0,0 +1,39 @@
+#!/usr/bin/python3
+"""Time the import of preprocess_cancellation, cold (nothing compiled yet) and warm, as reported by -X importtime"""
+import os
+import pathlib
+import re
+import subprocess
+import sys
+import tempfile
+
+root = pathlib.Path(__file__).resolve().parent.parent
+
+
+def import_time(pycache_prefix) -> float:
+    """Cumulative time of importing the module in a new interpreter"""
+    env = dict(os.environ, PYTHONPYCACHEPREFIX=str(pycache_prefix))
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import preprocess_cancellation"],
+        cwd=root,
+        env=env,
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    cumulative = re.search(r"^import time:\s+\d+ \|\s+(\d+) \| preprocess_cancellation$", result.stderr, re.M)
+    return int(cumulative[1]) / 1e6
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    with tempfile.TemporaryDirectory() as pycache_prefix:
+        cold = import_time(pycache_prefix)
+        warm = sorted(import_time(pycache_prefix) for _ in range(runs))
+    print(f"cold {cold * 1000:.1f} ms")
+    print(f"warm {warm[0] * 1000:.1f} ms best, {warm[len(warm) // 2] * 1000:.1f} ms median of {runs}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,286 @@
+#!/usr/bin/python3
+"""Benchmark the processing stages on synthetic files of each slicer dialect.
+
+Generates multi-object files of the requested size, then times slicer detection, the scan pass, the hull computation
+and the output pass separately. Each case runs in a fresh process, so that its peak RSS can be reported. The native
+scan and hulls can be compared with a pure-Python reference (--reference). Results can be saved as a JSON baseline and
+later compared against it to catch regressions.
+
+    tools/benchmark.py --size 256M --baseline-out baseline.json
+    tools/benchmark.py --size 256M --compare baseline.json
+    tools/benchmark.py --generate big.gcode --dialect cura --size 2G
+"""
+import argparse
+import concurrent.futures
+import io
+import json
+import math
+import os
+import pathlib
+import resource
+import sys
+import tempfile
+import time
+from typing import NamedTuple
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+import preprocess_cancellation as pc
+
+STAGES = ["detect", "scan", "hulls", "output"]
+
+
+class Dialect(NamedTuple):
+    header: str
+    object_start: str
+    object_end: str
+    layer_end: str = ""
+    footer: str = ""
+
+
+DIALECTS = {
+    "prusaslicer": Dialect(
+        "; generated by PrusaSlicer 2.4.0+linux-x64 on 2021-09-03 at 16:52:36 UTC\n",
+        "; printing object {name} id:{id} copy 0\n",
+        "; stop printing object {name} id:{id} copy 0\n",
+    ),
+    "superslicer": Dialect(
+        "; generated by SuperSlicer 2.3.56 on 2021-09-03 at 16:50:39 UTC\n",
+        "; printing object {name} id:{id} copy 0\n",
+        "; stop printing object {name} id:{id} copy 0\n",
+    ),
+    "slic3r": Dialect(
+        "; generated by Slic3r 1.3.1-dev on 2021-09-03 at 12:55:43\n",
+        "; printing object {name} id:{id} copy 0\n",
+        "; stop printing object {name} id:{id} copy 0\n",
+    ),
+    "cura": Dialect(
+        ";FLAVOR:Marlin\n;Generated with Cura_SteamEngine 4.10.0\n",
+        ";MESH:{name}\n",
+        ";MESH:NONMESH\n",
+        layer_end=";TIME_ELAPSED:{layer}.0\n",
+    ),
+    "ideamaker": Dialect(
+        ";Sliced by ideaMaker 4.2.0.5250, 2021-09-03 09:54:14 UTC-0700\n;TOTAL_NUM: {count}\n",
+        ";PRINTING: {name}\n;PRINTING_ID: {id}\n",
+        "",
+        footer=";PRINTING_ID: -1\n;REMAINING_TIME: 0\n",
+    ),
+    "m486": Dialect(
+        "M486 T{count}\n",
+        "M486 S{id}\n",
+        "M486 S-1\n",
+    ),
+}
+
+
+def parse_size(text: str) -> int:
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+    text = text.strip().upper().rstrip("B")
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+def _object_layer(index, columns, points=120):
+    """Perimeter of one object for a single layer, as relative extrusions around a circle with a bump"""
+    cx = 30 + 40 * (index % columns)
+    cy = 30 + 40 * (index // columns)
+    lines = [f"G1 X{cx + 15:.3f} Y{cy:.3f} F9000\n"]
+    for i in range(1, points + 1):
+        angle = 2 * math.pi * i / points
+        radius = 15 + (3 if i % 30 < 5 else 0)
+        lines.append(f"G1 X{cx + radius * math.cos(angle):.3f} Y{cy + radius * math.sin(angle):.3f} E0.04512\n")
+    return "".join(lines).encode()
+
+
+def generate(path, dialect_name: str, size: int, objects: int = 9):
+    """Write a synthetic file of roughly size bytes, every object printing one perimeter per layer"""
+    dialect = DIALECTS[dialect_name]
+    columns = math.ceil(math.sqrt(objects))
+    names = [f"part_{i}.stl" for i in range(objects)]
+    layers = [_object_layer(i, columns) for i in range(objects)]
+
+    with open(path, "wb") as f:
+        f.write(dialect.header.format(count=objects).encode())
+        f.write(b"M83\nG28\n")
+        layer = 0
+        while f.tell() < size:
+            layer += 1
+            f.write(f"G1 Z{0.2 * layer:.2f} F600\n".encode())
+            for i in range(objects):
+                f.write(dialect.object_start.format(name=names[i], id=i).encode())
+                f.write(layers[i])
+                f.write(dialect.object_end.format(name=names[i], id=i).encode())
+            f.write(dialect.layer_end.format(layer=layer).encode())
+        f.write(dialect.footer.encode())
+
+
+def _reference_scan(infile, slicer_factory):
+    """Pure-Python equivalent of the native scan pass, returns the rounded points per object"""
+    slicer = slicer_factory()
+    interests = [
+        (prefix.lower().encode(), callback)
+        for prefix, callback in pc._collect_interests(slicer, slicer.slicer_start_scan)
+    ]
+    points = {}
+    current = None
+    infile.seek(0)
+    for line in infile:
+        stripped = line.lstrip()
+        lowered = stripped[:64].lower()
+        for prefix, callback in interests:
+            if lowered.startswith(prefix):
+                callback(line)
+                hull = slicer.parser.hull
+                current = None if hull is None else points.setdefault(id(hull), set())
+                break
+        else:
+            if current is None or not lowered.startswith(b"g"):
+                continue
+            x = y = e = None
+            for word in stripped.split(b";")[0].split()[1:]:
+                axis = word[:1].upper()
+                try:
+                    if axis == b"X":
+                        x = float(word[1:])
+                    elif axis == b"Y":
+                        y = float(word[1:])
+                    elif axis == b"E":
+                        e = float(word[1:])
+                except ValueError:
+                    pass
+            if x is not None and y is not None and e is not None and e > 0:
+                current.add((round(x / pc.precision), round(y / pc.precision)))
+    return points
+
+
+def _reference_hull(points):
+    """Andrew's monotone chain"""
+    points = sorted(points)
+    if len(points) < 3:
+        return points
+
+    def cross(o, a, b):
+        return (a[0] - o[0]) * (b[1] - o[1]) - (a[1] - o[1]) * (b[0] - o[0])
+
+    lower, upper = [], []
+    for p in points:
+        while len(lower) >= 2 and cross(lower[-2], lower[-1], p) <= 0:
+            lower.pop()
+        lower.append(p)
+    for p in reversed(points):
+        while len(upper) >= 2 and cross(upper[-2], upper[-1], p) <= 0:
+            upper.pop()
+        upper.append(p)
+    return lower[:-1] + upper[:-1]
+
+
+def _timed(results, stage, function, *args):
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    value = function(*args)
+    results[stage] = {"wall": time.perf_counter() - wall, "cpu": time.process_time() - cpu}
+    return value
+
+
+def _run_case(path, engine):
+    """Runs in a fresh worker process"""
+    pc.logger.setLevel("WARNING")
+    results = {}
+    with open(path, "rb") as infile:
+        slicer_factory, _ = _timed(results, "detect", pc._identify_slicer, infile)
+        if engine == "native":
+            slicer = _timed(results, "scan", pc._scan_objects, infile, slicer_factory)
+            hulls = [known.hull for known in slicer.known_objects.values() if known.hull.points]
+            _timed(results, "hulls", lambda: [slicer.get_hull_bounds(hull) for hull in hulls])
+            with tempfile.TemporaryFile(dir=os.path.dirname(path)) as outfile:
+                _timed(results, "output", pc._write_pieces, pc._output_pieces(slicer), infile, outfile)
+        else:
+            points = _timed(results, "scan", _reference_scan, io.BufferedReader(infile), slicer_factory)
+            _timed(results, "hulls", lambda: [_reference_hull(p) for p in points.values()])
+
+    # ru_maxrss is in KiB on Linux
+    results["peak_rss"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return results
+
+
+def run(dialects, size, objects, engines, workdir):
+    cases = {}
+    for dialect in dialects:
+        path = os.path.join(workdir, f"{dialect}.gcode")
+        generate(path, dialect, size, objects)
+        actual_size = os.path.getsize(path)
+        for engine in engines:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=1) as executor:
+                results = executor.submit(_run_case, path, engine).result()
+            case = {"size": actual_size, "peak_rss": results.pop("peak_rss")}
+            for stage, timing in results.items():
+                timing["mb_s"] = actual_size / timing["wall"] / 1e6 if timing["wall"] > 0 else float("inf")
+                case[stage] = timing
+            cases[f"{dialect}/{engine}"] = case
+            _print_case(f"{dialect}/{engine}", case)
+        os.unlink(path)
+    return cases
+
+
+def _print_case(name, case):
+    stages = "  ".join(
+        f"{stage} {case[stage]['mb_s']:8.1f} MB/s" if stage in case else f"{stage} {'-':>8}     "
+        for stage in STAGES
+    )
+    print(f"{name:24} {case['size'] / 1e6:8.1f} MB  {stages}  peak {case['peak_rss'] / 1e6:7.1f} MB", flush=True)
+
+
+def compare(cases, baseline, tolerance) -> bool:
+    """Returns False if some stage got slower than the baseline by more than tolerance"""
+    ok = True
+    for name, case in cases.items():
+        if name not in baseline["cases"]:
+            continue
+        for stage in STAGES:
+            if stage not in case or stage not in baseline["cases"][name]:
+                continue
+            before = baseline["cases"][name][stage]["mb_s"]
+            after = case[stage]["mb_s"]
+            if after < before * (1 - tolerance):
+                print(f"REGRESSION {name} {stage}: {after:.1f} MB/s, baseline {before:.1f} MB/s")
+                ok = False
+    return ok
+
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    argparser.add_argument("--size", default="64M", help="Size of each generated file, e.g. 512M or 4G")
+    argparser.add_argument("--dialect", action="append", choices=sorted(DIALECTS), help="Default all dialects")
+    argparser.add_argument("--objects", type=int, default=9, help="Number of objects in each file")
+    argparser.add_argument("--reference", action="store_true", help="Also run the pure-Python reference")
+    argparser.add_argument("--workdir", help="Directory for the generated files (default system temporary directory)")
+    argparser.add_argument("--baseline-out", help="Write the results as a JSON baseline")
+    argparser.add_argument("--compare", help="Compare with a JSON baseline, exit with 1 on regressions")
+    argparser.add_argument("--tolerance", type=float, default=0.2, help="Allowed slowdown against the baseline")
+    argparser.add_argument("--generate", metavar="FILE", help="Only generate a file (of the first dialect)")
+    args = argparser.parse_args()
+
+    size = parse_size(args.size)
+    dialects = args.dialect or list(DIALECTS)
+    if args.generate:
+        generate(args.generate, dialects[0], size, args.objects)
+        return
+
+    engines = ["native", "python"] if args.reference else ["native"]
+    with tempfile.TemporaryDirectory(dir=args.workdir) as workdir:
+        cases = run(dialects, size, args.objects, engines, workdir)
+
+    if args.baseline_out:
+        with open(args.baseline_out, "w") as f:
+            json.dump({"version": pc.__version__, "cases": cases}, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if not compare(cases, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
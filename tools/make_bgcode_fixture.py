@@ -0,0 +1,119 @@
+#!/usr/bin/python3
+"""Write GCode/prusaslicer.bgcode, the binary G-code fixture of the tests, from GCode/prusaslicer.gcode"""
+# Laid out like PrusaSlicer's default output: metadata (naming the slicer, the G-code doesn't), a thumbnail, then G-code
+# blocks compressed with heatshrink (12, 4) and MeatPack encoded with comments. The encoders aren't ours, so that the
+# tests don't check our decoders against our encoders: heatshrink2 is the reference implementation (pip install
+# heatshrink2), MeatPack is packed here the way the printer side of the protocol expects.
+import pathlib
+import struct
+import zlib
+
+import heatshrink2
+
+root = pathlib.Path(__file__).resolve().parent.parent
+# Block types
+FILE_METADATA, GCODE, SLICER_METADATA, PRINTER_METADATA, PRINT_METADATA, THUMBNAIL = range(6)
+# Compressions
+NONE, DEFLATE, HEATSHRINK_12_4 = 0, 1, 3
+MEATPACK_COMMENTS = 2
+GCODE_BLOCK = 64 * 1024
+
+SIGNAL = b"\xff\xff"
+ENABLE_PACKING = SIGNAL + b"\xfb"
+DISABLE_PACKING = SIGNAL + b"\xfa"
+ENABLE_NO_SPACES = SIGNAL + b"\xf7"
+# Without spaces, the code of the space stands for E
+CODES = {c: i for i, c in enumerate(b"0123456789.E\nGX")}
+G_PARAMETERS = b"XYZEFIJRPWHCA"
+
+
+def block(type, parameters, data, compression=NONE):
+    payload = data
+    if compression == DEFLATE:
+        payload = zlib.compress(data)
+    elif compression == HEATSHRINK_12_4:
+        payload = heatshrink2.compress(data, window_sz2=12, lookahead_sz2=4)
+    header = struct.pack("<HHI", type, compression, len(data))
+    if compression:
+        header += struct.pack("<I", len(payload))
+    raw = header + parameters + payload
+    return raw + struct.pack("<I", zlib.crc32(raw))
+
+
+def pack(line: bytes) -> bytes:
+    """A line (with its line end) in packed mode"""
+    out = bytearray()
+    for i in range(0, len(line), 2):
+        pair = line[i : i + 2]
+        codes = [CODES.get(c, 0xF) for c in pair]
+        if len(pair) == 1:
+            # Only a line end can complete a byte on its own
+            assert pair == b"\n"
+            out.append(codes[0])
+            continue
+        out.append(codes[1] << 4 | codes[0])
+        out += bytes(c for c, code in zip(pair, codes) if code == 0xF)
+    return bytes(out)
+
+
+def meatpack(text: bytes) -> bytes:
+    out = bytearray(ENABLE_PACKING + ENABLE_NO_SPACES)
+    packing = True
+    for line in text.splitlines(keepends=True):
+        if line.startswith(b";"):
+            # Comments are sent as they are
+            if packing:
+                out += DISABLE_PACKING
+                packing = False
+            out += line
+            continue
+        if not packing:
+            out += ENABLE_PACKING
+            packing = True
+        if line.startswith(b"G") and b";" not in line:
+            # The printer puts back the spaces in front of the parameters
+            words = line.split(b" ")
+            if all(word[:1] in G_PARAMETERS for word in words[1:]):
+                line = b"".join(words)
+        out += pack(line)
+    return bytes(out)
+
+
+def png(width, height) -> bytes:
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+    rows = b"".join(b"\0" + b"\xff\x80\x00" * width for _ in range(height))
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+        + chunk(b"IDAT", zlib.compress(rows))
+        + chunk(b"IEND", b"")
+    )
+
+
+def main():
+    gcode = (root / "GCode" / "prusaslicer.gcode").read_bytes().replace(b"\r\n", b"\n")
+    # Binary G-code names the slicer in the file metadata only
+    gcode = b"".join(line for line in gcode.splitlines(keepends=True) if not line.startswith(b"; generated by "))
+    ini = struct.pack("<H", 0)
+    blocks = [
+        block(FILE_METADATA, ini, b"Producer=PrusaSlicer 2.7.0+linux-x64\n"),
+        block(PRINTER_METADATA, ini, b"printer_model=MK4\nfilament_type=PLA\nnozzle_diameter=0.4\n"),
+        block(THUMBNAIL, struct.pack("<HHH", 0, 16, 16), png(16, 16)),
+        block(PRINT_METADATA, ini, b"filament used [mm]=1234.5\nestimated printing time (normal mode)=25m\n"),
+        block(SLICER_METADATA, ini, b"layer_height = 0.2\nperimeters = 2\n", DEFLATE),
+    ]
+    text = b""
+    for line in gcode.splitlines(keepends=True):
+        if len(text) + len(line) > GCODE_BLOCK:
+            blocks.append(block(GCODE, struct.pack("<H", MEATPACK_COMMENTS), meatpack(text), HEATSHRINK_12_4))
+            text = b""
+        text += line
+    blocks.append(block(GCODE, struct.pack("<H", MEATPACK_COMMENTS), meatpack(text), HEATSHRINK_12_4))
+
+    (root / "GCode" / "prusaslicer.bgcode").write_bytes(b"GCDE" + struct.pack("<IH", 1, 1) + b"".join(blocks))
+
+
+if __name__ == "__main__":
+    main()